@@ -0,0 +1,124 @@
+"""Benchmark for the recipe annotation formats.
+
+Compares the throughput of writing and reading recipe annotations in the
+current format and in the version 1 format, for recipes with many parameters
+and long constant values.
+
+Usage: python benchmarks/benchmark_recipes.py [nb_params [constant_length]]
+"""
+
+import itertools
+import os
+import sys
+import timeit
+import urllib2
+
+
+top_level = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if top_level not in sys.path:
+    sys.path.append(top_level)
+
+
+import dat.main
+dat.main.setup_vistrails()
+
+
+from dat import DATRecipe, RecipeParameterValue
+from dat.global_data import GlobalManager
+from dat.tests import FakeObj
+from dat.vistrail_data import VistrailData
+
+
+def build_recipe_annotation_v1(recipe, conn_map):
+    """The version 1 writer, as it was before the current format.
+    """
+    value = '%s,%s' % (recipe.plot.package_identifier, recipe.plot.name)
+    for param, param_values in sorted(recipe.parameters.iteritems(),
+                                      key=lambda (k, v): k):
+        if not param_values:
+            continue
+        value += ';%s=' % param
+        if param_values[0].type == RecipeParameterValue.CONSTANT:
+            value += 'c='
+        else:
+            value += 'v='
+
+        for i, param_val, conn_list in itertools.izip(
+                itertools.count(), param_values, conn_map[param]):
+            if i != 0:
+                value += '|'
+            if param_val.type == RecipeParameterValue.CONSTANT:
+                value += urllib2.quote(param_val.constant, safe='')
+            else:
+                value += param_val.variable.name
+                if param_val.typecast is not None:
+                    value += ',%s' % param_val.typecast
+            value += ':' + ','.join(
+                '%d' % conn_id
+                for conn_id in conn_list)
+    return value
+
+
+def make_recipe(nb_params, constant_length):
+    """Builds a recipe mixing variables and long constants.
+
+    Returns (recipe, conn_map, vistraildata), the latter being a fake object
+    resolving the variables' names.
+    """
+    plot = FakeObj(package_identifier='benchmark.dat', name='Benchmark Plot')
+    variables = dict()
+    parameters = dict()
+    conn_map = dict()
+    conn_ids = itertools.count(1)
+    chunk = 'r\xC3\xA9mi;a=b|c:d,e '
+    constant = (chunk * (constant_length // len(chunk) + 1))[:constant_length]
+    for i in xrange(nb_params):
+        param = 'param%d' % i
+        if i % 2 == 0:
+            values = (RecipeParameterValue(constant=constant),)
+        else:
+            values = []
+            for j in xrange(3):
+                name = 'variable_%d_%d' % (i, j)
+                variables[name] = FakeObj(name=name)
+                values.append(RecipeParameterValue(
+                    variable=variables[name],
+                    typecast='cast_op' if j == 2 else None))
+            values = tuple(values)
+        parameters[param] = values
+        conn_map[param] = tuple((next(conn_ids), next(conn_ids))
+                                for v in values)
+    vistraildata = FakeObj(get_variable=variables.get)
+    return DATRecipe(plot, parameters), conn_map, vistraildata
+
+
+def bench(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    print "  %-8s %10.1f us/op  %10.0f op/s" % (
+        label, best / number * 1e6, number / best)
+
+
+def main(nb_params=50, constant_length=1000, number=200):
+    recipe, conn_map, vistraildata = make_recipe(nb_params, constant_length)
+
+    old_get_plot = GlobalManager.get_plot
+    GlobalManager.get_plot = lambda pkg_id, name: recipe.plot
+    try:
+        for label, build in (
+                ('v1', build_recipe_annotation_v1),
+                ('current', VistrailData._build_recipe_annotation)):
+            value = build(recipe, conn_map)
+            read = VistrailData._read_recipe_annotation(vistraildata, value)
+            if read != (recipe, conn_map):
+                raise AssertionError("%s annotation doesn't round-trip" %
+                                     label)
+            print "%s format (%d bytes):" % (label, len(value))
+            bench('encode', lambda: build(recipe, conn_map), number)
+            bench('decode', lambda: VistrailData._read_recipe_annotation(
+                vistraildata, value), number)
+    finally:
+        GlobalManager.get_plot = old_get_plot
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
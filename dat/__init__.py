@@ -15,6 +15,19 @@ variable_format = r'%s%s*' % (
     variable_format_other_chars)
 
 
+class DeferredVariable(object):
+    """Stands for a variable that is only looked up when first used.
+
+    resolve is called with the name of the variable and returns it.
+    """
+    def __init__(self, name, resolve):
+        self.name = name
+        self._resolve = resolve
+
+    def resolve(self):
+        return self._resolve(self.name)
+
+
 class RecipeParameterValue(object):
     VARIABLE = 1
     CONSTANT = 2
@@ -22,7 +35,7 @@ class RecipeParameterValue(object):
     def __init__(self, variable=None, constant=None, typecast=None):
         if variable is not None and constant is None:
             self.type = self.VARIABLE
-            self.variable = variable
+            self._variable = variable  # might be a DeferredVariable
             self.typecast = typecast  # str
             # This 'typecast' parameter is not really useful since it doesn't
             # unambiguously point to a specific operation (remember: we allow
@@ -34,6 +47,20 @@ class RecipeParameterValue(object):
         else:
             raise ValueError
 
+    @property
+    def variable(self):
+        """The variable, looked up on first access if it was deferred.
+        """
+        if isinstance(self._variable, DeferredVariable):
+            self._variable = self._variable.resolve()
+        return self._variable
+
+    @property
+    def variable_name(self):
+        """The name of the variable, without looking it up.
+        """
+        return self._variable.name
+
     def __eq__(self, other):
         if not isinstance(other, RecipeParameterValue):
             return False
@@ -49,7 +76,7 @@ class RecipeParameterValue(object):
 
     def __hash__(self):
         if self.type == self.VARIABLE:
-            return hash((self.type, self.variable.name))
+            return hash((self.type, self.variable_name))
         else:  # self.type == self.CONSTANT:
             return hash((self.type, self.constant))
 
@@ -60,7 +87,7 @@ class RecipeParameterValue(object):
             else:
                 typecast = ''
             return 'RecipeParameterValue(variable=%s%s)' % (
-                self.variable.name, typecast)
+                self.variable_name, typecast)
         else:
             return 'RecipeParameterValue(constant=%r)' % self.constant
 
@@ -0,0 +1,325 @@
+"""Headless execution of the DAT plots stored in vistrail files.
+
+This is the 'batch' command:
+    python -m dat batch [-o OUTPUT_DIR] [-j JOBS] file.vt [file.vt ...]
+
+Each vistrail is loaded through a VistrailData, and the latest pipeline of
+every cell is executed, one batch per sheet, without any window. Spreadsheet
+cells are rendered to files in OUTPUT_DIR/<vistrail>/<sheet>/, and the time
+and outcome of each pipeline is reported.
+
+With JOBS > 1, the pipelines are serialized and executed by a pool of worker
+processes instead; each cell is then rendered to its own directory,
+OUTPUT_DIR/<vistrail>/<sheet>/cell_<row>_<col>/.
+
+Rendering the cells still needs Qt, and so a display; on a headless machine,
+run it under a virtual X server, e.g. with xvfb-run.
+"""
+
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import warnings
+
+from PyQt4 import QtGui
+
+from dat.global_data import GlobalManager
+from dat.gui.application import NotificationDispatcher
+from dat.utils import LRUCache
+from dat.vistrail_data import VistrailData
+from dat import vistrails_interface
+from dat.vistrails_interface.utils import set_disk_cache_directory
+
+from vistrails.core.application import set_vistrails_application, \
+    VistrailsApplicationInterface
+from vistrails.core.configuration import get_vistrails_configuration
+import vistrails.core.db.io
+from vistrails.core.db.locator import FileLocator
+from vistrails.core.system import current_dot_vistrails
+from vistrails.core.utils import DummyView
+from vistrails.core.vistrail.controller import VistrailController
+from vistrails.core.vistrail.pipeline import Pipeline
+
+
+class BatchApplication(QtGui.QApplication, NotificationDispatcher,
+                       VistrailsApplicationInterface):
+    """Application used to execute DAT pipelines without the GUI.
+
+    A QApplication is still needed because spreadsheet cells are Qt widgets;
+    they are rendered to files instead of being shown.
+    """
+    def __init__(self, optionsDict={}):
+        QtGui.QApplication.__init__(self, [])
+        NotificationDispatcher.__init__(self)
+        # Every VistrailData creates the same notifications
+        warnings.simplefilter('ignore', NotificationDispatcher.UsageWarning)
+
+        VistrailsApplicationInterface.__init__(self)
+        set_vistrails_application(self)
+
+        options = {
+            'batch': True,
+            'installBundles': False,
+            'enablePackagesSilently': True,
+        }
+        options.update(optionsDict)
+        VistrailsApplicationInterface.init(self,
+                                           options_dict=options,
+                                           args=[])
+
+        # Share the caches of the GUI
+        set_disk_cache_directory(os.path.join(current_dot_vistrails(),
+                                              'dat_cache'))
+
+        self.startup.set_package_to_enabled('spreadsheet')
+        self.package_manager.initialize_packages()
+
+        # Discover the plots from packages
+        GlobalManager.init()
+
+    # Various getters required by VisTrails's code...
+
+    def is_running(self):
+        return True
+
+    def is_running_gui(self):
+        return False
+
+    def get_current_controller(self):
+        return None
+    get_controller = get_current_controller
+
+    def get_vistrail(self):
+        return None
+
+
+def _safe_filename(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or '_'
+
+
+def _load_controller(filename):
+    locator = FileLocator(os.path.abspath(filename))
+    loaded_objs = vistrails.core.db.io.load_vistrail(locator)
+    return VistrailController(loaded_objs[0], locator, *loaded_objs[1:])
+
+
+def load_vistrail(filename):
+    """Opens a vistrail file and returns its VistrailData.
+    """
+    return VistrailData(_load_controller(filename))
+
+
+# In the worker processes of the pool
+_worker_app = None
+_worker_controllers = LRUCache(2)  # filename -> VistrailController
+
+
+def _init_worker():
+    """Sets up VisTrails in a worker process of the pool.
+    """
+    global _worker_app
+    _worker_app = BatchApplication()
+
+
+def _execute_in_worker(job):
+    """Executes a serialized pipeline in a worker process of the pool.
+
+    The vistrail is loaded as well, for its vistrail variables; pipelines come
+    already upgraded from the main process. Returns (error, seconds).
+    """
+    filename, version, pipeline_xml, stores, dump_dir = job
+    start = time.time()
+    try:
+        controller = _worker_controllers.get(filename)
+        if controller is None:
+            controller = _worker_controllers[filename] = _load_controller(
+                filename)
+        pipeline = vistrails.core.db.io.unserialize(pipeline_xml, Pipeline)
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        get_vistrails_configuration().spreadsheetDumpCells = dump_dir
+        results, changed = controller.execute_workflow_list([(
+            controller.locator,     # locator
+            version,                # version
+            pipeline,               # pipeline
+            DummyView(),            # view
+            None,                   # custom_aliases
+            None,                   # custom_params
+            "DAT batch execution",  # reason
+            None,                   # sinks
+            {})])                   # extra_info
+        error = vistrails_interface.execution_error(results[0])
+        vistrails_interface.store_variable_values(stores, results[0])
+    except Exception, e:
+        logging.exception("Couldn't execute version %d of %s",
+                          version, filename)
+        error = str(e) or e.__class__.__name__
+    return error, time.time() - start
+
+
+def _execute_serial(controller, jobs):
+    """Executes the jobs in this process, one batch per sheet.
+    """
+    configuration = get_vistrails_configuration()
+    outcomes = []
+    for dump_dir, sheet_jobs in itertools.groupby(jobs, lambda j: j[4]):
+        sheet_jobs = list(sheet_jobs)
+        configuration.spreadsheetDumpCells = dump_dir
+        results = vistrails_interface.execute_pipelines(
+            controller,
+            [pipelineInfo for s, r, c, pipelineInfo, d in sheet_jobs],
+            reason="DAT batch execution")
+        outcomes.extend((error, seconds)
+                        for pipelineInfo, error, seconds in results)
+    return outcomes
+
+
+def _execute_parallel(pool, filename, controller, jobs):
+    """Executes the jobs in the worker processes of a pool.
+
+    Each cell is dumped in its own directory, as workers run concurrently.
+    """
+    filename = os.path.abspath(filename)
+    pending = []
+    for sheetname, row, col, pipelineInfo, dump_dir in jobs:
+        if not vistrails_interface.recipe_is_complete(pipelineInfo.recipe):
+            pending.append(None)
+            continue
+        workflow = vistrails_interface.PipelineToExecute(controller,
+                                                         pipelineInfo)
+        pipeline = workflow.finish(controller)
+        pending.append(pool.apply_async(_execute_in_worker, ((
+            filename,
+            pipelineInfo.version,
+            vistrails.core.db.io.serialize(pipeline),
+            workflow.stores,
+            os.path.join(dump_dir, 'cell_%d_%d' % (row + 1, col + 1))),)))
+    return [(vistrails_interface.MISSING_PARAMS, 0.0) if result is None
+            else result.get()
+            for result in pending]
+
+
+def execute_vistrail(filename, output_dir, pool=None, out=sys.stdout):
+    """Executes every DAT cell of a vistrail file.
+
+    If a multiprocessing pool is given (see main()), the pipelines are
+    executed in its worker processes.
+
+    Returns the number of pipelines that failed.
+    """
+    start = time.time()
+    vistraildata = load_vistrail(filename)
+    controller = vistraildata.controller
+    out.write("%s: loaded in %.3fs\n" % (filename, time.time() - start))
+
+    sheets = dict()  # sheet_id -> [((row, col), PipelineInformation)]
+    for (row, col, sheet_id), pipelineInfo in (
+            vistraildata.get_latest_pipelines().iteritems()):
+        sheets.setdefault(sheet_id, []).append(((row, col), pipelineInfo))
+
+    vistrail_dir = os.path.join(
+        output_dir,
+        _safe_filename(os.path.splitext(os.path.basename(filename))[0]))
+    # [(sheetname, row, col, PipelineInformation, dump_dir)]
+    jobs = []
+    for sheet_id, cells in sorted(sheets.iteritems()):
+        sheetname = vistraildata.get_sheetname(sheet_id)
+        dump_dir = os.path.join(vistrail_dir, _safe_filename(sheetname))
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        for (row, col), pipelineInfo in sorted(cells):
+            jobs.append((sheetname, row, col, pipelineInfo, dump_dir))
+
+    if pool is None:
+        outcomes = _execute_serial(controller, jobs)
+    else:
+        outcomes = _execute_parallel(pool, filename, controller, jobs)
+
+    failed = 0
+    for (sheetname, row, col, pipelineInfo, dump_dir), (error, seconds) in (
+            itertools.izip(jobs, outcomes)):
+        if error is None:
+            status = "ok"
+        elif error is vistrails_interface.MISSING_PARAMS:
+            status = "skipped (missing parameters)"
+        else:
+            status = "ERROR: %s" % error
+            failed += 1
+        out.write("  %s (%d, %d) version %d: %.3fs %s\n" % (
+            sheetname, row + 1, col + 1, pipelineInfo.version,
+            seconds, status))
+    return failed
+
+
+def _has_display():
+    """Indicates whether Qt will be able to connect to a display.
+
+    Only X11 needs one to be configured; Windows and Mac OS X always have one.
+    """
+    if sys.platform.startswith('win') or sys.platform == 'darwin':
+        return True
+    return bool(os.environ.get('DISPLAY'))
+
+
+def main(args):
+    """Entry point for the 'batch' command.
+    """
+    parser = argparse.ArgumentParser(
+        prog='dat batch',
+        description="Executes the DAT plots of vistrail files without the "
+                    "GUI, rendering the cells to files.")
+    parser.add_argument('-o', '--output', metavar='OUTPUT_DIR',
+                        help="directory where cells are rendered (default: a "
+                             "new temporary directory)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes executing the "
+                             "pipelines (default: 1, execute in this "
+                             "process)")
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help="vistrail files to execute")
+    options = parser.parse_args(args)
+
+    # Qt would abort the process, in every worker as well
+    if not _has_display():
+        sys.stderr.write(
+            "Error: no display available (DISPLAY is not set)\n"
+            "The cells are rendered with Qt, which needs an X server. On a "
+            "headless machine,\n"
+            "use a virtual one, for example:\n"
+            "    xvfb-run -a python -m dat batch FILE [FILE ...]\n")
+        return 1
+
+    output_dir = options.output
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='dat_batch_')
+    logging.info("Rendering cells to %s", output_dir)
+
+    # The workers have to be forked before Qt and VisTrails are set up here;
+    # each of them sets up its own
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs, initializer=_init_worker)
+    else:
+        pool = None
+
+    app = BatchApplication()
+    failed = 0
+    try:
+        for filename in options.files:
+            try:
+                failed += execute_vistrail(filename, output_dir, pool)
+            except Exception:
+                logging.exception("Couldn't execute %s", filename)
+                failed += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        app.finishSession()
+
+    return 1 if failed else 0
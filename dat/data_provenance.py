@@ -136,13 +136,13 @@ class Operation(_DataProvenanceNode):
             args = {}
             if operation.usable_in_command:
                 for variable, decl_arg in izip(arg_list, operation.parameters):
-                    if variable._materialized is None:
+                    if variable.materialized is None:
                         # Intermediate result: write its provenance
                         args[decl_arg.name] = variable.provenance
                     else:
                         # Materialized variable: reference it instead
                         args[decl_arg.name] = Variable(
-                            variable=variable._materialized)
+                            variable=variable.materialized)
             _DataProvenanceNode.__init__(
                 self,
                 pkg_id=operation.package_identifier,
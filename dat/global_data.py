@@ -1,7 +1,8 @@
 import warnings
 
 from dat import BaseVariableLoader
-from dat.vistrails_interface.utils import resolve_descriptor
+from dat.vistrails_interface.utils import resolve_descriptor, \
+    invalidate_upgraded_pipelines, invalidate_variable_values
 from dat.vistrails_interface.wrappers import Plot, VariableOperation, \
     OperationArgument
 
@@ -107,6 +108,10 @@ class GlobalManager(object):
 
         Discovers and registers Plots and VariableLoaders.
         """
+        # Upgrades and variable values might be different with this package
+        invalidate_upgraded_pipelines()
+        invalidate_variable_values()
+
         pm = get_package_manager()
         package = pm.get_package(package_identifier)
         if hasattr(package.init_module, '_plots'):
@@ -118,6 +123,7 @@ class GlobalManager(object):
                             package_identifier, package.codepath, plot))
                     continue
                 plot.package_identifier = package_identifier
+                plot._invalidate_pipeline()
 
                 # Resolve the port types
                 for port in plot.ports:
@@ -179,8 +185,12 @@ class GlobalManager(object):
         Removes the Plots and VariableLoaders associated with that package from
         the lists.
         """
+        invalidate_upgraded_pipelines()
+        invalidate_variable_values()
+
         for plot in self._plots.values():
             if plot.package_identifier == package.identifier:
+                plot._invalidate_pipeline()
                 self._remove_plot(plot)
 
         for loader in list(self._variable_loaders):
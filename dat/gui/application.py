@@ -1,17 +1,23 @@
+import itertools
 import logging
+import os
+import sip
 import warnings
 from PyQt4 import QtCore, QtGui
 
 from dat.gui import translate
 from dat.gui import vt_hooks
+from dat.gui.execution import get_execution_scheduler, \
+    stop_execution_scheduler
 from dat.gui.window import MainWindow
 from dat.global_data import GlobalManager
 from dat.vistrail_data import VistrailManager
-from dat import vistrails_interface
+from dat.vistrails_interface.utils import set_disk_cache_directory
 
 from vistrails.core.application import set_vistrails_application, \
     get_vistrails_application, VistrailsApplicationInterface
 import vistrails.core.requirements
+from vistrails.core.system import current_dot_vistrails
 import vistrails.gui.theme
 from vistrails.packages.spreadsheet.spreadsheet_cell import CellInformation
 from vistrails.packages.spreadsheet.spreadsheet_controller import \
@@ -169,6 +175,11 @@ class Application(QtGui.QApplication, NotificationDispatcher,
         VistrailsApplicationInterface.init(self,
                                            options_dict=optionsDict,
                                            args=args)
+
+        # Keep upgraded pipelines and the values of variables between sessions
+        set_disk_cache_directory(os.path.join(current_dot_vistrails(),
+                                              'dat_cache'))
+
         from vistrails.gui.vistrails_window import QVistrailsWindow
         self.builderWindow = QVistrailsWindow(ui_hooks=vt_hooks.hooks)
         self.builderWindow.closeEvent = lambda e: None
@@ -256,22 +267,7 @@ class Application(QtGui.QApplication, NotificationDispatcher,
 
         if new:
             # Execute the pipelines
-            for cellInfo, pipeline in vistraildata.all_cells:
-                tab = cellInfo.tab
-                error = vistrails_interface.try_execute(
-                    controller,
-                    pipeline)
-                if error is not None:
-                    from dat.gui.cellcontainer import DATCellContainer
-                    tab.setCellWidget(
-                        cellInfo.row,
-                        cellInfo.column,
-                        DATCellContainer(
-                            cellInfo=CellInformation(
-                                tab,
-                                cellInfo.row,
-                                cellInfo.column),
-                            error=error))
+            self.execute_cells(controller, list(vistraildata.all_cells))
 
         # Make one of these tabs current
         sh_window = spreadsheetController.findSpreadsheetWindow(
@@ -284,6 +280,40 @@ class Application(QtGui.QApplication, NotificationDispatcher,
                 tabidx = tab_controller.indexOf(tab)
                 tab_controller.setCurrentIndex(tabidx)
 
+    def execute_cells(self, controller, cells):
+        """Executes the pipelines of several cells in a single batch.
+
+        cells is a list of (CellInformation, PipelineInformation). The
+        execution goes through the ExecutionScheduler; the errors are shown on
+        the cells once it is done.
+        """
+        cells = list(cells)
+        get_execution_scheduler().execute_list(
+            controller,
+            [pipeline for cellInfo, pipeline in cells],
+            lambda errors: self._cells_executed(cells, errors))
+
+    def _cells_executed(self, cells, errors):
+        from dat.gui.cellcontainer import DATCellContainer
+
+        for (cellInfo, pipeline), error in itertools.izip(cells, errors):
+            tab = cellInfo.tab
+            if sip.isdeleted(tab):
+                continue  # The sheet was closed during the execution
+            container = tab.getCellWidget(cellInfo.row, cellInfo.column)
+            if isinstance(container, DATCellContainer):
+                container._set_error(error)
+            elif error is not None:
+                tab.setCellWidget(
+                    cellInfo.row,
+                    cellInfo.column,
+                    DATCellContainer(
+                        cellInfo=CellInformation(
+                            tab,
+                            cellInfo.row,
+                            cellInfo.column),
+                        error=error))
+
     def _sheet_changed(self, tab):
         vistraildata = VistrailManager.from_spreadsheet_tab(tab)
         if vistraildata is not None:
@@ -356,6 +386,7 @@ def start(args=[], optionsDict={}):
 def stop():
     """Stops the application and cleans up.
     """
+    stop_execution_scheduler()
     app = get_vistrails_application()
     app.finishSession()
     app.save_configuration()
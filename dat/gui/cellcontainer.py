@@ -1,3 +1,4 @@
+import sip
 import warnings
 
 from PyQt4 import QtCore, QtGui
@@ -6,8 +7,9 @@ from dat import MIMETYPE_DAT_VARIABLE, MIMETYPE_DAT_PLOT, DATRecipe, \
     RecipeParameterValue
 from dat.gui import get_icon
 from dat.gui import typecast_dialog
+from dat.gui.execution import get_execution_scheduler
 from dat.global_data import GlobalManager
-from dat.operations import apply_operation, get_typecast_operations
+from dat.operations import apply_operation, get_typecast_paths
 from dat.utils import deferrable_via_qt
 from dat.vistrail_data import VistrailManager
 from dat import vistrails_interface
@@ -94,6 +96,12 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
                      lambda: self._set_overlay(None))
         self._hide_action_enabled = False
 
+        # Busy indicator, shown while the pipeline executes in the background
+        self._busy_indicator = QtGui.QProgressBar(self)
+        self._busy_indicator.setRange(0, 0)
+        self._busy_indicator.setTextVisible(False)
+        self._busy_indicator.hide()
+
         # Error icon
         self._error_icon = QtGui.QLabel(self)
         self._error_icon.setPixmap(get_icon('error.png').pixmap(24, 24))
@@ -162,7 +170,7 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
             return
         if any(
                 (param.type == RecipeParameterValue.VARIABLE and
-                 param.variable.name == varname)
+                 param.variable_name == varname)
                 for params in self._parameters.itervalues()
                 for param in params):
             self._overlay.update()
@@ -173,7 +181,7 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
             return
         if any(
                 (param.type == RecipeParameterValue.VARIABLE and
-                 param.variable.name == varname)
+                 param.variable_name == varname)
                 for params in self._parameters.itervalues()
                 for param in params):
             # A variable was removed!
@@ -192,7 +200,7 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
                 for param, values in self._parameters.iteritems():
                     for i, value in enumerate(values):
                         if (value.type == RecipeParameterValue.VARIABLE and
-                                value.variable.name == varname):
+                                value.variable_name == varname):
                             to_remove.append((param, i))
                 for param, i in to_remove:
                     del self._parameters[param][i]
@@ -221,6 +229,8 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
         if widget is None:
             return
         widget.raise_()
+        if self._busy_indicator.isVisible():
+            self._busy_indicator.raise_()
         self._set_toolbar_buttons(True)
 
         self.contentsUpdated()
@@ -355,6 +365,9 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
             4, 4,
             self.width() - 8, self.height() - 8)
         self._error_icon.setGeometry(self.width() - 24, 0, 24, 24)
+        self._busy_indicator.setGeometry(
+            4, self.height() - 12,
+            self.width() - 8, 8)
 
     def dragEnterEvent(self, event):
         mimeData = event.mimeData()
@@ -566,28 +579,53 @@ class DATCellContainer(CellContainerInterface, QtGui.QWidget):
             self._execute_pending = False
 
             # Execute the new pipeline if possible
-            error = vistrails_interface.try_execute(
-                self._controller,
-                pipeline)
-            if (error is vistrails_interface.MISSING_PARAMS and
-                    self.widget() is not None):
-                # Clear the cell
-                self.cellInfo.tab.deleteCell(self.cellInfo.row,
-                                             self.cellInfo.column)
-            # Set error status
-            self._set_error(error)
+            if vistrails_interface.recipe_is_complete(recipe):
+                self._set_busy(True)
+                get_execution_scheduler().execute(
+                    self._controller,
+                    pipeline,
+                    self._execution_done,
+                    key=self.cellInfo)
+            else:
+                # Don't let a previous recipe show up in the cell
+                get_execution_scheduler().cancel(self.cellInfo)
+                self._set_busy(False)
+                if self.widget() is not None:
+                    # Clear the cell
+                    self.cellInfo.tab.deleteCell(self.cellInfo.row,
+                                                 self.cellInfo.column)
+                self._set_error(vistrails_interface.MISSING_PARAMS)
 
             return True
         except vistrails_interface.CancelExecution:
             return False
 
+    def _execution_done(self, error):
+        """Called by the ExecutionScheduler once the pipeline was executed.
+
+        The spreadsheet has already put the new widget in this cell.
+        """
+        if sip.isdeleted(self):
+            return  # The cell went away during the execution
+        self._set_busy(False)
+        self._set_error(error)
+
+    def _set_busy(self, busy):
+        if busy:
+            self._busy_indicator.show()
+            self._busy_indicator.raise_()
+        else:
+            self._busy_indicator.hide()
+
     def _typecast(self, controller, variable,
                   source_descriptor, expected_descriptor):
-        typecasts = get_typecast_operations(
+        typecasts = get_typecast_paths(
             source_descriptor,
             expected_descriptor)
         choice = typecast_dialog.choose_operation(
             typecasts,
             source_descriptor, expected_descriptor,
             self)
-        return apply_operation(controller, choice, [variable]), choice
+        for operation in choice:
+            variable = apply_operation(controller, operation, [variable])
+        return variable, choice
@@ -0,0 +1,280 @@
+"""Scheduling of the execution of DAT pipelines.
+
+The VisTrails interpreter and the modules' compute code (spreadsheet cells,
+matplotlib, VTK) have to run on the GUI thread, so every execution the GUI
+requests goes through a single ExecutionScheduler, which runs them one after
+the other from the Qt event loop. Requests return right away; the outcome is
+delivered later through a callback.
+
+Only the preparation of the pipelines happens in a worker thread: copying
+them and looking up the variable values in the disk cache (see
+PipelineToExecute). What uses the controller or the shared caches stays on
+the GUI thread, as does writing the values the execution computed to the disk
+cache.
+
+While a pipeline executes, the pending events are processed after each
+module, so the window is repainted and stays usable: the other cells can be
+edited, and a cell whose recipe changes can replace or cancel its running
+execution.
+
+Executions are queued by key (the cell): a new request replaces the one
+waiting for the same key, and cancels the one running for that key at the
+next module boundary, so only the latest recipe of a cell gets executed. This
+uses the interpreter's own abort mechanism, so the execution is still
+finalized and logged.
+"""
+
+from collections import OrderedDict
+import logging
+
+from PyQt4 import QtCore
+
+from dat import vistrails_interface
+
+from vistrails.core.application import get_vistrails_application
+from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.cached import CachedInterpreter
+from vistrails.core.utils import DummyView
+
+
+class _ExecutionJob(object):
+    """A request to execute some DAT pipelines.
+
+    prepare() and run() are called from the GUI thread; copy(), called in
+    between, only uses what prepare() got and runs in the worker thread.
+    """
+    def __init__(self, key, controller, pipelineInfos, callback):
+        self.key = key
+        self.controller = controller
+        self.pipelineInfos = pipelineInfos
+        self.callback = callback
+        self.cancelled = False
+        self._locator = None
+        self._logger = None
+        self._workflows = []  # [(index, PipelineToExecute)]
+        self._errors = dict()  # index -> error message
+
+    def module_executed(self, objId):
+        # The interpreter stops at this exception and still cleans up
+        if self.cancelled:
+            raise AbortExecution("Execution cancelled")
+        QtCore.QCoreApplication.processEvents()
+        # A request processed above might have cancelled this job
+        if self.cancelled:
+            raise AbortExecution("Execution cancelled")
+
+    def prepare(self):
+        """Selects the version and gets the pipelines to execute.
+        """
+        controller = self.controller
+        # Like try_execute(), select the version of the first pipeline
+        if self.pipelineInfos:
+            controller.change_selected_version(self.pipelineInfos[0].version)
+        self._locator = controller.locator
+        self._logger = controller.get_logger()
+        self._workflows = [
+            (i, vistrails_interface.PipelineToExecute(controller,
+                                                      pipelineInfo))
+            for i, pipelineInfo in enumerate(self.pipelineInfos)
+            if vistrails_interface.recipe_is_complete(pipelineInfo.recipe)]
+
+    def copy(self):
+        """Copies the pipelines to execute.
+        """
+        for i, workflow in self._workflows:
+            if self.cancelled:
+                break
+            try:
+                workflow.copy()
+            except Exception, e:
+                logging.exception("Got exception while copying version %d",
+                                  workflow.pipelineInfo.version)
+                self._errors[i] = str(e) or e.__class__.__name__
+
+    def run(self, interpreter):
+        """Executes the prepared pipelines, returning the list of errors.
+
+        The errors are None, MISSING_PARAMS or an error message, in the same
+        order as pipelineInfos. Pipelines are executed with the given
+        interpreter, one after the other, so that upstream modules they share
+        are only run once.
+        """
+        errors = [vistrails_interface.MISSING_PARAMS] * len(self.pipelineInfos)
+        for i, workflow in self._workflows:
+            if self.cancelled:
+                break
+            if i in self._errors:
+                errors[i] = self._errors[i]
+                continue
+            version = workflow.pipelineInfo.version
+            try:
+                result = interpreter.execute(
+                    workflow.finish(self.controller),
+                    locator=self._locator,
+                    current_version=version,
+                    view=DummyView(),
+                    logger=self._logger,
+                    reason="DAT recipe execution",
+                    extra_info={'module_executed_hook': [
+                        self.module_executed]})
+                errors[i] = vistrails_interface.execution_error(result)
+                workflow.store_values(result)
+            except Exception, e:
+                logging.exception("Got exception while executing version %d",
+                                  version)
+                errors[i] = str(e) or e.__class__.__name__
+        return errors
+
+
+class _CopyWorker(QtCore.QObject):
+    """Copies the pipelines of the jobs; lives in the scheduler's thread.
+    """
+    jobCopied = QtCore.pyqtSignal('PyQt_PyObject')
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def copy(self, job):
+        job.copy()
+        self.jobCopied.emit(job)
+
+
+class ExecutionScheduler(QtCore.QObject):
+    """Runs the execution of DAT pipelines one at a time, from the event loop.
+
+    Use the execute(), execute_list() and cancel() methods from the GUI
+    thread; the callbacks are called from the GUI thread as well.
+    """
+    _submit = QtCore.pyqtSignal('PyQt_PyObject')
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self._pending = OrderedDict()  # key -> _ExecutionJob
+        self._running = None  # _ExecutionJob, being copied or executed
+        self._stopped = False
+        # Not the default interpreter, which get_variable_value() uses from
+        # the events processed while a job is executing
+        self._interpreter = CachedInterpreter()
+        self._thread = QtCore.QThread()
+        self._worker = _CopyWorker()
+        self._worker.moveToThread(self._thread)
+        # Both are queued connections, as the objects live in different
+        # threads
+        self._submit.connect(self._worker.copy)
+        self._worker.jobCopied.connect(self._job_copied)
+        self._thread.start()
+
+    def execute(self, controller, pipelineInfo, callback, key=None):
+        """Schedules the execution of a DAT pipeline.
+
+        The recipe should be complete (see recipe_is_complete()).
+        callback(error) gets called once the pipeline has been executed, with
+        error either None or an error message.
+
+        If key is given, an execution for the same key that didn't start yet
+        is dropped (its callback won't be called), and one that is running is
+        cancelled.
+        """
+        if key is None:
+            key = object()
+        self._cancel_running(key)
+        # Replaces a pending request for the same key, keeping its place
+        self._pending[key] = _ExecutionJob(
+            key, controller, [pipelineInfo],
+            lambda errors: callback(errors[0]))
+        self._schedule()
+
+    def execute_list(self, controller, pipelineInfos, callback):
+        """Schedules the execution of several DAT pipelines in a single batch.
+
+        Upstream modules the pipelines share are only run once.
+        callback(errors) gets called once they have been executed, with the
+        list of errors (None, MISSING_PARAMS or an error message) in the same
+        order as pipelineInfos.
+        """
+        key = object()
+        self._pending[key] = _ExecutionJob(
+            key, controller, list(pipelineInfos), callback)
+        self._schedule()
+
+    def cancel(self, key):
+        """Cancels the execution scheduled for a key.
+
+        If it didn't start yet it is dropped, else the interpreter stops at
+        the next module boundary. Its callback won't be called.
+        """
+        self._pending.pop(key, None)
+        self._cancel_running(key)
+
+    def _cancel_running(self, key):
+        if self._running is not None and self._running.key == key:
+            self._running.cancelled = True
+
+    def _schedule(self):
+        # Jobs are started from the event loop, so requests made together
+        # get coalesced first
+        if self._running is None and self._pending and not self._stopped:
+            QtCore.QTimer.singleShot(0, self._start_next)
+
+    def _start_next(self):
+        # Executions are never nested, even though events are processed while
+        # a job is running
+        while (self._running is None and self._pending and
+                not self._stopped):
+            key, job = self._pending.popitem(last=False)
+            try:
+                job.prepare()
+            except Exception, e:
+                logging.exception("Got exception while preparing versions %s",
+                                  ', '.join(str(pipelineInfo.version)
+                                            for pipelineInfo
+                                            in job.pipelineInfos))
+                job.callback([str(e) or e.__class__.__name__] *
+                             len(job.pipelineInfos))
+                continue
+            self._running = job
+            self._submit.emit(job)
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def _job_copied(self, job):
+        errors = None
+        try:
+            if not job.cancelled:
+                errors = job.run(self._interpreter)
+        finally:
+            self._running = None
+        self._schedule()
+        if errors is not None:
+            get_vistrails_application().send_notification(
+                'execution_updated')
+        if not job.cancelled:
+            job.callback(errors)
+
+    def stop(self):
+        """Drops the pending executions and stops the worker thread.
+
+        The running execution is cancelled.
+        """
+        self._stopped = True
+        self._pending.clear()
+        if self._running is not None:
+            self._running.cancelled = True
+        self._thread.quit()
+        self._thread.wait()
+
+
+_scheduler = None
+
+
+def get_execution_scheduler():
+    """Gets the ExecutionScheduler, starting its thread on the first call.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ExecutionScheduler()
+    return _scheduler
+
+
+def stop_execution_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.stop()
+        _scheduler = None
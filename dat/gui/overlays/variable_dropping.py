@@ -4,7 +4,7 @@ from dat.gui.overlays import Overlay
 
 from dat import MIMETYPE_DAT_VARIABLE
 from dat.gui import translate
-from dat.operations.typecasting import get_typecast_operations
+from dat.operations.typecasting import get_typecast_paths
 from dat.vistrail_data import VistrailManager
 from dat.vistrails_interface.wrappers import DataPort
 
@@ -17,6 +17,20 @@ TYPECASTABLE = 'cast'
 INCOMPATIBLE = 'no'
 
 
+def port_compatibility(variable_type, port_type):
+    """Indicates whether a variable can be dropped on a port.
+
+    Returns COMPATIBLE, TYPECASTABLE if a typecast (possibly a chain of
+    operations, see get_typecast_paths()) is needed, or INCOMPATIBLE.
+    """
+    if issubclass(variable_type.module, port_type.module):
+        return COMPATIBLE
+    elif get_typecast_paths(variable_type, port_type):
+        return TYPECASTABLE
+    else:
+        return INCOMPATIBLE
+
+
 stylesheet = """
 DataParameter {
     background-color: #DDD;
@@ -115,17 +129,9 @@ class VariableDroppingOverlay(Overlay):
             varname = str(mimeData.data(MIMETYPE_DAT_VARIABLE))
             variable = (VistrailManager(self._cell._controller)
                         .get_variable(varname))
-            self._compatible_ports = []
-            for port in self._cell._plot.ports:
-                if issubclass(variable.type.module, port.type.module):
-                    self._compatible_ports.append(COMPATIBLE)
-                else:
-                    if get_typecast_operations(
-                            variable.type,
-                            port.type):
-                        self._compatible_ports.append(TYPECASTABLE)
-                    else:
-                        self._compatible_ports.append(INCOMPATIBLE)
+            self._compatible_ports = [
+                port_compatibility(variable.type, port.type)
+                for port in self._cell._plot.ports]
 
         self._cell._parameter_hovered = None
 
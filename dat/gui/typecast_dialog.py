@@ -10,6 +10,11 @@ from dat.vistrails_interface import CancelExecution
 
 def choose_operation(typecasts, source_descriptor, expected_descriptor,
                      parent=None):
+    """Asks the user how to typecast a variable.
+
+    typecasts is a list of TypecastPath, as returned by get_typecast_paths();
+    the one selected is returned.
+    """
     _ = translate('typecast_dialog')
 
     dialog = QtGui.QDialog(parent)
@@ -29,9 +34,13 @@ def choose_operation(typecasts, source_descriptor, expected_descriptor,
     list_widget = CategorizedListWidget()
     list_widget.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
     pm = get_package_manager()
-    for operation in typecasts:
-        package = pm.get_package(operation.package_identifier)
-        item = OperationItem(operation, package.name)
+    for path in typecasts:
+        if len(path) == 1:
+            package = pm.get_package(path[0].package_identifier)
+            category = package.name
+        else:
+            category = _("Chained conversions")
+        item = OperationItem(path, category)
         list_widget.addItem(item, item.category)
     layout.addWidget(list_widget)
 
@@ -79,7 +79,7 @@ def _get_custom_version_panels(controller, version):
     for p_values in recipe.parameters.itervalues():
         for value in p_values:
             if value.type == RecipeParameterValue.VARIABLE:
-                text.append(value.variable.name)
+                text.append(value.variable_name)
     text = '\n'.join(text)
     variable_list.setPlainText(text)
     variable_list.setFixedHeight(
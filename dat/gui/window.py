@@ -6,6 +6,7 @@ from dat.gui.operations import OperationPanel
 from dat.gui.plots import PlotPanel
 from dat.gui.variables import VariablePanel
 from dat.vistrail_data import VistrailManager
+from dat.vistrails_interface.pipelines import relayout_pipeline
 
 from vistrails.core.application import get_vistrails_application
 from vistrails.packages.spreadsheet.spreadsheet_controller import \
@@ -54,6 +55,15 @@ class MainWindow(QtGui.QMainWindow):
         self.connect(showBuilderAction, QtCore.SIGNAL('triggered()'),
                      get_vistrails_application().showBuilderWindow)
 
+        sheetMenu = menubar.addMenu(_("S&heet"))
+        executeAction = sheetMenu.addAction(_("&Execute all cells"))
+        executeAction.setShortcut('Ctrl+E')
+        self.connect(executeAction, QtCore.SIGNAL('triggered()'),
+                     self.executeSheet)
+        relayoutAction = sheetMenu.addAction(_("&Lay out all pipelines"))
+        self.connect(relayoutAction, QtCore.SIGNAL('triggered()'),
+                     self.relayoutSheet)
+
         # Spreadsheet hooks
         ss_hooks = dict(
             window_menu_main=False,
@@ -161,6 +171,37 @@ class MainWindow(QtGui.QMainWindow):
         bw.get_current_view().save_vistrail_as(
             bw.dbDefault and DBLocator or FileLocator())
 
+    def executeSheet(self):
+        """Executes every DAT cell of the current sheet in a single batch.
+        """
+        tab = self.spreadsheetWindow.tabController.currentWidget()
+        vistraildata = VistrailManager.from_spreadsheet_tab(tab)
+        if vistraildata is None:
+            return
+        get_vistrails_application().execute_cells(
+            vistraildata.controller,
+            [(cellInfo, pipeline)
+             for cellInfo, pipeline in vistraildata.all_cells
+             if cellInfo.tab is tab])
+
+    def relayoutSheet(self):
+        """Lays out the pipeline of every DAT cell of the current sheet again.
+
+        The modules are only moved, so the cells don't need to be executed.
+        """
+        tab = self.spreadsheetWindow.tabController.currentWidget()
+        vistraildata = VistrailManager.from_spreadsheet_tab(tab)
+        if vistraildata is None:
+            return
+        for cellInfo, pipeline in list(vistraildata.all_cells):
+            if cellInfo.tab is not tab:
+                continue
+            new_pipeline = relayout_pipeline(
+                vistraildata.controller,
+                pipeline,
+                "Laid out DAT plot %s" % pipeline.recipe.plot.name)
+            vistraildata.created_pipeline(cellInfo, new_pipeline)
+
     def closeEvent(self, event):
         if not self.quitApplication():
             event.ignore()
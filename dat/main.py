@@ -69,6 +69,11 @@ def main():
 
     setup_vistrails()
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        # Headless execution of the plots, see dat.batch
+        import dat.batch
+        sys.exit(dat.batch.main(sys.argv[2:]))
+
     try:
         import dat.gui.application
         v = dat.gui.application.start(args=sys.argv)
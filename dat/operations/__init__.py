@@ -1,3 +1,8 @@
+from dat.global_data import GlobalManager
+
+from vistrails.core.application import get_vistrails_application
+
+
 class InvalidOperation(ValueError):
     """Error while executing an expression.
     """
@@ -15,9 +20,74 @@ def is_operator(op_name):
     return op_name in iter('+-*/')
 
 
+class OperationIndex(object):
+    """An index of the VariableOperations, kept up to date.
+
+    keys(operation) gives the keys an operation is listed under. The index is
+    built on first use from the GlobalManager's operations, plus the ones
+    returned by extra_operations() if given, then updated through the
+    'dat_new_operation' and 'dat_removed_operation' notifications.
+
+    The functions registered with on_change() get called whenever an
+    operation is added or removed, to invalidate what was computed from the
+    index.
+    """
+    def __init__(self, keys, extra_operations=None):
+        self._keys = keys
+        self._extra_operations = extra_operations
+        self._index = None  # key -> set([VariableOperation])
+        self._change_callbacks = []
+
+    def on_change(self, callback):
+        self._change_callbacks.append(callback)
+
+    def get(self, key):
+        """Returns the operations listed under a key, as a set.
+
+        The set belongs to the index and shouldn't be modified.
+        """
+        if self._index is None:
+            app = get_vistrails_application()
+            app.register_notification('dat_new_operation',
+                                      self._operation_added)
+            app.register_notification('dat_removed_operation',
+                                      self._operation_removed)
+
+            self._index = dict()
+            for operation in GlobalManager.variable_operations:
+                self._add(operation)
+            if self._extra_operations is not None:
+                for operation in self._extra_operations():
+                    self._add(operation)
+        return self._index.get(key, frozenset())
+
+    def _add(self, operation):
+        for key in self._keys(operation):
+            self._index.setdefault(key, set()).add(operation)
+
+    def _operation_added(self, operation):
+        self._add(operation)
+        self._changed()
+
+    def _operation_removed(self, operation):
+        for key in self._keys(operation):
+            operations = self._index.get(key)
+            if operations is not None:
+                operations.discard(operation)
+                if not operations:
+                    del self._index[key]
+        self._changed()
+
+    def _changed(self):
+        for callback in self._change_callbacks:
+            callback()
+
+
 from dat.operations.execution import perform_operation, apply_operation
-from dat.operations.typecasting import get_typecast_operations
+from dat.operations.typecasting import get_typecast_operations, \
+    get_typecast_paths
 
 
 __all__ = ['InvalidOperation', 'OperationWarning',
-           'perform_operation', 'apply_operation', 'get_typecast_operations']
+           'perform_operation', 'apply_operation', 'get_typecast_operations',
+           'get_typecast_paths']
@@ -1,3 +1,6 @@
+import urllib
+
+from dat import data_provenance
 from dat.packages import Variable, VariableOperation, OperationArgument
 from dat.vistrails_interface.utils import resolve_descriptor
 
@@ -8,14 +11,29 @@ Float_desc = resolve_descriptor(Float)
 String_desc = resolve_descriptor(String)
 
 
+def _connect_operand(operand, calc, inputport_name):
+    """Connects an operand to an input port of a PythonCalc module.
+
+    Constants are set directly on the port instead of being connected from
+    their own Float module.
+    """
+    provenance = operand.provenance
+    if isinstance(provenance, data_provenance.Constant):
+        calc.add_function(inputport_name, Float_desc,
+                          repr(provenance['constant']))
+        operand.mark_used()
+    else:
+        operand.connect_to(calc, inputport_name)
+
+
 def float_op(op):
     def cb(op1, op2):
         new_var = Variable(type=Float_desc)
         calc = new_var.add_module(
             'org.vistrails.vistrails.pythoncalc:PythonCalc')
         calc.add_function('op', String_desc, op)
-        op1.connect_to(calc, 'value1')
-        op2.connect_to(calc, 'value2')
+        _connect_operand(op1, calc, 'value1')
+        _connect_operand(op2, calc, 'value2')
         new_var.select_output_port(calc, 'value')
         return new_var
 
@@ -29,9 +47,61 @@ def float_op(op):
         return_type=Float_desc)
 
 
+def float_negation():
+    def cb(op):
+        new_var = Variable(type=Float_desc)
+        calc = new_var.add_module(
+            'org.vistrails.vistrails.pythoncalc:PythonCalc')
+        calc.add_function('op', String_desc, '-')
+        calc.add_function('value1', Float_desc, '0.0')
+        _connect_operand(op, calc, 'value2')
+        new_var.select_output_port(calc, 'value')
+        return new_var
+
+    return VariableOperation(
+        '_',
+        callback=cb,
+        args=[
+            OperationArgument('op', Float_desc),
+        ],
+        return_type=Float_desc)
+
+
+def evaluate_expression(expression, operands, controller=None):
+    """Builds a Float variable computing an arithmetic expression.
+
+    The whole expression is evaluated by a single PythonSource module, instead
+    of a chain of PythonCalc modules, one per operator. expression is Python
+    code using the names in0, in1, ... for the operands, which are given as
+    ArgumentWrapper objects. The Variable is created in the given controller,
+    or the current one.
+    """
+    new_var = Variable(type=Float_desc, controller=controller)
+    source = new_var.add_module('org.vistrails.vistrails.basic:PythonSource')
+    for i, operand in enumerate(operands):
+        source.add_port('input', 'in%d' % i, Float_desc)
+        operand.connect_to(source, 'in%d' % i)
+    source.add_port('output', 'value', Float_desc)
+    # PythonSource is not cacheable by default; this one is a pure function
+    # of its inputs
+    code = 'value = %s\ncache_this()\n' % expression
+    source.add_function('source', String_desc, urllib.quote(code))
+    new_var.select_output_port(source, 'value')
+    return new_var
+
+
 builtin_operations = {
     '+': [float_op('+')],
     '-': [float_op('-')],
     '*': [float_op('*')],
     '/': [float_op('/')],
+    '_': [float_negation()],  # Unary minus
 }
+
+
+# VariableOperation -> Python format of the expression, for the operations
+# that evaluate_expression() can fuse together
+fusable_operations = dict(
+    [(builtin_operations[name][0], '(%s ' + name + ' %s)')
+     for name in '+-*/'] +
+    [(builtin_operations['_'][0], '(-%s)')])
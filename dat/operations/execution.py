@@ -1,10 +1,13 @@
+import operator
 import sys
 import warnings
+import weakref
 
 from dat import data_provenance
-from dat.global_data import GlobalManager
-from dat.operations import InvalidOperation, OperationWarning
+from dat.operations import InvalidOperation, OperationIndex, \
+    OperationWarning
 from dat.operations.parsing import SYMBOL, NUMBER, STRING, OP, parse_expression
+from dat.utils import LRUCache
 from dat.vistrail_data import VistrailManager
 from dat import vistrails_interface
 from dat.vistrails_interface import Variable, PipelineGenerator
@@ -14,7 +17,23 @@ from vistrails.core.modules.vistrails_module import Module
 
 
 class ComputeVariable(object):
-    def execute(self, controller):
+    def execute(self, controller, results=None):
+        """Builds the Variable for this node.
+
+        results maps the nodes already executed to their Variable; a node
+        shared by several operations is only built once, its pipeline then
+        being connected to each of them.
+        """
+        if results is None:
+            results = dict()
+        try:
+            return results[self]
+        except KeyError:
+            pass
+        result = results[self] = self._execute(controller, results)
+        return result
+
+    def _execute(self, controller, results):
         raise NotImplementedError
 
 
@@ -25,7 +44,7 @@ class GetExistingVariable(ComputeVariable):
             raise InvalidOperation("Unknown variable %r" % varname)
         self.type = self._variable.type
 
-    def execute(self, controller):
+    def _execute(self, controller, results):
         # Here we explicitely don't record that the Variable is already
         # materialized in the workflow, because we allow the user to copy
         # variables (i.e. enter an expression without any operation)
@@ -45,7 +64,7 @@ class BuildConstant(ComputeVariable):
                 'org.vistrails.vistrails.basic',
                 'Float')
 
-    def execute(self, controller):
+    def _execute(self, controller, results):
         generator = PipelineGenerator(controller)
         module = generator.controller.create_module_from_descriptor(self.type)
         generator.add_module(module)
@@ -64,34 +83,180 @@ class ApplyOperation(ComputeVariable):
         self.type = self._op.return_type
         self._args = args
 
-    def execute(self, controller):
+    def _execute(self, controller, results):
         """Recursively perform operations.
         """
-        args = [arg.execute(controller) for arg in self._args]
+        args = [arg.execute(controller, results) for arg in self._args]
         return apply_operation(controller, self._op, args)
 
 
-def resolve_symbols(vistraildata, expr):
+def _fusable(node):
+    from dat.operations.builtins import fusable_operations
+
+    return (isinstance(node, FusedOperations) or
+            (isinstance(node, ApplyOperation) and
+             node._op in fusable_operations))
+
+
+class FusedOperations(ComputeVariable):
+    """A tree of builtin arithmetic operations, computed by a single module.
+
+    The operands that are not builtin operations themselves become the inputs
+    of that module; constants are written in the expression.
+    """
+    def __init__(self, node):
+        self._node = node
+        self.type = node.type
+        self._operands = []
+        self.expression = self._build_expression(node)
+
+    def _build_expression(self, node):
+        from dat.operations.builtins import fusable_operations
+
+        if isinstance(node, FusedOperations):
+            node = node._node
+        if isinstance(node, BuildConstant):
+            return repr(node.value)
+        elif _fusable(node):
+            return fusable_operations[node._op] % tuple(
+                self._build_expression(arg) for arg in node._args)
+        else:
+            # The same node is passed only once
+            for i, operand in enumerate(self._operands):
+                if operand is node:
+                    break
+            else:
+                i = len(self._operands)
+                self._operands.append(node)
+            return 'in%d' % i
+
+    def _provenance(self, node, variables):
+        if isinstance(node, FusedOperations):
+            node = node._node
+        if isinstance(node, BuildConstant):
+            return data_provenance.Constant(constant=node.value)
+        elif _fusable(node):
+            # The same provenance as if the operations had been applied one
+            # by one
+            args = dict(
+                (param.name, self._provenance(arg, variables))
+                for param, arg in zip(node._op.parameters, node._args))
+            return data_provenance.Operation(_json=dict(
+                pkg_id=node._op.package_identifier,
+                name=node._op.name,
+                args=args))
+        else:
+            variable = variables[self._operands.index(node)]
+            if variable.materialized is None:
+                return variable.provenance
+            else:
+                return data_provenance.Variable(
+                    variable=variable.materialized)
+
+    def _execute(self, controller, results):
+        from dat.operations.builtins import evaluate_expression
+
+        variables = [operand.execute(controller, results)
+                     for operand in self._operands]
+        result = evaluate_expression(
+            self.expression,
+            [vistrails_interface.ArgumentWrapper(variable)
+             for variable in variables],
+            controller)
+        result.provenance = self._provenance(self._node, variables)
+        return result
+
+
+_constant_operators = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div,
+    '_': operator.neg,
+}
+
+
+def _fold_constants(name, values):
+    """Computes an operator on constants, returning a BuildConstant.
+
+    Returns None if the values don't support this operator, in which case an
+    operation has to be found for them (and probably won't).
+    """
+    try:
+        return BuildConstant(_constant_operators[name](*values))
+    except ZeroDivisionError:
+        raise InvalidOperation("Division by zero in constant expression")
+    except TypeError:
+        return None
+
+
+def _resolve_symbols(vistraildata, expr, resolved):
+    try:
+        return resolved[expr]
+    except KeyError:
+        pass
     if expr[0] == SYMBOL:
         # Get an existing variable
-        return GetExistingVariable(vistraildata, expr[1])
+        result = GetExistingVariable(vistraildata, expr[1])
     elif expr[0] == NUMBER or expr[0] == STRING:
         # Build a constant module
-        return BuildConstant(expr[1])
+        result = BuildConstant(expr[1])
     elif expr[0] == OP:
         # Find the right operation, comparing argument number and types
         name = expr[1]
-        args = [resolve_symbols(vistraildata, arg) for arg in expr[2:]]
-        if all(isinstance(arg, BuildConstant) for arg in args):
-            if name == '+':
-                return BuildConstant(args[0].value + args[1].value)
-            elif name == '-':
-                return BuildConstant(args[0].value - args[1].value)
-            elif name == '*':
-                return BuildConstant(args[0].value * args[1].value)
-            elif name == '/':
-                return BuildConstant(args[0].value / args[1].value)
-        return ApplyOperation(name, args)
+        args = [_resolve_symbols(vistraildata, arg, resolved)
+                for arg in expr[2:]]
+        result = None
+        if (name in _constant_operators and
+                all(isinstance(arg, BuildConstant) for arg in args)):
+            result = _fold_constants(name, [arg.value for arg in args])
+        if result is None:
+            result = ApplyOperation(name, args)
+            # Arithmetic on Floats gets computed by a single module
+            if _fusable(result) and any(_fusable(arg) for arg in args):
+                result = FusedOperations(result)
+    resolved[expr] = result
+    return result
+
+
+def resolve_symbols(vistraildata, expr):
+    """Builds the tree of ComputeVariable for an expression tree.
+
+    Identical subexpressions are only resolved once: the result is a DAG,
+    whose shared nodes also only get executed once.
+    """
+    return _resolve_symbols(vistraildata, expr, dict())
+
+
+# VistrailData -> expression tree ->
+#     (ComputeVariable, {varname: Variable})
+_resolved_expressions = weakref.WeakKeyDictionary()
+
+
+def _get_resolved_expression(vistraildata, expr):
+    """Resolves an expression tree, reusing the results of previous calls.
+
+    A cached tree is only used if the variables it references haven't been
+    replaced since; everything gets resolved again when operations are added
+    or removed.
+    """
+    cache = _resolved_expressions.get(vistraildata)
+    if cache is None:
+        cache = _resolved_expressions[vistraildata] = LRUCache(32)
+    entry = cache.get(expr)
+    if entry is not None:
+        op_tree, variables = entry
+        if all(vistraildata.get_variable(varname) is variable
+               for varname, variable in variables.iteritems()):
+            return op_tree
+
+    resolved = dict()
+    op_tree = _resolve_symbols(vistraildata, expr, resolved)
+    variables = dict((subexpr[1], node._variable)
+                     for subexpr, node in resolved.iteritems()
+                     if subexpr[0] == SYMBOL)
+    cache[expr] = op_tree, variables
+    return op_tree
 
 
 def perform_operation(expression, controller=None):
@@ -106,7 +271,7 @@ def perform_operation(expression, controller=None):
     vistraildata = VistrailManager(controller)
     if vistraildata.get_variable(target) is not None:
         raise InvalidOperation("Target variable %r already exists" % target)
-    op_tree = resolve_symbols(vistraildata, expr_tree)
+    op_tree = _get_resolved_expression(vistraildata, expr_tree)
 
     # Build the new variable
     variable = op_tree.execute(controller)
@@ -130,35 +295,61 @@ def _fill_parent_modules_map(mod, parents, level):
     return top_hit
 
 
+# Module subclass -> {Module subclass: int}
+_parent_modules = weakref.WeakKeyDictionary()
+
+
 def parent_modules(mod):
     """Get the parent Modules of a Module subclass.
 
     Returns a dict mapping each Module subclass to an int, that goes up from 0
     (for the given 'mod') to the class that directly inherits Module.
+
+    The result is computed once per class; it is shared and must not be
+    modified.
     """
+    try:
+        return _parent_modules[mod]
+    except KeyError:
+        pass
     parents = dict()
     _fill_parent_modules_map(mod, parents, 0)
+    _parent_modules[mod] = parents
     return parents
 
 
-def find_operation(name, args):
-    """Choose the operation with the given name that accepts these arguments.
-    """
+def _operation_keys(operation):
+    if operation.usable_in_command:
+        return [operation.name, (operation.name, len(operation.parameters))]
+    else:
+        return []
+
+
+def _builtin_operations():
     from dat.operations.builtins import builtin_operations
 
-    # Initial list of considered operations: correct name
-    operations = set([
-        op
-        for op in GlobalManager.variable_operations
-        if op.name == name and op.usable_in_command])
-    operations.update(builtin_operations.get(name, []))
-    if not operations:
-        raise InvalidOperation("There is no operation %r" % name)
-    operations = set([
-        op
-        for op in operations
-        if len(op.parameters) == len(args)])
+    for operations in builtin_operations.itervalues():
+        for operation in operations:
+            yield operation
+
+
+# The operations usable in expressions, by name and by
+# (name, number of parameters)
+_operations_index = OperationIndex(_operation_keys, _builtin_operations)
+# (name, (Module subclass, ...)) -> (VariableOperation, ambiguous: bool) or
+# error message
+_resolved_operations = dict()
+_operations_index.on_change(_resolved_operations.clear)
+_operations_index.on_change(_resolved_expressions.clear)
+
+
+def _resolve_operation(name, args):
+    # Initial list of considered operations: correct name and number of
+    # arguments
+    operations = _operations_index.get((name, len(args)))
     if not operations:
+        if not _operations_index.get(name):
+            raise InvalidOperation("There is no operation %r" % name)
         raise InvalidOperation("There is no operation %r with %d arguments" % (
                                name, len(args)))
 
@@ -167,7 +358,7 @@ def find_operation(name, args):
         retained_operations = set()
         current_score = sys.maxint
         # All base classes
-        bases = parent_modules(actual.module)
+        bases = parent_modules(actual)
         for op in operations:
             for desc in op.parameters[i].types:
                 expected = desc.module
@@ -195,12 +386,34 @@ def find_operation(name, args):
     if len(operations) == 0:
         raise InvalidOperation("Found no match for operation %r with given "
                                "%d args" % (name, len(args)))
-    if len(operations) > 1:
+    return next(iter(operations)), len(operations) > 1
+
+
+def find_operation(name, args):
+    """Choose the operation with the given name that accepts these arguments.
+
+    Resolutions are cached by name and argument types, until operations are
+    added or removed.
+    """
+    key = name, tuple(desc.module for desc in args)
+    try:
+        result = _resolved_operations[key]
+    except KeyError:
+        try:
+            result = _resolve_operation(name, key[1])
+        except InvalidOperation, e:
+            result = e.args[0]
+        _resolved_operations[key] = result
+
+    if isinstance(result, basestring):
+        raise InvalidOperation(result)
+    operation, ambiguous = result
+    if ambiguous:
         warnings.warn(
             "Found several operations %r matching the given %d args" % (
                 name, len(args)),
             category=OperationWarning)
-    return next(iter(operations))
+    return operation
 
 
 def apply_operation(controller, op, args):
@@ -2,7 +2,7 @@ import re
 from tdparser import Lexer, Token, LexerError, Error
 
 from dat import variable_format
-from dat.utils import iswhitespace
+from dat.utils import LRUCache, iswhitespace
 
 from dat.operations import InvalidOperation
 
@@ -141,7 +141,27 @@ lexer.register_tokens(
 _variable_format = re.compile('^' + variable_format + '$')
 
 
+# Expression text -> (target, expression tree)
+_parsed_expressions = LRUCache(64)
+
+
 def parse_expression(expression):
+    """Parses an assignment expression, 'target = expression'.
+
+    Returns the target variable name and the expression tree. The trees are
+    made of tuples, so the results of the last calls are kept and returned
+    again when the same line is entered.
+    """
+    try:
+        return _parsed_expressions[expression]
+    except KeyError:
+        pass
+    result = _parse_expression(expression)
+    _parsed_expressions[expression] = result
+    return result
+
+
+def _parse_expression(expression):
     equal = expression.find('=')
     if equal == -1:
         raise InvalidOperation("Missing target variable name",
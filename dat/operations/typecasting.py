@@ -1,4 +1,81 @@
-from dat.global_data import GlobalManager
+from dat.operations import OperationIndex
+
+
+class TypecastPath(tuple):
+    """A sequence of single-argument operations converting a type to another.
+
+    Each operation is applied to the result of the previous one.
+    """
+    @property
+    def name(self):
+        return ' -> '.join(operation.name for operation in self)
+
+
+def _typecast_keys(operation):
+    # TODO : propose wizards here?
+    if operation.usable_in_command and len(operation.parameters) == 1:
+        return [desc.module for desc in operation.parameters[0].types]
+    else:
+        return []
+
+
+# The typecast operations, by the Module subclass they take as their parameter
+_typecasts_index = OperationIndex(_typecast_keys)
+# (source Module subclass, expected Module subclass, max_length) ->
+# [TypecastPath]
+_typecast_paths = dict()
+_typecasts_index.on_change(_typecast_paths.clear)
+
+
+def _typecasts_from(module):
+    """Returns the typecast operations accepting a module type.
+
+    These take the module or one of its superclasses as their parameter.
+    """
+    operations = set()
+    for cls in module.__mro__:
+        operations.update(_typecasts_index.get(cls))
+    return operations
+
+
+def get_typecast_paths(source_descriptor, expected_descriptor, max_length=2):
+    """Finds the ways to typecast from a module type to another.
+
+    Returns a list of TypecastPath, each made of at most max_length
+    operations, the first one taking the source_descriptor (or a superclass)
+    as a parameter and the last one returning the expected_descriptor (or a
+    subclass). Shorter paths come first.
+
+    Results are cached until operations are added or removed. Might return an
+    empty list.
+    """
+    source = source_descriptor.module
+    expected = expected_descriptor.module
+    key = source, expected, max_length
+    try:
+        return list(_typecast_paths[key])
+    except KeyError:
+        pass
+
+    paths = []
+    # [(type, path to get there)]
+    frontier = [(source, ())]
+    for length in xrange(max_length):
+        next_frontier = []
+        for module, path in frontier:
+            visited = set([source])
+            visited.update(op.return_type.module for op in path)
+            for operation in _typecasts_from(module):
+                result = operation.return_type.module
+                if issubclass(result, expected):
+                    paths.append(TypecastPath(path + (operation,)))
+                elif result not in visited:
+                    next_frontier.append((result, path + (operation,)))
+        frontier = next_frontier
+    paths.sort(key=lambda p: (len(p), p.name))
+
+    _typecast_paths[key] = paths
+    return list(paths)
 
 
 def get_typecast_operations(source_descriptor, expected_descriptor):
@@ -11,23 +88,7 @@ def get_typecast_operations(source_descriptor, expected_descriptor):
 
     Might return an empty list.
     """
-    valid = []
-
-    for operation in GlobalManager.variable_operations:
-        if not operation.usable_in_command:
-            continue
-        # TODO : propose wizards here?
-        if len(operation.parameters) != 1:
-            continue
-
-        if not any(issubclass(source_descriptor.module, desc.module)
-                   for desc in operation.parameters[0].types):
-            continue
-
-        if not issubclass(operation.return_type.module,
-                          expected_descriptor.module):
-            continue
-
-        valid.append(operation)
-
-    return valid
+    return [path[0]
+            for path in get_typecast_paths(source_descriptor,
+                                           expected_descriptor,
+                                           max_length=1)]
@@ -43,6 +43,7 @@ from dat.gui import translate
 from dat.gui.operation_wizard import OperationWizard
 from dat.vistrails_interface import CustomVariableLoader, FileVariableLoader, \
     get_variable_value
+from dat.vistrails_interface.utils import invalidate_variable_values
 from dat.vistrails_interface.wrappers import Variable, DataPort, \
     ConstantPort, Plot, VariableOperation, OperationArgument
 
@@ -84,4 +85,5 @@ def derive_varname(param, remove_ext=False, remove_path=False, default=None,
 __all__ = ['Plot', 'DataPort', 'ConstantPort', 'Variable',
            'CustomVariableLoader', 'FileVariableLoader',
            'VariableOperation', 'OperationArgument', 'OperationWizard',
-           'translate', 'derive_varname', 'get_variable_value']
+           'translate', 'derive_varname', 'get_variable_value',
+           'invalidate_variable_values']
@@ -111,6 +111,23 @@ overload_custom_4 = VariableOperation(
     return_type=Module)
 
 
+cast_a_to_e = VariableOperation(
+    'cast_a_to_e',
+    callback=nop,
+    args=[
+        OperationArgument('op', ModA),
+    ],
+    return_type=ModE)
+
+cast_e_to_d = VariableOperation(
+    'cast_e_to_d',
+    callback=nop,
+    args=[
+        OperationArgument('op', ModE),
+    ],
+    return_type=ModD)
+
+
 _modules = [ModA, ModB, ModC, ModD, ModE]
 
 
@@ -124,4 +141,7 @@ _variable_operations = [
     overload_custom_2,
     overload_custom_3,
     overload_custom_4,
+
+    cast_a_to_e,
+    cast_e_to_d,
 ]
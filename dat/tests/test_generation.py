@@ -4,17 +4,22 @@
 
 
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from dat import DATRecipe, RecipeParameterValue
+from dat import DATRecipe, PipelineInformation, RecipeParameterValue
 import dat.tests
 from dat.tests import CallRecorder, FakeObj
 from dat.vistrail_data import VistrailManager
 from dat import vistrails_interface
 from dat.vistrails_interface import get_upgraded_pipeline, Variable
+from dat.vistrails_interface.pipelines import relayout_pipeline
 
 from vistrails.core import get_vistrails_application
 from vistrails.core.db.locator import XMLFileLocator
+from vistrails.core.interpreter.cached import CachedInterpreter
 from vistrails.core.interpreter.default import get_default_interpreter
 import vistrails.core.modules.basic_modules as basic
 from vistrails.core.modules.module_registry import MissingPackage
@@ -97,6 +102,350 @@ class Test_generation(unittest.TestCase):
             vistrails_interface.get_function(output_port, 'spec'),
             'org.vistrails.vistrails.basic:Float')
 
+    def test_lazy_loading(self):
+        from dat.vistrail_data import VistrailData
+
+        controller = self.vt_controller()
+        loader = Test_generation._loaders.get('MyVariableLoader')
+        VistrailManager(controller).new_variable('lazyvar', loader.load())
+
+        vistraildata = VistrailData(controller, lazy=True)
+        self.assertEqual(list(vistraildata.variables), ['lazyvar'])
+        self.assertEqual(vistraildata.load_stats['pending_variables'], 1)
+        self.assertEqual(vistraildata.load_stats['variables'], 0)
+
+        # Resolved on first access
+        variable = vistraildata.get_variable('lazyvar')
+        self.assertIsNotNone(variable)
+        self.assertEqual(variable.type.module, basic.Float)
+        self.assertIs(vistraildata.get_variable('lazyvar'), variable)
+        self.assertEqual(list(vistraildata.variables), ['lazyvar'])
+
+    def test_lazy_recipes(self):
+        """Tests that recipes don't resolve the variables they use.
+        """
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.vistrail_data import VistrailData
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+
+        loader.v = 'Hello'
+        vistraildata.new_variable('var1', loader.load())
+        loader.v = 'world'
+        vistraildata.new_variable('var2', loader.load())
+
+        recipe = DATRecipe(
+            pkg_test_plots.concat_plot,
+            {
+                'param1': (
+                    RecipeParameterValue(
+                        variable=vistraildata.get_variable('var1')),
+                ),
+                'param2': (
+                    RecipeParameterValue(
+                        variable=vistraildata.get_variable('var2')),
+                ),
+            })
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller, recipe, 0, 0, None)
+        vistraildata.created_pipeline(FakeObj(), pipelineInfo)
+
+        lazydata = VistrailData(controller, lazy=True)
+        self.assertEqual(lazydata.load_stats['pipelines'], 1)
+        self.assertEqual(lazydata.load_stats['variables'], 0)
+        read_recipe = lazydata.get_pipeline(pipelineInfo.version).recipe
+        self.assertEqual(lazydata.load_stats['pending_variables'], 2)
+        self.assertEqual(sorted(lazydata._pending_variables),
+                         ['var1', 'var2'])
+
+        # The variables are resolved when they are used
+        param1, = read_recipe.parameters['param1']
+        self.assertEqual(param1.variable_name, 'var1')
+        self.assertEqual(sorted(lazydata._pending_variables),
+                         ['var1', 'var2'])
+        variable = param1.variable
+        self.assertEqual(sorted(lazydata._pending_variables), ['var2'])
+        self.assertIs(variable, lazydata.get_variable('var1'))
+
+        # Renaming a variable doesn't break the recipes referring to it
+        lazydata.rename_variable('var2', 'renamed')
+        param2, = read_recipe.parameters['param2']
+        self.assertIs(param2.variable, lazydata.get_variable('renamed'))
+
+        # A variable that fails to load stays deferred
+        lazydata = VistrailData(controller, lazy=True)
+        read_recipe = lazydata.get_pipeline(pipelineInfo.version).recipe
+        load_variable = lazydata._load_variable
+
+        def failing_load(varname, version):
+            raise IOError
+        lazydata._load_variable = failing_load
+        self.assertRaises(IOError, lazydata.get_variable, 'var1')
+        self.assertEqual(sorted(lazydata._pending_variables),
+                         ['renamed', 'var1'])
+        lazydata._load_variable = load_variable
+        self.assertIsNotNone(lazydata.get_variable('var1'))
+
+        # A recipe using an invalid variable raises a clear error
+        lazydata._load_variable = lambda varname, version: None
+        param2, = read_recipe.parameters['param2']
+        self.assertRaises(ValueError, lambda: param2.variable)
+        self.assertIsNone(lazydata.get_pipeline(pipelineInfo.version))
+
+    def test_variable_value_cache(self):
+        from dat.vistrails_interface import get_variable_value
+        from dat.vistrails_interface.utils import invalidate_variable_values
+
+        invalidate_variable_values()
+        controller = self.vt_controller()
+        loader = Test_generation._loaders.get('MyVariableLoader')
+        variable = loader.load()
+
+        get_interpreter = CallRecorder(get_default_interpreter)
+        old_get_interpreter = vistrails_interface.get_default_interpreter
+        vistrails_interface.get_default_interpreter = get_interpreter
+        try:
+            value = get_variable_value(variable)
+            self.assertEqual(len(get_interpreter.calls), 1)
+            self.assertEqual(get_variable_value(variable), value)
+            # Same pipeline built from another Variable object
+            self.assertEqual(get_variable_value(loader.load()), value)
+            self.assertEqual(len(get_interpreter.calls), 1)
+
+            vistraildata = VistrailManager(controller)
+            vistraildata.new_variable('cachedvar', variable)
+            variableinfo = vistraildata.get_variable('cachedvar')
+            self.assertEqual(get_variable_value(variableinfo), value)
+            self.assertEqual(get_variable_value(variableinfo), value)
+            self.assertEqual(len(get_interpreter.calls), 2)
+
+            invalidate_variable_values(controller.vistrail)
+            self.assertEqual(get_variable_value(variableinfo), value)
+            self.assertEqual(len(get_interpreter.calls), 3)
+        finally:
+            vistrails_interface.get_default_interpreter = old_get_interpreter
+
+    def test_variable_value_disk_cache(self):
+        from dat.vistrails_interface import get_variable_value
+        from dat.vistrails_interface.utils import \
+            invalidate_variable_values, set_disk_cache_directory
+
+        invalidate_variable_values()
+        loader = Test_generation._loaders.get('MyVariableLoader')
+        directory = tempfile.mkdtemp(prefix='dat_test_')
+        set_disk_cache_directory(directory)
+
+        get_interpreter = CallRecorder(get_default_interpreter)
+        old_get_interpreter = vistrails_interface.get_default_interpreter
+        vistrails_interface.get_default_interpreter = get_interpreter
+        try:
+            value = get_variable_value(loader.load())
+            self.assertEqual(len(get_interpreter.calls), 1)
+
+            # Dropped from memory, as in a new session
+            invalidate_variable_values()
+            self.assertEqual(get_variable_value(loader.load()), value)
+            self.assertEqual(len(get_interpreter.calls), 1)
+
+            # Disabled
+            set_disk_cache_directory(None)
+            invalidate_variable_values()
+            self.assertEqual(get_variable_value(loader.load()), value)
+            self.assertEqual(len(get_interpreter.calls), 2)
+        finally:
+            vistrails_interface.get_default_interpreter = old_get_interpreter
+            set_disk_cache_directory(None)
+            invalidate_variable_values()
+            shutil.rmtree(directory)
+
+    def test_cell_disk_cache(self):
+        """Tests that plot pipelines read their variables from the cache.
+        """
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.vistrails_interface.utils import get_function, \
+            invalidate_variable_values, set_disk_cache_directory
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+        loader.v = 'Hello'
+        vistraildata.new_variable('var1', loader.load())
+
+        def param(name):
+            return (RecipeParameterValue(
+                variable=vistraildata.get_variable(name)),)
+
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': param('var1'),
+                       'param2': param('var1'),
+                       'param3': (RecipeParameterValue(constant="!"),)}),
+            0, 0,
+            None)
+        pipeline = get_upgraded_pipeline(controller.vistrail,
+                                         pipelineInfo.version)
+
+        # Disabled
+        self.assertIs(
+            vistrails_interface.use_cached_values(controller, pipelineInfo,
+                                                  pipeline),
+            pipeline)
+
+        directory = tempfile.mkdtemp(prefix='dat_test_')
+        set_disk_cache_directory(directory)
+        get_interpreter = CallRecorder(get_default_interpreter)
+        old_get_interpreter = vistrails_interface.get_default_interpreter
+        vistrails_interface.get_default_interpreter = get_interpreter
+        try:
+            # The value is not computed here
+            self.assertIs(
+                vistrails_interface.use_cached_values(controller,
+                                                      pipelineInfo,
+                                                      pipeline),
+                pipeline)
+            self.assertEqual(get_interpreter.calls, [])
+
+            vistrails_interface.get_variable_value(
+                vistraildata.get_variable('var1'))
+            self.assertEqual(len(get_interpreter.calls), 1)
+            cached = vistrails_interface.use_cached_values(
+                controller, pipelineInfo, pipeline)
+            self.assertIsNot(cached, pipeline)
+            # The String module of var1 was replaced
+            self.assertEqual(
+                [m.name for m in pipeline.module_list
+                 if get_function(m, 'value') == 'Hello'],
+                ['String'])
+            self.assertFalse(any(get_function(m, 'value') == 'Hello'
+                                 for m in cached.module_list))
+            # The module reading the value has the String module's id, and
+            # is connected to both parameters
+            self.assertEqual(sorted(cached.modules),
+                             sorted(pipeline.modules))
+            self.assertEqual(sorted(cached.connections),
+                             sorted(pipeline.connections))
+            # The shared pipeline is not modified
+            self.assertIs(get_upgraded_pipeline(controller.vistrail,
+                                                pipelineInfo.version),
+                          pipeline)
+
+            # In a new session, the value is read from disk
+            invalidate_variable_values()
+            result = CallRecorder()
+            pkg_test_plots.Recorder.callback = result
+            results = vistrails_interface.execute_pipelines(
+                controller, [pipelineInfo], reason="DAT cache test")
+            self.assertEqual([error for p, error, seconds in results],
+                             [None])
+            self.assertEqual(result.calls, [(['Hello, Hello!'], dict())])
+            self.assertEqual(len(get_interpreter.calls), 1)
+        finally:
+            vistrails_interface.get_default_interpreter = old_get_interpreter
+            set_disk_cache_directory(None)
+            invalidate_variable_values()
+            shutil.rmtree(directory)
+
+    def test_cell_execution_disk_cache(self):
+        """Tests that executing a plot pipeline fills the cache.
+        """
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.vistrails_interface.utils import \
+            get_variable_values_disk_cache, invalidate_variable_values, \
+            set_disk_cache_directory
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+        loader.v = 'Stored'
+        vistraildata.new_variable('var1', loader.load())
+        variable = vistraildata.get_variable('var1')
+
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': (RecipeParameterValue(variable=variable),),
+                       'param2': (RecipeParameterValue(variable=variable),),
+                       'param3': (RecipeParameterValue(constant="!"),)}),
+            0, 0,
+            None)
+        pipeline = get_upgraded_pipeline(controller.vistrail,
+                                         pipelineInfo.version)
+
+        directory = tempfile.mkdtemp(prefix='dat_test_')
+        set_disk_cache_directory(directory)
+        get_interpreter = CallRecorder(get_default_interpreter)
+        old_get_interpreter = vistrails_interface.get_default_interpreter
+        vistrails_interface.get_default_interpreter = get_interpreter
+        try:
+            disk_key = vistrails_interface._variable_value_disk_key(variable)
+            self.assertNotIn(disk_key, get_variable_values_disk_cache())
+
+            result = CallRecorder()
+            pkg_test_plots.Recorder.callback = result
+            results = vistrails_interface.execute_pipelines(
+                controller, [pipelineInfo], reason="DAT cache test")
+            self.assertEqual([error for p, error, seconds in results],
+                             [None])
+            self.assertEqual(result.calls, [(['Stored, Stored!'], dict())])
+
+            # The execution stored the value of the variable
+            self.assertIn(disk_key, get_variable_values_disk_cache())
+            self.assertIsNot(
+                vistrails_interface.use_cached_values(controller,
+                                                      pipelineInfo,
+                                                      pipeline),
+                pipeline)
+            invalidate_variable_values()
+            self.assertEqual(vistrails_interface.get_variable_value(variable),
+                             'Stored')
+            self.assertEqual(get_interpreter.calls, [])
+        finally:
+            vistrails_interface.get_default_interpreter = old_get_interpreter
+            set_disk_cache_directory(None)
+            invalidate_variable_values()
+            shutil.rmtree(directory)
+
+    def test_plot_pipeline_cache(self):
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+
+        plot = pkg_test_plots.concat_plot
+        pipeline = plot.get_pipeline()
+        self.assertIs(plot.get_pipeline(), pipeline)
+
+        plot._invalidate_pipeline()
+        pipeline2 = plot.get_pipeline()
+        self.assertIsNot(pipeline2, pipeline)
+        self.assertEqual(len(pipeline2.module_list),
+                         len(pipeline.module_list))
+
+    def test_operation_template(self):
+        from dat.vistrails_interface import get_operation_template
+
+        subworkflow = os.path.join(os.path.dirname(__file__),
+                                   'pkg_test_plots', 'concat.xml')
+        op = FakeObj(name='concat')
+        template = get_operation_template(op, subworkflow)
+        self.assertIs(get_operation_template(op, subworkflow), template)
+
+        # ConcatenateString, Recorder and the String default value
+        self.assertEqual(len(template.modules), 3)
+        self.assertEqual(set(template.parameters.iterkeys()),
+                         set(['param1', 'param2', 'param3']))
+        self.assertIsNone(template.output)
+
+        controller = self.vt_controller()
+        controller.change_selected_version(0)
+        generator = vistrails_interface.PipelineGenerator(controller)
+        params, output = template.instantiate(generator)
+        new_ids = set(m.id for m in generator.all_modules)
+        self.assertEqual(len(new_ids), 3)
+        for ports in params.itervalues():
+            for module, port in ports:
+                self.assertIn(module.id, new_ids)
+
     def test_pipeline_creation(self):
         import dat.tests.pkg_test_plots.init as pkg_test_plots
 
@@ -156,6 +505,271 @@ class Test_generation(unittest.TestCase):
         call = (['Hello, world!'], dict())
         self.assertEqual(result.calls, [call])
 
+        # Laying out the whole pipeline again on demand
+        pipeline = controller.current_pipeline
+        relaidout = relayout_pipeline(controller, pipelineInfo)
+        self.assertNotEqual(relaidout.version, pipelineInfo.version)
+        self.assertIs(relaidout.recipe, pipelineInfo.recipe)
+        self.assertEqual(relaidout.conn_map, pipelineInfo.conn_map)
+        controller.change_selected_version(relaidout.version)
+        self.assertEqual(sorted(controller.current_pipeline.modules),
+                         sorted(pipeline.modules))
+        controller.change_selected_version(pipelineInfo.version)
+
+        # Batch execution, without the GUI
+        incomplete = PipelineInformation(
+            pipelineInfo.version,
+            DATRecipe(pkg_test_plots.concat_plot, {}),
+            {}, {})
+        results = vistrails_interface.execute_pipelines(
+            controller,
+            [pipelineInfo, incomplete],
+            reason="DAT batch test")
+        self.assertEqual(
+            [(p, error) for p, error, seconds in results],
+            [(pipelineInfo, None),
+             (incomplete, vistrails_interface.MISSING_PARAMS)])
+
+    def test_cancelled_execution(self):
+        """Tests that a cancelled execution doesn't break the next one.
+        """
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.gui.execution import _ExecutionJob
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+        loader.v = 'Hello'
+        vistraildata.new_variable('var1', loader.load())
+
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': (RecipeParameterValue(
+                          variable=vistraildata.get_variable('var1')),),
+                       'param2': (RecipeParameterValue(constant="you"),),
+                       'param3': (RecipeParameterValue(constant="!"),)}),
+            0, 0,
+            None)
+
+        interpreter = CachedInterpreter()
+
+        def execute(cancel):
+            result = CallRecorder()
+            pkg_test_plots.Recorder.callback = result
+            job = _ExecutionJob(None, controller, [pipelineInfo], None)
+            job.prepare()
+            job.copy()
+            if cancel:
+                # Cancelled while the first module executes
+                module_executed = job.module_executed
+
+                def cancelling_hook(objId):
+                    job.cancelled = True
+                    module_executed(objId)
+                job.module_executed = cancelling_hook
+            return job.run(interpreter), result.calls
+
+        # Cancelled: stops after the first module, without raising
+        self.assertEqual(execute(True), ([None], []))
+
+        # The interpreter was cleaned up, the next execution works
+        self.assertEqual(execute(False),
+                         ([None], [(['Hello, you!'], dict())]))
+
+    def test_execution_scheduler(self):
+        """Tests the coalescing and batching of the ExecutionScheduler.
+        """
+        from PyQt4 import QtCore
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.gui.execution import ExecutionScheduler
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+        for name, value in [('var1', 'Hello'), ('first', 'first'),
+                            ('second', 'second')]:
+            loader.v = value
+            vistraildata.new_variable(name, loader.load())
+
+        def create(varname):
+            recipe = DATRecipe(
+                pkg_test_plots.concat_plot,
+                {
+                    'param1': (
+                        RecipeParameterValue(
+                            variable=vistraildata.get_variable('var1')),
+                    ),
+                    'param2': (
+                        RecipeParameterValue(
+                            variable=vistraildata.get_variable(varname)),
+                    ),
+                })
+            return vistrails_interface.create_pipeline(
+                controller, recipe, 0, 0, None)
+        first, second = create('first'), create('second')
+        incomplete = PipelineInformation(
+            first.version,
+            DATRecipe(pkg_test_plots.concat_plot, {}),
+            {}, {})
+
+        result = CallRecorder()
+        pkg_test_plots.Recorder.callback = result
+        done = []
+        scheduler = ExecutionScheduler()
+        scheduler.execute(controller, first,
+                          lambda error: done.append(('first', error)),
+                          key='cell')
+        # Replaces the request that didn't start yet
+        scheduler.execute(controller, second,
+                          lambda error: done.append(('second', error)),
+                          key='cell')
+        scheduler.execute_list(controller, [first, incomplete],
+                               lambda errors: done.append(('list', errors)))
+        self.assertEqual(done, [])
+
+        deadline = time.time() + 30
+        while len(done) < 2 and time.time() < deadline:
+            QtCore.QCoreApplication.processEvents()
+        scheduler.stop()
+        self.assertEqual(
+            done,
+            [('second', None),
+             ('list', [None, vistrails_interface.MISSING_PARAMS])])
+        self.assertEqual(result.calls,
+                         [(['Hello, second!'], dict()),
+                          (['Hello, first!'], dict())])
+
+    def test_execution_scheduler_cancel(self):
+        """Tests cancelling the execution that is running.
+        """
+        from PyQt4 import QtCore
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.gui.execution import ExecutionScheduler, _ExecutionJob
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+        loader.v = 'Hello'
+        vistraildata.new_variable('var1', loader.load())
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': (RecipeParameterValue(
+                          variable=vistraildata.get_variable('var1')),),
+                       'param2': (RecipeParameterValue(constant="you"),),
+                       'param3': (RecipeParameterValue(constant="!"),)}),
+            0, 0,
+            None)
+
+        # The cell gets cleared while the first module executes; this is
+        # processed by the event loop between modules
+        started = []
+        module_executed = _ExecutionJob.module_executed.im_func
+
+        def cancelling_hook(job, objId):
+            if not started:
+                started.append(objId)
+                QtCore.QTimer.singleShot(0,
+                                         lambda: scheduler.cancel('cell'))
+            module_executed(job, objId)
+
+        def wait_for(condition):
+            deadline = time.time() + 30
+            while not condition() and time.time() < deadline:
+                QtCore.QCoreApplication.processEvents()
+
+        result = CallRecorder()
+        pkg_test_plots.Recorder.callback = result
+        done = []
+        scheduler = ExecutionScheduler()
+        _ExecutionJob.module_executed = cancelling_hook
+        try:
+            scheduler.execute(controller, pipelineInfo, done.append,
+                              key='cell')
+            wait_for(lambda: started and scheduler._running is None)
+        finally:
+            _ExecutionJob.module_executed = module_executed
+        self.assertTrue(started)
+        self.assertEqual(done, [])
+        self.assertEqual(result.calls, [])
+
+        # The next execution for that cell works
+        scheduler.execute(controller, pipelineInfo, done.append, key='cell')
+        wait_for(lambda: done)
+        scheduler.stop()
+        self.assertEqual(done, [None])
+        self.assertEqual(result.calls, [(['Hello, you!'], dict())])
+
+    def test_shared_variable_subworkflow(self):
+        import dat.tests.pkg_test_plots.init as pkg_test_plots
+        from dat.vistrails_interface.utils import get_function
+
+        controller = self.vt_controller()
+        vistraildata = VistrailManager(controller)
+        loader = Test_generation._loaders.get('StrMaker')
+
+        loader.v = 'Hello'
+        vistraildata.new_variable('var1', loader.load())
+
+        loader.v = 'world'
+        vistraildata.new_variable('var2', loader.load())
+
+        def param(name):
+            return (RecipeParameterValue(
+                variable=vistraildata.get_variable(name)),)
+
+        def run(pipelineInfo):
+            controller.change_selected_version(pipelineInfo.version)
+            strings = [get_function(m, 'value')
+                       for m in controller.current_pipeline.module_list
+                       if get_function(m, 'value') in ('Hello', 'world')]
+            result = CallRecorder()
+            pkg_test_plots.Recorder.callback = result
+            get_default_interpreter().execute(
+                controller.current_pipeline,
+                view=DummyView(),
+                locator=controller.locator,
+                current_version=pipelineInfo.version)
+            return sorted(strings), result.calls
+
+        constant = (RecipeParameterValue(constant="!"),)
+
+        # The subworkflow of var1 is only added once
+        pipelineInfo = vistrails_interface.create_pipeline(
+            controller,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': param('var1'),
+                       'param2': param('var1'),
+                       'param3': constant}),
+            0, 0,
+            None)
+        self.assertEqual(run(pipelineInfo),
+                         (['Hello'], [(['Hello, Hello!'], dict())]))
+
+        # It stays as long as a parameter uses it
+        pipelineInfo = vistrails_interface.update_pipeline(
+            controller,
+            pipelineInfo,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': param('var1'),
+                       'param2': param('var2'),
+                       'param3': constant}))
+        self.assertEqual(run(pipelineInfo),
+                         (['Hello', 'world'],
+                          [(['Hello, world!'], dict())]))
+
+        # Adding var2 again reuses the subworkflow in the pipeline
+        pipelineInfo = vistrails_interface.update_pipeline(
+            controller,
+            pipelineInfo,
+            DATRecipe(pkg_test_plots.concat_plot,
+                      {'param1': param('var2'),
+                       'param2': param('var2'),
+                       'param3': constant}))
+        self.assertEqual(run(pipelineInfo),
+                         (['world'], [(['world, world!'], dict())]))
+
 
 class Test_variable_creation(unittest.TestCase):
     def test_var_type(self):
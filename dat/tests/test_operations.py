@@ -6,10 +6,14 @@
 import re
 import unittest
 
-from dat.operations.execution import parent_modules, find_operation
+from dat.operations.execution import parent_modules, find_operation, \
+    resolve_symbols, FusedOperations
 from dat.operations.parsing import InvalidOperation, parse_expression, \
     SYMBOL, NUMBER, STRING, OP, String
+from dat.operations.typecasting import get_typecast_operations, \
+    get_typecast_paths
 import dat.tests
+from dat.tests import FakeObj
 
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.packagemanager import get_package_manager
@@ -44,6 +48,8 @@ class Test_operation_parsing(unittest.TestCase):
             ))
 
         self.assertEqual(parse_expression('a = 3 + 3')[0], 'a')
+        self.assertIs(parse_expression('a = 3 + 3'),
+                      parse_expression('a = 3 + 3'))
 
         self.assertEqual(
             parse_expression('b = 4 *cd(2+ 5, "test\\"\\\\") + (1-4)/7'),
@@ -138,6 +144,7 @@ class Test_operations(unittest.TestCase):
         self.assertEqual(
             parent_modules(pkg.ModC),
             {pkg.ModC: 0, pkg.ModB: 1, pkg.ModA: 2})
+        self.assertIs(parent_modules(pkg.ModC), parent_modules(pkg.ModC))
 
     def test_operation_resolution(self):
         import dat.tests.pkg_test_operations.init as pkg
@@ -180,3 +187,150 @@ class Test_operations(unittest.TestCase):
                 'overload_custom',
                 [gd(pkg.ModD), gd(pkg.ModD)]),
             pkg.overload_custom_1)
+
+    def test_operation_index(self):
+        import dat.tests.pkg_test_operations.init as pkg
+
+        from vistrails.core.modules.basic_modules import Integer, String
+
+        reg = get_module_registry()
+        gd = reg.get_descriptor
+
+        args = [gd(String), gd(Integer)]
+        self.assertIs(find_operation('overload_std', args),
+                      pkg.overload_std_3)
+        self.assertIs(find_operation('overload_std', args),
+                      pkg.overload_std_3)
+
+        # The index follows the operations going away with their package
+        pm = get_package_manager()
+        pm.late_disable_package('pkg_test_operations')
+        try:
+            with self.assertRaises(InvalidOperation) as cm:
+                find_operation('overload_std', args)
+            self.assertIn("There is no ", cm.exception.message)
+        finally:
+            pm.late_enable_package(
+                'pkg_test_operations',
+                {'pkg_test_operations': 'dat.tests.'})
+        self.assertEqual(find_operation('overload_std', args).name,
+                         'overload_std')
+
+    def test_operation_index_helper(self):
+        from dat.operations import OperationIndex
+
+        changes = []
+        index = OperationIndex(lambda op: [op.name, op.name[0]])
+        index.on_change(lambda: changes.append(True))
+        self.assertEqual(index.get('zzz'), set())
+
+        op = FakeObj(name='zzz')
+        index._operation_added(op)
+        self.assertEqual(index.get('zzz'), set([op]))
+        self.assertEqual(index.get('z'), set([op]))
+        self.assertEqual(len(changes), 1)
+        index._operation_removed(op)
+        self.assertEqual(index.get('zzz'), set())
+        self.assertEqual(index.get('z'), set())
+        self.assertEqual(len(changes), 2)
+
+    def test_typecasts(self):
+        import dat.tests.pkg_test_operations.init as pkg
+
+        reg = get_module_registry()
+        gd = reg.get_descriptor
+
+        # Parameter and return types match subclasses
+        self.assertEqual(
+            get_typecast_operations(gd(pkg.ModC), gd(pkg.ModE)),
+            [pkg.cast_a_to_e])
+        self.assertEqual(
+            get_typecast_operations(gd(pkg.ModE), gd(pkg.ModA)),
+            [pkg.cast_e_to_d])
+        self.assertEqual(
+            get_typecast_operations(gd(pkg.ModB), gd(pkg.ModD)),
+            [])
+
+        # Chained typecasts
+        paths = get_typecast_paths(gd(pkg.ModB), gd(pkg.ModD))
+        self.assertEqual(paths, [(pkg.cast_a_to_e, pkg.cast_e_to_d)])
+        self.assertEqual(paths[0].name, 'cast_a_to_e -> cast_e_to_d')
+        self.assertEqual(
+            get_typecast_paths(gd(pkg.ModB), gd(pkg.ModD), max_length=1),
+            [])
+
+    def test_typecast_dropping(self):
+        """Ports only reachable through chained typecasts accept drops.
+        """
+        import dat.tests.pkg_test_operations.init as pkg
+        from dat.gui.overlays.variable_dropping import port_compatibility, \
+            COMPATIBLE, TYPECASTABLE, INCOMPATIBLE
+
+        reg = get_module_registry()
+        gd = reg.get_descriptor
+
+        self.assertEqual(port_compatibility(gd(pkg.ModC), gd(pkg.ModA)),
+                         COMPATIBLE)
+        self.assertEqual(port_compatibility(gd(pkg.ModC), gd(pkg.ModE)),
+                         TYPECASTABLE)
+        # ModB -> ModE -> ModD
+        self.assertEqual(port_compatibility(gd(pkg.ModB), gd(pkg.ModD)),
+                         TYPECASTABLE)
+        self.assertEqual(port_compatibility(gd(pkg.ModD), gd(pkg.ModB)),
+                         INCOMPATIBLE)
+
+    def test_shared_subexpressions(self):
+        import dat.tests.pkg_test_operations.init as pkg
+
+        target, expr = parse_expression(
+            'a = overload_std(overload_std("x", 2), overload_std("x", 2))')
+        op_tree = resolve_symbols(None, expr)
+        self.assertIs(op_tree._op, pkg.overload_std_1)
+        self.assertIs(op_tree._args[0]._op, pkg.overload_std_4)
+        self.assertIs(op_tree._args[0], op_tree._args[1])
+
+    def test_constant_folding(self):
+        def fold(expression):
+            target, expr = parse_expression(expression)
+            return resolve_symbols(None, expr)
+
+        self.assertEqual(fold('a = -(1 + 2) * 3').value, -9.0)
+        self.assertEqual(fold('a = 7 / (3 - 1)').value, 3.5)
+        # Numbers are floats, so this is what PythonCalc would compute
+        self.assertEqual(fold('a = 7 / 2').value, 3.5)
+        self.assertEqual(fold('a = "ab" + "cd"').value, 'abcd')
+        with self.assertRaises(InvalidOperation) as cm:
+            fold('a = 1 / (2 - 2)')
+        self.assertIn("Division by zero", cm.exception.message)
+        # Not a valid constant expression, no operation to do it either
+        with self.assertRaises(InvalidOperation):
+            fold('a = "ab" * 2')
+
+    def test_fused_arithmetic(self):
+        from vistrails.core.modules.basic_modules import Float
+
+        float_desc = get_module_registry().get_descriptor(Float)
+        x = FakeObj(type=float_desc)
+        y = FakeObj(type=float_desc)
+        variables = dict(x=x, y=y)
+        vistraildata = FakeObj(get_variable=variables.get)
+
+        def resolve(expression):
+            target, expr = parse_expression(expression)
+            return resolve_symbols(vistraildata, expr)
+
+        # A single operation is not fused
+        self.assertNotIsInstance(resolve('c = x * 2'), FusedOperations)
+
+        op_tree = resolve('c = x*2 + y/3 - 1')
+        self.assertIsInstance(op_tree, FusedOperations)
+        self.assertEqual(op_tree.expression,
+                         '(((in0 * 2.0) + (in1 / 3.0)) - 1.0)')
+        self.assertEqual([operand._variable for operand in op_tree._operands],
+                         [x, y])
+
+        # Each operand is only passed once
+        op_tree = resolve('c = (x + y) * -(x + y)')
+        self.assertEqual(op_tree.expression,
+                         '((in0 + in1) * (-(in0 + in1)))')
+        self.assertEqual(len(op_tree._operands), 2)
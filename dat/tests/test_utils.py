@@ -3,6 +3,9 @@
 """
 
 
+import os
+import shutil
+import tempfile
 import unittest
 import warnings
 
@@ -11,7 +14,7 @@ from PyQt4 import QtCore
 import dat.tests
 from dat.tests import CallRecorder
 from dat.utils import bisect, iswhitespace, catch_warning, \
-    deferrable_via_qt, deferred_result
+    deferrable_via_qt, deferred_result, DiskCache, LRUCache
 
 
 class Test_utils(unittest.TestCase):
@@ -55,6 +58,72 @@ class Test_bisect(unittest.TestCase):
                          10)  # 100 / 9 = 11, 100 / 10 = 10
 
 
+class Test_LRUCache(unittest.TestCase):
+    """Covers the LRUCache class.
+    """
+    def test_eviction(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(cache['a'], 1)  # 'b' is now the oldest
+        cache['d'] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.keys(), ['c', 'a', 'd'])
+        cache['c'] = 5
+        cache['e'] = 6
+        self.assertEqual(cache.keys(), ['d', 'c', 'e'])
+        self.assertIsNone(cache.get('a'))
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache[1] = 'one'
+        self.assertEqual(cache.pop(1), 'one')
+        self.assertIsNone(cache.pop(1))
+        self.assertRaises(KeyError, lambda: cache[1])
+        self.assertRaises(ValueError, LRUCache, 0)
+
+
+class Test_DiskCache(unittest.TestCase):
+    """Covers the DiskCache class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='dat_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        cache = DiskCache(os.path.join(self.directory, 'values'), 1024)
+        self.assertTrue(cache.set('a', [1, 2, 3]))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        # Another object reading the same directory
+        cache = DiskCache(os.path.join(self.directory, 'values'), 1024)
+        self.assertEqual(cache.get('a'), [1, 2, 3])
+        self.assertFalse(cache.set('b', lambda: None))  # Can't be pickled
+        self.assertEqual(sorted(os.listdir(cache.directory)),
+                         [os.path.basename(cache._filename('a'))])
+        cache.pop('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size(), 0)
+
+    def test_eviction(self):
+        cache = DiskCache(self.directory, 300)
+        self.assertFalse(cache.set('big', 'x' * 400))
+        self.assertEqual(os.listdir(self.directory), [])
+        for i, key in enumerate('abc'):
+            self.assertTrue(cache.set(key, key * 100))
+            os.utime(cache._filename(key), (i, i))
+        self.assertNotIn('a', cache)
+        self.assertLessEqual(cache.size(), 300)
+        self.assertEqual(cache.get('c'), 'c' * 100)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+
 class MyWarning(UserWarning):
     pass
 
@@ -7,8 +7,9 @@ import unittest
 
 from dat import RecipeParameterValue, DATRecipe
 from dat.global_data import GlobalManager
-from dat.tests import FakeObj
+from dat.tests import CallRecorder, FakeObj
 from dat.vistrail_data import VistrailData
+from dat.vistrails_interface.utils import AnnotationIndex
 
 
 class Test_annotations(unittest.TestCase):
@@ -81,19 +82,14 @@ class Test_annotations(unittest.TestCase):
             VistrailData._build_recipe_annotation(
                 self.recipe,
                 self.conn_map),
-            'tests.dat.vistrail_data,My Plot'
-            ';param1=v='
-            'var1:1,2|'
-            'var2:5'
-            ';param2=c='
-            'test%27%22%3Bb%3Dc%2Cr%C3%A9mi:4'
-            ';param3=v='
-            'var3:3')
-
-    def test_read_recipe(self):
-        """Tests the _read_annotation() method.
-        """
-        # Patch GlobalManager
+            '{"params":{'
+            '"param1":[["v","var1",null,[1,2]],["v","var2",null,[5]]],'
+            '"param2":[["c","test\'\\";b=c,r\\u00e9mi",[4]]],'
+            '"param3":[["v","var3",null,[3]]]},'
+            '"plot":["tests.dat.vistrail_data","My Plot"],'
+            '"v":2}')
+
+    def _patch_get_plot(self):
         old_get_plot = GlobalManager.get_plot
 
         def get_plot(pkg_id, name):
@@ -102,6 +98,12 @@ class Test_annotations(unittest.TestCase):
             return self.plot
 
         GlobalManager.get_plot = get_plot
+        return old_get_plot
+
+    def test_read_recipe(self):
+        """Tests the _read_annotation() method with the version 1 format.
+        """
+        old_get_plot = self._patch_get_plot()
         try:
             self.assertEqual(
                 VistrailData._read_recipe_annotation(
@@ -119,6 +121,56 @@ class Test_annotations(unittest.TestCase):
             # Restore GlobalManager
             GlobalManager.get_plot = old_get_plot
 
+    def test_recipe_roundtrip(self):
+        """Reads back recipes written with _build_recipe_annotation().
+        """
+        recipe = DATRecipe(
+            self.plot,
+            dict(self.recipe.parameters,
+                 param3=(RecipeParameterValue(variable=self.var3,
+                                              typecast='cast_op'),)))
+        old_get_plot = self._patch_get_plot()
+        try:
+            for recipe in (self.recipe, recipe):
+                value = VistrailData._build_recipe_annotation(
+                    recipe, self.conn_map)
+                read_recipe, read_conn_map = (
+                    VistrailData._read_recipe_annotation(
+                        self.vistraildata, value))
+                self.assertEqual((read_recipe, read_conn_map),
+                                 (recipe, self.conn_map))
+                param3, = read_recipe.parameters['param3']
+                self.assertEqual(param3.typecast,
+                                 recipe.parameters['param3'][0].typecast)
+                param2, = read_recipe.parameters['param2']
+                self.assertIsInstance(param2.constant, str)
+
+            # Constants that are not valid UTF-8, e.g. latin-1 file paths
+            recipe = DATRecipe(
+                self.plot,
+                {'param2': (RecipeParameterValue(
+                    constant='/home/r\xE9mi/data.csv'),)})
+            conn_map = {'param2': ((4,),)}
+            value = VistrailData._build_recipe_annotation(recipe, conn_map)
+            self.assertIn('["q","%2Fhome%2Fr%E9mi%2Fdata.csv",[4]]', value)
+            self.assertEqual(
+                VistrailData._read_recipe_annotation(
+                    self.vistraildata, value),
+                (recipe, conn_map))
+
+            self.assertEqual(
+                VistrailData._read_recipe_annotation(
+                    self.vistraildata,
+                    '{"params":{"param1":[["v","unknown",null,[1]]]},'
+                    '"plot":["tests.dat.vistrail_data","My Plot"],"v":2}'),
+                (None, None))
+            self.assertEqual(
+                VistrailData._read_recipe_annotation(
+                    self.vistraildata, '{"v":3}'),
+                (None, None))
+        finally:
+            GlobalManager.get_plot = old_get_plot
+
     def test_build_portmap(self):
         """Tests the _build_portmap_annotation() method.
         """
@@ -129,3 +181,37 @@ class Test_annotations(unittest.TestCase):
             '1,port1:2,port2'
             ';param3='
             '3,port3')
+
+
+class Test_annotation_index(unittest.TestCase):
+    def test_index(self):
+        """Tests the AnnotationIndex class.
+        """
+        annotations = [
+            FakeObj(key='a', action_id=1, value='a1'),
+            FakeObj(key='b', action_id=1, value='b1'),
+            FakeObj(key='other', action_id=2, value='x'),
+            FakeObj(key='a', action_id=3, value='a3'),
+        ]
+        set_action_annotation = CallRecorder()
+        vistrail = FakeObj(action_annotations=annotations,
+                           set_action_annotation=set_action_annotation)
+
+        index = AnnotationIndex(vistrail, ('a', 'b'))
+        self.assertEqual(index.scanned, 4)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get('a', 3), 'a3')
+        self.assertIsNone(index.get('b', 3))
+        self.assertEqual(sorted(index.iteritems('a')),
+                         [(1, 'a1'), (3, 'a3')])
+        self.assertRaises(KeyError, index.get, 'other', 2)
+
+        index.set(3, 'b', 'b3')
+        index.set(1, 'a', None)
+        index.set(2, 'other', 'y')
+        self.assertEqual(set_action_annotation.calls, [
+            ([3, 'b', 'b3'], {}),
+            ([1, 'a', None], {}),
+            ([2, 'other', 'y'], {})])
+        self.assertEqual(sorted(index.iteritems('a')), [(3, 'a3')])
+        self.assertEqual(index.get('b', 3), 'b3')
@@ -3,10 +3,14 @@
 """
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import dat.tests
 
+from vistrails.core.db.locator import XMLFileLocator
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.vistrail.controller import VistrailController
 from vistrails.core.vistrail.vistrail import Vistrail
@@ -91,6 +95,44 @@ class Test_vistrails_interface(unittest.TestCase):
 
         return controller, modules
 
+    def test_pipeline_graph(self):
+        """Tests the PipelineGraph class.
+        """
+        from dat.vistrails_interface.utils import PipelineGraph, \
+            get_pipeline_graph, get_upgraded_pipeline
+
+        controller, modules = self.make_pipeline()
+        # Shared for the pipelines that are never modified
+        pipeline = get_upgraded_pipeline(controller.vistrail,
+                                         controller.current_version)
+        graph = get_pipeline_graph(pipeline)
+        self.assertIs(get_pipeline_graph(pipeline), graph)
+
+        def ends(connections):
+            rmodules = {m.id: i for i, m in enumerate(modules)}
+            return sorted((rmodules[c.source.moduleId],
+                           rmodules[c.destination.moduleId])
+                          for c in connections)
+
+        self.assertEqual(ends(graph.outgoing(modules[9].id)),
+                         [(9, 10), (9, 11)])
+        self.assertEqual(ends(graph.incoming(modules[9].id, 'value')),
+                         [(7, 9), (8, 9)])
+        self.assertEqual(graph.incoming(modules[9].id, 'nonexistent'), [])
+        self.assertEqual(ends(graph.connections(modules[5].id)),
+                         [(1, 5), (5, 6)])
+        self.assertEqual(graph.connections(modules[2].id), [])
+
+        # Other pipelines are not indexed, as they might change
+        self.assertNotIsInstance(
+            get_pipeline_graph(controller.current_pipeline),
+            PipelineGraph)
+        controller.add_connection(modules[2].id, 'value',
+                                  modules[3].id, 'value')
+        graph = get_pipeline_graph(controller.current_pipeline)
+        self.assertEqual(ends(graph.incoming(modules[3].id)),
+                         [(0, 3), (2, 3)])
+
     def test_delete_linked(self):
         """Tests the delete_linked() function.
         """
@@ -131,6 +173,82 @@ class Test_vistrails_interface(unittest.TestCase):
         test_delete([3, 6, 7], [2, 4],
                     depth=2)
 
+    def test_pipeline_generator(self):
+        """Tests the bookkeeping of the PipelineGenerator.
+        """
+        from dat.vistrails_interface.pipelines import PipelineGenerator
+
+        controller, modules = self.make_pipeline()
+        rmodules = {m.id: i for i, m in enumerate(modules)}
+        generator = PipelineGenerator(controller)
+        # Kept up to date by the generator, not recomputed
+        all_modules = generator.all_modules
+        self.assertEqual(len(all_modules), 12)
+
+        new_module = generator.copy_module(modules[0])
+        conn_id = generator.connect_modules(new_module, 'value',
+                                            modules[2], 'value')
+        self.assertEqual(generator.get_connection(conn_id).source.moduleId,
+                         new_module.id)
+        generator.delete_linked([modules[7]])
+
+        self.assertIn(new_module, all_modules)
+        self.assertEqual(
+            sorted(rmodules[m.id] for m in all_modules
+                   if m is not new_module),
+            [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(len(generator.all_connections), 5)
+
+        # The operations of a shared subworkflow are only added once
+        other = PipelineGenerator(controller)
+        other.append_operations(generator.operations)
+        other.append_operations(generator.operations)
+        self.assertEqual(other.operations, generator.operations)
+
+        controller.change_selected_version(generator.perform_action())
+        self.assertEqual(len(controller.current_pipeline.module_list), 8)
+        self.assertEqual(len(controller.current_pipeline.connection_list), 5)
+
+    def test_generator_layout(self):
+        """Tests that perform_action() doesn't move the existing modules.
+        """
+        from dat.vistrails_interface.pipelines import PipelineGenerator, \
+            LAYOUT_MARGIN
+
+        from vistrails.core.db.action import create_action
+
+        controller, modules = self.make_pipeline()
+        action = create_action(controller.move_modules_ops(
+            [(module.id, i * 100.0, 0.0)
+             for i, module in enumerate(modules)]))
+        controller.add_new_action(action)
+        controller.change_selected_version(controller.perform_action(action))
+        locations = {module.id: (module.location.x, module.location.y)
+                     for module in controller.current_pipeline.module_list}
+
+        generator = PipelineGenerator(controller)
+        new_modules = [generator.copy_module(modules[i]) for i in (0, 1)]
+        generator.connect_modules(new_modules[0], 'value',
+                                  new_modules[1], 'value')
+        generator.connect_modules(new_modules[1], 'value',
+                                  modules[2], 'value')
+        controller.change_selected_version(generator.perform_action())
+
+        pipeline = controller.current_pipeline
+        for mod_id, location in locations.iteritems():
+            module = pipeline.modules[mod_id]
+            self.assertEqual((module.location.x, module.location.y),
+                             location)
+        # The new modules were placed clear of the existing ones, at the
+        # height of the module they are connected to
+        max_x = max(x for x, y in locations.itervalues())
+        new_locations = [pipeline.modules[m.id].location
+                         for m in new_modules]
+        for location in new_locations:
+            self.assertGreaterEqual(location.x, max_x + LAYOUT_MARGIN)
+        ys = [location.y for location in new_locations]
+        self.assertAlmostEqual((min(ys) + max(ys)) / 2.0, 0.0)
+
     def test_find_modules_by_type(self):
         """Tests the find_modules_by_type() function.
         """
@@ -168,6 +286,140 @@ class Test_vistrails_interface(unittest.TestCase):
                 [Boolean]),
             [])
 
+        self.assertEqual(
+            [m.id for m in find_modules_by_type(
+                controller.current_pipeline,
+                [Float, String])],
+            [m.id for m in controller.current_pipeline.module_list])
+
+    def test_module_type_index(self):
+        """Tests that the ModuleTypeIndex is shared for unmodified pipelines.
+        """
+        from dat.vistrails_interface.utils import find_modules_by_type, \
+            get_module_type_index, get_upgraded_pipeline
+        from vistrails.core.modules.basic_modules import String
+
+        controller = VistrailController(Vistrail())
+        controller.change_selected_version(0)
+        mod1 = controller.add_module('org.vistrails.vistrails.basic',
+                                     'String')
+
+        # Shared for the pipelines that are never modified
+        pipeline = get_upgraded_pipeline(controller.vistrail,
+                                         controller.current_version)
+        index = get_module_type_index(pipeline)
+        self.assertIs(get_module_type_index(pipeline), index)
+        self.assertEqual(
+            [m.id for m in find_modules_by_type(pipeline, [String])],
+            [mod1.id])
+
+        # Not indexed for other pipelines, which might change
+        self.assertIsNone(get_module_type_index(controller.current_pipeline))
+        mod2 = controller.add_module('org.vistrails.vistrails.basic',
+                                     'String')
+        self.assertEqual(
+            set(m.id for m in find_modules_by_type(
+                controller.current_pipeline, [String])),
+            set([mod1.id, mod2.id]))
+
+    def test_upgraded_pipeline_cache(self):
+        """Tests the cache behind get_upgraded_pipeline().
+        """
+        from dat.vistrails_interface.utils import get_upgraded_pipeline, \
+            invalidate_upgraded_pipelines
+
+        controller, modules = self.make_pipeline()
+        vistrail = controller.vistrail
+        version = controller.current_version
+
+        pipeline = get_upgraded_pipeline(vistrail, version)
+        self.assertEqual(len(pipeline.module_list), 12)
+        self.assertIs(get_upgraded_pipeline(vistrail, version), pipeline)
+        self.assertIsNot(get_upgraded_pipeline(vistrail, 0), pipeline)
+
+        invalidate_upgraded_pipelines(vistrail, [version])
+        pipeline2 = get_upgraded_pipeline(vistrail, version)
+        self.assertIsNot(pipeline2, pipeline)
+        self.assertEqual(len(pipeline2.module_list), 12)
+
+        invalidate_upgraded_pipelines()
+        self.assertIsNot(get_upgraded_pipeline(vistrail, version), pipeline2)
+
+    def test_upgraded_pipeline_disk_cache(self):
+        """Tests the disk cache behind get_upgraded_pipeline().
+        """
+        from dat.vistrails_interface import utils
+        from dat.vistrails_interface.utils import get_upgraded_pipeline, \
+            invalidate_upgraded_pipelines, set_disk_cache_directory
+
+        filename = os.path.join(os.path.dirname(__file__),
+                                'pkg_test_plots', 'concat.xml')
+        directory = tempfile.mkdtemp(prefix='dat_test_')
+        set_disk_cache_directory(directory)
+        old_controller = utils.VistrailController
+        try:
+            pipeline = get_upgraded_pipeline(XMLFileLocator(filename).load(),
+                                             filename=filename)
+
+            # Opened again in a new session: not upgraded
+            invalidate_upgraded_pipelines()
+
+            def no_upgrade(vistrail):
+                self.fail("pipeline was upgraded again")
+            utils.VistrailController = no_upgrade
+            pipeline2 = get_upgraded_pipeline(XMLFileLocator(filename).load(),
+                                              filename=filename)
+            self.assertIsNot(pipeline2, pipeline)
+            self.assertEqual(sorted(pipeline2.modules),
+                             sorted(pipeline.modules))
+            self.assertEqual(sorted(pipeline2.connections),
+                             sorted(pipeline.connections))
+        finally:
+            utils.VistrailController = old_controller
+            set_disk_cache_directory(None)
+            invalidate_upgraded_pipelines()
+            shutil.rmtree(directory)
+
+    def test_variable_value_disk_key(self):
+        """Tests what the key of variable values on disk depends on.
+        """
+        from dat.vistrails_interface.utils import variable_value_disk_key
+        import vistrails.core.modules.basic_modules as basic
+
+        controller, modules = self.make_pipeline()
+        output_id = modules[3].id
+
+        def key(value):
+            controller.update_function(
+                controller.current_pipeline.modules[modules[0].id],
+                'value', [value])
+            return variable_value_disk_key(controller.current_pipeline,
+                                           output_id)
+
+        self.assertIsNotNone(key('some text'))
+
+        # Files named by strings are part of the key
+        fd, filename = tempfile.mkstemp(prefix='dat_test_')
+        try:
+            os.close(fd)
+            key1 = key(filename)
+            self.assertIn(repr(filename), key1)
+            with open(filename, 'wb') as fp:
+                fp.write('changed')
+            self.assertNotEqual(key(filename), key1)
+        finally:
+            os.remove(filename)
+
+        # Remote data is not kept on disk
+        self.assertIsNone(key('http://www.example.org/data.csv'))
+
+        # Neither are the values of modules that opt out
+        basic.String.dat_disk_cacheable = False
+        try:
+            self.assertIsNone(key('some text'))
+        finally:
+            del basic.String.dat_disk_cacheable
+
     def test_describe_update(self):
         """Tests the describe_dat_update() function.
         """
@@ -1,6 +1,12 @@
+from collections import OrderedDict
+import cPickle as pickle
 import functools
+import hashlib
 from itertools import izip
+import logging
+import os
 import string
+import tempfile
 import warnings
 
 from PyQt4 import QtCore
@@ -107,6 +113,211 @@ def abbrev(s, length=30, ellipsis='...'):
         return s[:length - len(ellipsis)] + ellipsis
 
 
+def file_signature(filename):
+    """Returns a value that changes when the given file is modified.
+
+    This is the (modification time, size) pair of the file, or None if it
+    can't be accessed. It is used to invalidate data cached from files.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class LRUCache(object):
+    """A mapping that only keeps a limited number of entries.
+
+    When a new entry is added and the cache is full, the least recently used
+    entry is discarded. Both reading and writing an entry count as using it.
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        # Move the entry to the end of the list (most recently used)
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+
+    def keys(self):
+        return self._entries.keys()
+
+
+class _CacheFileTooBig(Exception):
+    pass
+
+
+class _SizeLimitedWriter(object):
+    """Writes to a file, raising _CacheFileTooBig past max_size bytes.
+    """
+    def __init__(self, fp, max_size):
+        self._fp = fp
+        self._max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self._max_size:
+            raise _CacheFileTooBig
+        self._fp.write(data)
+
+
+class DiskCache(object):
+    """A persistent cache of picklable values, stored in a directory.
+
+    Each entry is pickled to its own file, named after a hash of its key (a
+    string). When the files take more than max_size bytes, the least recently
+    used entries are deleted; both reading and writing an entry count as using
+    it.
+
+    Failing to access the directory is not an error: entries that can't be
+    read are missing, and values that can't be written are not kept.
+    """
+    def __init__(self, directory, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.directory = directory
+        self.max_size = max_size
+
+    def _filename(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.pickle')
+
+    def _entries(self):
+        """Returns the (access time, size, filename) of every entry.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith('.pickle'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def __contains__(self, key):
+        return os.path.isfile(self._filename(key))
+
+    def get(self, key, default=None):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fp:
+                stored_key, value = pickle.load(fp)
+        except IOError:
+            return default
+        except Exception:
+            logging.warning("Discarding invalid cache file %s", filename)
+            self._remove(filename)
+            return default
+        if stored_key != key:
+            return default
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        """Stores a value in the cache.
+
+        Returns False if the value was not stored, because it can't be pickled,
+        it is bigger than the cache, or the file couldn't be written.
+
+        The value is pickled directly to a temporary file, which is then
+        renamed, so it is never held in memory as a whole. Writing stops as
+        soon as the file gets bigger than the cache.
+        """
+        filename = self._filename(key)
+        temp = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump((key, value),
+                            _SizeLimitedWriter(fp, self.max_size),
+                            pickle.HIGHEST_PROTOCOL)
+            # Windows can't rename over an existing file
+            self._remove(filename)
+            os.rename(temp, filename)
+        except (IOError, OSError), e:
+            logging.warning("Couldn't write cache file %s: %s", filename, e)
+            if temp is not None:
+                self._remove(temp)
+            return False
+        except Exception:
+            # Can't be pickled, or too big
+            if temp is not None:
+                self._remove(temp)
+            return False
+
+        # Evict the least recently used entries
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            if name != filename:
+                self._remove(name)
+                total -= size
+        return True
+
+    def pop(self, key):
+        self._remove(self._filename(key))
+
+    def clear(self):
+        for mtime, size, filename in self._entries():
+            self._remove(filename)
+
+    def size(self):
+        """Returns the number of bytes used by the entries.
+        """
+        return sum(size for mtime, size, filename in self._entries())
+
+
 class DeferredResult(object):
     def __nonzero__(self, *args):
         raise RuntimeError("DeferredResult should be ignored!")
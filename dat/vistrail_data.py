@@ -1,15 +1,22 @@
 import contextlib
 import itertools
+import json
+import logging
+import time
 import urllib2
 import uuid
 import warnings
 import weakref
 
-from dat import RecipeParameterValue, DATRecipe, PipelineInformation
+from PyQt4 import QtCore
+
+from dat import RecipeParameterValue, DATRecipe, DeferredVariable, \
+    PipelineInformation
 from dat import data_provenance
 from dat.global_data import GlobalManager
 from dat.vistrails_interface import Variable, get_pipeline_location, \
     get_upgraded_pipeline
+from dat.vistrails_interface.utils import AnnotationIndex
 
 from vistrails.core.application import get_vistrails_application
 from vistrails.core.vistrail.vistrailvariable import VistrailVariable
@@ -21,6 +28,24 @@ from vistrails.packages.spreadsheet.spreadsheet_tab import \
     StandardWidgetSheetTab
 
 
+class _RecipeVariables(object):
+    """Looks up the variables of the recipes read when opening a vistrail.
+
+    Variables that are not loaded yet (lazy mode) are not resolved here;
+    DeferredVariable placeholders are returned instead, and the recipes look
+    them up when they are first used.
+    """
+    def __init__(self, vistraildata):
+        self._vistraildata = vistraildata
+
+    def get_variable(self, varname):
+        vistraildata = self._vistraildata
+        if varname in vistraildata._pending_variables:
+            return DeferredVariable(varname,
+                                    vistraildata._resolve_recipe_variable)
+        return vistraildata._variables.get(varname)
+
+
 class VistrailData(object):
     """Keeps a list of DAT objects that are local to a vistrail file.
 
@@ -45,12 +70,22 @@ class VistrailData(object):
     #           key="dat-ports"
     #           value="<portmap>" />
     #
-    # Where <recipe> has the format (with added whitespace for clarity):
+    # Where <recipe> is a compact JSON object (with added whitespace for
+    # clarity):
+    #   {"v": 2,
+    #    "plot": ["plot_package", "PlotName"],
+    #    "params": {
+    #        "param1": [["v", "varname1", null, [CONN1, CONN2]],
+    #                   ["v", "varname2", "cast_op", [CONN3]]],
+    #        "param2": [["c", "value2", [CONN4]]]}}
+    #
+    # Files written by older versions use the version 1 format for <recipe>,
+    # which is still read:
     #   plot_package,PlotName;
     #       param1=v=
     #           varname1:CONN1,CONN2|
     #           varname2,cast_op:CONN3;
-    #       param2=c=value2
+    #       param2=c=value2:CONN4
     #
     # And <portmap>:
     #   param1=
@@ -67,7 +102,10 @@ class VistrailData(object):
     #     input port for the associated parameter
     #   * CONN<M> with the id of a connection tying the plot input port to one
     #     of the parameters set to this port
-    #   * value<N> is the string representation of a constant
+    #   * value<N> is the string representation of a constant (URL-quoted in
+    #     the version 1 format); constants that are not valid UTF-8 are
+    #     written URL-quoted in the JSON format as well, marked "q" instead of
+    #     "c"
     #   * cast_op is the name of the variable operation used for typecasting
     #
     # Parameters which are not set are simply omitted from the list
@@ -75,87 +113,149 @@ class VistrailData(object):
     _PORTMAP_KEY = 'dat-ports'
     _DATA_PROVENANCE_KEY = 'dat-data-provenance'
 
+    _RECIPE_FORMAT_VERSION = 2
+
     @staticmethod
     def _build_recipe_annotation(recipe, conn_map):
         """Builds the recipe annotation value from the recipe and conn_map.
+
+        This always writes the current format.
         """
-        value = '%s,%s' % (recipe.plot.package_identifier, recipe.plot.name)
-        for param, param_values in sorted(recipe.parameters.iteritems(),
-                                          key=lambda (k, v): k):
+        parameters = dict()
+        for param, param_values in recipe.parameters.iteritems():
             if not param_values:
                 continue
-            value += ';%s=' % param
-            if param_values[0].type == RecipeParameterValue.CONSTANT:
-                if len(param_values) != 1:
-                    raise ValueError
-                value += 'c='
-            else:  # param_values[0].type == RecipeParameterValue.VARIABLE:
-                value += 'v='
-
-            for i, param_val, conn_list in itertools.izip(
-                    itertools.count(), param_values, conn_map[param]):
-                if i != 0:
-                    value += '|'
+            if (param_values[0].type == RecipeParameterValue.CONSTANT and
+                    len(param_values) != 1):
+                raise ValueError
+            values = []
+            for param_val, conn_list in itertools.izip(param_values,
+                                                       conn_map[param]):
                 if param_val.type == RecipeParameterValue.CONSTANT:
-                    value += urllib2.quote(param_val.constant, safe='')
+                    constant = param_val.constant
+                    try:
+                        if isinstance(constant, str):
+                            constant.decode('utf-8')
+                    except UnicodeDecodeError:
+                        # JSON can only hold text; quote arbitrary bytes
+                        values.append(['q', urllib2.quote(constant, safe=''),
+                                       list(conn_list)])
+                    else:
+                        values.append(['c', constant, list(conn_list)])
                 else:  # param_val.type == RecipeParameterValue.VARIABLE
-                    value += param_val.variable.name
-                    if param_val.typecast is not None:
-                        value += ',%s' % param_val.typecast
-                value += ':' + ','.join(
-                    '%d' % conn_id
-                    for conn_id in conn_list)
-        return value
+                    values.append(['v', param_val.variable_name,
+                                   param_val.typecast, list(conn_list)])
+            parameters[param] = values
+        return json.dumps(
+            {'v': VistrailData._RECIPE_FORMAT_VERSION,
+             'plot': [recipe.plot.package_identifier, recipe.plot.name],
+             'params': parameters},
+            sort_keys=True, separators=(',', ':'))
 
     @staticmethod
     def _read_recipe_annotation(vistraildata, value):
         """Reads (recipe, conn_map) from an annotation value.
+
+        Both the current JSON format and the version 1 format are accepted.
+        Returns (None, None) if the value can't be read.
         """
+        if value.startswith('{'):
+            read = VistrailData._read_recipe_annotation_v2
+        else:
+            read = VistrailData._read_recipe_annotation_v1
+        try:
+            return read(vistraildata, value)
+        except (KeyError, ValueError, TypeError, IndexError):
+            return None, None
+
+    @staticmethod
+    def _read_recipe_annotation_v2(vistraildata, value):
+        def to_str(s):
+            # JSON strings are decoded as unicode; DAT uses UTF-8 str objects
+            if isinstance(s, unicode):
+                return s.encode('utf-8')
+            elif isinstance(s, str):
+                return s
+            raise TypeError
+
+        data = json.loads(value)
+        if data['v'] != 2:
+            raise ValueError
+        pkg_id, plot_name = data['plot']
+        plot = GlobalManager.get_plot(to_str(pkg_id), to_str(plot_name))
+        parameters = dict()
+        conn_map = dict()
+        for param, pvals in data['params'].iteritems():
+            plist = []
+            cplist = []
+            for val in pvals:
+                if val[0] == 'c':
+                    t, constant, connlist = val
+                    plist.append(RecipeParameterValue(
+                        constant=to_str(constant)))
+                elif val[0] == 'q':
+                    t, constant, connlist = val
+                    plist.append(RecipeParameterValue(
+                        constant=urllib2.unquote(to_str(constant))))
+                elif val[0] == 'v':
+                    t, varname, typecast, connlist = val
+                    if typecast is not None:
+                        typecast = to_str(typecast)
+                    plist.append(RecipeParameterValue(
+                        variable=vistraildata.get_variable(to_str(varname)),
+                        typecast=typecast))
+                else:
+                    raise ValueError
+                cplist.append(tuple(int(conn_id) for conn_id in connlist))
+            param = to_str(param)
+            parameters[param] = tuple(plist)
+            conn_map[param] = tuple(cplist)
+        return DATRecipe(plot, parameters), conn_map
+
+    @staticmethod
+    def _read_recipe_annotation_v1(vistraildata, value):
         def read_connlist(connlist):
             return tuple(int(conn_id) for conn_id in connlist.split(','))
 
         value = iter(value.split(';'))
-        try:
-            plot = next(value)
-            plot = plot.split(',')
-            if len(plot) != 2:
+        plot = next(value)
+        plot = plot.split(',')
+        if len(plot) != 2:
+            raise ValueError
+        plot = GlobalManager.get_plot(*plot)  # Might raise KeyError
+        parameters = dict()
+        conn_map = dict()
+        for param in value:
+            # Might raise ValueError or TypeError
+            param, t, pvals = param.split('=')
+            pvals = pvals.split('|')
+            plist = []
+            cplist = []
+            if t not in ('c', 'v'):
                 raise ValueError
-            plot = GlobalManager.get_plot(*plot)  # Might raise KeyError
-            parameters = dict()
-            conn_map = dict()
-            for param in value:
-                # Might raise ValueError or TypeError
-                param, t, pvals = param.split('=')
-                pvals = pvals.split('|')
-                plist = []
-                cplist = []
-                if t not in ('c', 'v'):
+            for val in pvals:
+                val = val.split(':')
+                if len(val) != 2:
                     raise ValueError
-                for val in pvals:
-                    val = val.split(':')
-                    if len(val) != 2:
+                if t == 'c':
+                    plist.append(RecipeParameterValue(
+                        constant=urllib2.unquote(val[0])))
+                else:  # t == 'v':
+                    v = val[0].split(',')
+                    if len(v) not in (1, 2):
                         raise ValueError
-                    if t == 'c':
+                    variable = vistraildata.get_variable(v[0])
+                    if len(v) == 2:
                         plist.append(RecipeParameterValue(
-                            constant=urllib2.unquote(val[0])))
-                    else:  # t == 'v':
-                        v = val[0].split(',')
-                        if len(v) not in (1, 2):
-                            raise ValueError
-                        variable = vistraildata.get_variable(v[0])
-                        if len(v) == 2:
-                            plist.append(RecipeParameterValue(
-                                variable=variable,
-                                typecast=v[1]))
-                        else:
-                            plist.append(RecipeParameterValue(
-                                variable=variable))
-                    cplist.append(read_connlist(val[1]))
-                parameters[param] = tuple(plist)
-                conn_map[param] = tuple(cplist)
-            return DATRecipe(plot, parameters), conn_map
-        except (KeyError, ValueError, TypeError):
-            return None, None
+                            variable=variable,
+                            typecast=v[1]))
+                    else:
+                        plist.append(RecipeParameterValue(
+                            variable=variable))
+                cplist.append(read_connlist(val[1]))
+            parameters[param] = tuple(plist)
+            conn_map[param] = tuple(cplist)
+        return DATRecipe(plot, parameters), conn_map
 
     @staticmethod
     def _build_portmap_annotation(port_map):
@@ -197,22 +297,35 @@ class VistrailData(object):
         except (ValueError, TypeError):
             return None
 
-    def __init__(self, controller):
+    # Time spent resolving lazily-loaded variables at each iteration of the
+    # event loop, in seconds
+    _BACKGROUND_LOADING_SLICE = 0.05
+
+    def __init__(self, controller, lazy=False):
         """Initial setup of the VistrailData.
 
         Discovers plots and variable loaders from packages and registers
         notifications for packages loaded in the future.
+
+        If lazy is True, the type of the variables is not read right away:
+        each variable is resolved when it is first accessed, or from the Qt
+        event loop in the background.
         """
         self._controller = controller
         self._spreadsheet_tabs = None  # id: int -> spreadsheet_tab
 
         self._variables = dict()
+        self._pending_variables = dict()  # varname: str -> version: int
         self._data_provenance = dict()  # version: int -> provenance
 
         self._cell_to_version = dict()  # CellInformation -> int
         self._version_to_pipeline = dict()  # int -> PipelineInformation
         # CellInformation -> PipelineInformation
         self._cell_to_pipeline = dict()
+        # Reverse indexes, maintained by _set_pipeline(), _set_cell() and
+        # _forget_pipeline()
+        self._variable_to_versions = dict()  # varname: str -> set([int])
+        self._version_to_cells = dict()  # int -> set([CellInformation])
 
         self._failed_infer_calls = set()  # [version: int]
 
@@ -223,68 +336,153 @@ class VistrailData(object):
         # dat_removed_variable(varname: str)
         app.create_notification('dat_removed_variable')
 
-        annotations = self._controller.vistrail.action_annotations
+        start = time.time()
+
+        # Index the annotations we are interested in, in a single pass
+        self._annotations = AnnotationIndex(
+            self._controller.vistrail,
+            (self._DATA_PROVENANCE_KEY, self._RECIPE_KEY, self._PORTMAP_KEY))
+        annotations_time = time.time()
 
         # Load variables from tagged versions
         if self._controller.vistrail.has_tag_str('dat-vars'):
             # Load all data provenance annotations
             # Loading from known variables is not enough, we also need deleted
             # variables to form the complete graph
-            for an in annotations:
-                if an.key == self._DATA_PROVENANCE_KEY:
-                    version = an.action_id
-                    provenance = data_provenance.read_from_annotation(an.value)
-                    self._data_provenance[version] = provenance
+            for version, value in self._annotations.iteritems(
+                    self._DATA_PROVENANCE_KEY):
+                provenance = data_provenance.read_from_annotation(value)
+                self._data_provenance[version] = provenance
 
             tagmap = self._controller.vistrail.get_tagMap()
             for version, tag in tagmap.iteritems():
                 if tag.startswith('dat-var-'):
                     varname = tag[8:]
 
-                    # Get the type from the OutputPort module's spec input port
-                    type = Variable.read_type(get_upgraded_pipeline(
-                        self._controller.vistrail,
-                        version))
-                    if type is None:
-                        warnings.warn("Found invalid DAT variable pipeline "
-                                      "%r, ignored" % tag)
+                    if lazy:
+                        self._pending_variables[varname] = version
+                    elif self._load_variable(varname, version) is None:
                         continue
-                    # Get the data provenance
-                    provenance = self._data_provenance.get(version)
-
-                    variable = Variable.VariableInformation(
-                        varname, self._controller, type, provenance)
-
-                    self._variables[varname] = variable
                     self._add_variable(varname)
+        variables_time = time.time()
 
         # Load mappings from annotations
         # First, read the recipes
-        for an in annotations:
-            if an.key == self._RECIPE_KEY:
-                version = an.action_id
-                recipe, conn_map = self._read_recipe_annotation(self, an.value)
-                if recipe is not None:
-                    pipeline = PipelineInformation(
-                        version, recipe, conn_map,
-                        None)  # to be filled by the next block
-                    self._version_to_pipeline[version] = pipeline
+        recipe_variables = _RecipeVariables(self)
+        for version, value in self._annotations.iteritems(self._RECIPE_KEY):
+            recipe, conn_map = self._read_recipe_annotation(recipe_variables,
+                                                            value)
+            if recipe is not None:
+                pipeline = PipelineInformation(
+                    version, recipe, conn_map,
+                    None)  # to be filled by the next block
+                self._set_pipeline(pipeline)
         # Then, read the port maps
-        for an in annotations:
-            if an.key == self._PORTMAP_KEY:
-                pipeline = self._version_to_pipeline[an.action_id]
-                if not pipeline:
-                    # Purge the lone port map
-                    warnings.warn("Found a DAT port map annotation with no "
-                                  "associated recipe -- removing")
-                    self._controller.vistrail.set_action_annotation(
-                        an.action_id,
-                        an.key,
-                        None)
-                else:
-                    port_map = self._read_portmap_annotation(an.value)
-                    if port_map is not None:
-                        pipeline.port_map = port_map
+        for version, value in list(self._annotations.iteritems(
+                self._PORTMAP_KEY)):
+            pipeline = self._version_to_pipeline.get(version)
+            if pipeline is None:
+                # Purge the lone port map
+                warnings.warn("Found a DAT port map annotation with no "
+                              "associated recipe -- removing")
+                self._annotations.set(version, self._PORTMAP_KEY, None)
+            else:
+                port_map = self._read_portmap_annotation(value)
+                if port_map is not None:
+                    pipeline.port_map = port_map
+        end = time.time()
+
+        self.load_stats = dict(
+            annotations=self._annotations.scanned,
+            variables=len(self._variables),
+            pending_variables=len(self._pending_variables),
+            pipelines=len(self._version_to_pipeline),
+            annotations_time=annotations_time - start,
+            variables_time=variables_time - annotations_time,
+            recipes_time=end - variables_time,
+            total_time=end - start)
+        logging.info(
+            "Loaded DAT data in %(total_time).3fs: %(annotations)d "
+            "annotations (%(annotations_time).3fs), %(variables)d variables "
+            "+ %(pending_variables)d deferred (%(variables_time).3fs), "
+            "%(pipelines)d pipelines (%(recipes_time).3fs)",
+            self.load_stats)
+
+        if self._pending_variables:
+            self._schedule_background_loading(list(self._pending_variables))
+
+    def _load_variable(self, varname, version):
+        """Reads a variable from its pipeline and stores it.
+
+        Returns the new VariableInformation, or None if the pipeline is not a
+        valid DAT variable.
+        """
+        # Get the type from the OutputPort module's spec input port
+        type = Variable.read_type(get_upgraded_pipeline(
+            self._controller.vistrail,
+            version))
+        if type is None:
+            warnings.warn("Found invalid DAT variable pipeline %r, "
+                          "ignored" % ('dat-var-%s' % varname))
+            return None
+        # Get the data provenance
+        provenance = self._data_provenance.get(version)
+
+        variable = Variable.VariableInformation(
+            varname, self._controller, type, provenance)
+
+        self._variables[varname] = variable
+        return variable
+
+    def _resolve_variable(self, varname):
+        """Loads a variable that was deferred by the lazy mode.
+
+        If the pipeline turns out to be invalid, observers are told that the
+        variable was removed, and None is returned. If loading raises, the
+        variable stays deferred and is loaded again on the next access.
+        """
+        variable = self._load_variable(varname,
+                                       self._pending_variables[varname])
+        del self._pending_variables[varname]
+        if variable is None:
+            self._remove_variable(varname)
+        return variable
+
+    def _resolve_recipe_variable(self, varname):
+        """Resolves a DeferredVariable from a recipe read in lazy mode.
+
+        The recipes using a variable that turns out to be invalid are dropped
+        when it is resolved, but one might already have been handed out; this
+        raises ValueError in that case instead of returning None.
+        """
+        variable = self.get_variable(varname)
+        if variable is None:
+            raise ValueError("DAT variable %r used by this recipe is not "
+                             "valid" % varname)
+        return variable
+
+    def _schedule_background_loading(self, varnames):
+        if QtCore.QCoreApplication.instance() is not None:
+            QtCore.QTimer.singleShot(
+                0, lambda: self._background_loading(varnames))
+
+    def _background_loading(self, varnames):
+        """Resolves some of the deferred variables from the event loop.
+
+        varnames is the list of the variables left to resolve. A variable that
+        fails to load is only tried once here; it stays deferred.
+        """
+        deadline = time.time() + self._BACKGROUND_LOADING_SLICE
+        while varnames and time.time() < deadline:
+            varname = varnames.pop()
+            if varname not in self._pending_variables:
+                continue  # Already resolved when it was accessed
+            try:
+                self._resolve_variable(varname)
+            except Exception:
+                logging.exception("Error loading DAT variable %r", varname)
+        if varnames:
+            self._schedule_background_loading(varnames)
 
     def _get_controller(self):
         return self._controller
@@ -378,19 +576,14 @@ class VistrailData(object):
         VistrailManager._tabs[tab] = (self, sheet_id)
         return tab, sheet_id
 
-    def _get_spreadsheet_tabs(self):
-        if self._spreadsheet_tabs is not None:
-            return self._spreadsheet_tabs
-
-        sh_window = spreadsheetController.findSpreadsheetWindow(create=False)
-        if sh_window is None:
-            return None
-        tab_controller = sh_window.tabController
+    def get_latest_pipelines(self):
+        """Finds the pipeline currently shown in each cell.
 
-        # Get the cell location from the pipeline to fill in _cell_to_version
-        # and _cell_to_pipeline
+        Returns a dict mapping (row, col, sheet_id) to the PipelineInformation
+        with the latest version for that location. This doesn't need the
+        spreadsheet window.
+        """
         cells = dict()
-        sheet_sizes = dict()
         for pipeline in self._version_to_pipeline.itervalues():
             try:
                 row, col, sheetname_var = get_pipeline_location(
@@ -402,18 +595,29 @@ class VistrailData(object):
                     raise ValueError
             except ValueError:
                 continue
-            try:
-                p = cells[(row, col, sheet_id)]
-            except KeyError:
+            p = cells.get((row, col, sheet_id))
+            if p is None or pipeline.version > p.version:
+                # Select the latest version for a given cell
                 cells[(row, col, sheet_id)] = pipeline
-                rowCount, colCount = sheet_sizes.get(sheet_id, (2, 2))
-                rowCount = max(rowCount, row + 1)
-                colCount = max(colCount, col + 1)
-                sheet_sizes[sheet_id] = (rowCount, colCount)
-            else:
-                if pipeline.version > p.version:
-                    # Select the latest version for a given cell
-                    cells[(row, col, sheet_id)] = pipeline
+        return cells
+
+    def _get_spreadsheet_tabs(self):
+        if self._spreadsheet_tabs is not None:
+            return self._spreadsheet_tabs
+
+        sh_window = spreadsheetController.findSpreadsheetWindow(create=False)
+        if sh_window is None:
+            return None
+        tab_controller = sh_window.tabController
+
+        # Get the cell location from the pipeline to fill in _cell_to_version
+        # and _cell_to_pipeline
+        cells = self.get_latest_pipelines()
+        sheet_sizes = dict()
+        for row, col, sheet_id in cells.iterkeys():
+            rowCount, colCount = sheet_sizes.get(sheet_id, (2, 2))
+            sheet_sizes[sheet_id] = (max(rowCount, row + 1),
+                                     max(colCount, col + 1))
         self._spreadsheet_tabs = dict()
         self._spreadsheet_tabs_rev = dict()
         for (row, col, sheet_id), pipeline in cells.iteritems():
@@ -427,9 +631,8 @@ class VistrailData(object):
                     rowCount,
                     colCount,
                     sheet_id)[0]
-            cellInfo = CellInformation(spreadsheet_tab, row, col)
-            self._cell_to_pipeline[cellInfo] = pipeline
-            self._cell_to_version[cellInfo] = pipeline.version
+            self._set_cell(CellInformation(spreadsheet_tab, row, col),
+                           pipeline)
 
         if not self._spreadsheet_tabs:
             self.new_tab(True, tab_controller)
@@ -461,7 +664,7 @@ class VistrailData(object):
 
         This will materialize it in the pipeline and signal its creation.
         """
-        if varname in self._variables:
+        if varname in self._variables or varname in self._pending_variables:
             raise ValueError("A variable named %s already exists!")
 
         # Materialize the Variable in the Vistrail
@@ -470,7 +673,7 @@ class VistrailData(object):
         # Record the data provenance in an annotation
         version = self.controller.vistrail.get_version_number(
             'dat-var-%s' % varname)
-        self.controller.vistrail.set_action_annotation(
+        self._annotations.set(
             version,
             self._DATA_PROVENANCE_KEY,
             data_provenance.save_to_annotation(variable.provenance))
@@ -485,13 +688,12 @@ class VistrailData(object):
     def _add_variable(self, varname, renamed_from=None):
         if renamed_from is not None:
             # Variable was renamed -- reflect this change on the annotations
-            for pipeline in self._version_to_pipeline.itervalues():
-                if any(
-                        p.type == RecipeParameterValue.VARIABLE and
-                        p.variable.name == varname
-                        for p_values in pipeline.recipe.parameters.itervalues()
-                        for p in p_values):
-                    self._controller.vistrail.set_action_annotation(
+            versions = self._variable_to_versions.pop(renamed_from, None)
+            if versions:
+                self._variable_to_versions[varname] = versions
+                for version in versions:
+                    pipeline = self._version_to_pipeline[version]
+                    self._annotations.set(
                         pipeline.version,
                         self._RECIPE_KEY,
                         self._build_recipe_annotation(
@@ -514,36 +716,18 @@ class VistrailData(object):
         if renamed_to is None:
             # A variable was removed!
             # We'll remove all the mappings that used it
-            to_remove = set([])
-            for pipeline in self._version_to_pipeline.itervalues():
-                if any(
-                        p.type == RecipeParameterValue.VARIABLE and
-                        p.variable.name == varname
-                        for p_values in pipeline.recipe.parameters.itervalues()
-                        for p in p_values):
-                    to_remove.add(pipeline.version)
+            to_remove = self._variable_to_versions.get(varname)
             if to_remove:
                 warnings.warn(
                     "Variable %r was used in %d pipelines!" % (
                         varname, len(to_remove)))
-            for version in to_remove:
-                del self._version_to_pipeline[version]
-
-                # Remove the annotations from the vistrail
-                for key in (
-                        self._RECIPE_KEY, self._PORTMAP_KEY):
-                    self._controller.vistrail.set_action_annotation(
-                        version,
-                        key,
-                        None)
-
-            cell_to_remove = []
-            for cellInfo, version in self._cell_to_version.iteritems():
-                if version in to_remove:
-                    cell_to_remove.append(cellInfo)
-            for cellInfo in cell_to_remove:
-                del self._cell_to_version[cellInfo]
-                del self._cell_to_pipeline[cellInfo]
+                for version in list(to_remove):
+                    self._forget_pipeline(version)
+
+                    # Remove the annotations from the vistrail
+                    for key in (
+                            self._RECIPE_KEY, self._PORTMAP_KEY):
+                        self._annotations.set(version, key, None)
 
     def remove_variable(self, varname):
         """Remove a Variable from DAT.
@@ -551,6 +735,9 @@ class VistrailData(object):
         This will remove the associated version in the vistrail and signal its
         destruction.
         """
+        if (varname in self._pending_variables and
+                self._resolve_variable(varname) is None):
+            return  # Invalid variable, already removed
         self._remove_variable(varname)
 
         variable = self._variables.pop(varname)
@@ -564,6 +751,11 @@ class VistrailData(object):
         Observers will get notified that a Variable was deleted and another
         added.
         """
+        if (old_varname in self._pending_variables and
+                self._resolve_variable(old_varname) is None):
+            return  # Invalid variable, already removed
+        # Recipes can't look the variable up by its old name after this
+        self._resolve_recipe_variables(old_varname)
         self._remove_variable(old_varname, renamed_to=new_varname)
 
         variable = self._variables.pop(old_varname)
@@ -575,10 +767,13 @@ class VistrailData(object):
     def get_variable(self, varname):
         if not isinstance(varname, str):
             raise ValueError
+        if varname in self._pending_variables:
+            return self._resolve_variable(varname)
         return self._variables.get(varname)
 
     def _get_variables(self):
-        return self._variables.iterkeys()
+        # Returns a copy, as getting variables might resolve deferred ones
+        return iter(self._variables.keys() + self._pending_variables.keys())
     variables = property(_get_variables)
 
     def variable_provenance(self, version):
@@ -615,22 +810,80 @@ class VistrailData(object):
                     pipeline.recipe))
         except KeyError:
             pass
-        self._cell_to_version[cellInfo] = pipeline.version
-        self._version_to_pipeline[pipeline.version] = pipeline
-        self._cell_to_pipeline[cellInfo] = pipeline
+        self._set_pipeline(pipeline)
+        self._set_cell(cellInfo, pipeline)
 
         # Add the annotation in the vistrail
-        self._controller.vistrail.set_action_annotation(
+        self._annotations.set(
             pipeline.version,
             self._RECIPE_KEY,
             self._build_recipe_annotation(pipeline.recipe,
                                           pipeline.conn_map))
 
-        self._controller.vistrail.set_action_annotation(
+        self._annotations.set(
             pipeline.version,
             self._PORTMAP_KEY,
             self._build_portmap_annotation(pipeline.port_map))
 
+    def _resolve_recipe_variables(self, varname):
+        """Looks up a variable in the recipes that only refer to it by name.
+        """
+        for version in self._variable_to_versions.get(varname, ()):
+            recipe = self._version_to_pipeline[version].recipe
+            for p_values in recipe.parameters.itervalues():
+                for p in p_values:
+                    if (p.type == RecipeParameterValue.VARIABLE and
+                            p.variable_name == varname):
+                        p.variable  # resolves the DeferredVariable
+
+    @staticmethod
+    def _recipe_variables(recipe):
+        """Returns the set of the names of the variables used by a recipe.
+        """
+        return set(p.variable_name
+                   for p_values in recipe.parameters.itervalues()
+                   for p in p_values
+                   if p.type == RecipeParameterValue.VARIABLE)
+
+    def _set_pipeline(self, pipeline):
+        """Stores a PipelineInformation and indexes the variables it uses.
+        """
+        old = self._version_to_pipeline.get(pipeline.version)
+        if old is not None:
+            for varname in self._recipe_variables(old.recipe):
+                self._variable_to_versions[varname].discard(old.version)
+        self._version_to_pipeline[pipeline.version] = pipeline
+        for varname in self._recipe_variables(pipeline.recipe):
+            self._variable_to_versions.setdefault(varname, set()).add(
+                pipeline.version)
+
+    def _set_cell(self, cellInfo, pipeline):
+        """Records that a cell is displaying the given pipeline.
+        """
+        old_version = self._cell_to_version.get(cellInfo)
+        if old_version is not None:
+            cells = self._version_to_cells[old_version]
+            cells.discard(cellInfo)
+            if not cells:
+                del self._version_to_cells[old_version]
+        self._cell_to_version[cellInfo] = pipeline.version
+        self._cell_to_pipeline[cellInfo] = pipeline
+        self._version_to_cells.setdefault(pipeline.version, set()).add(
+            cellInfo)
+
+    def _forget_pipeline(self, version):
+        """Removes a PipelineInformation and the cells showing it.
+        """
+        pipeline = self._version_to_pipeline.pop(version)
+        for varname in self._recipe_variables(pipeline.recipe):
+            versions = self._variable_to_versions[varname]
+            versions.discard(version)
+            if not versions:
+                del self._variable_to_versions[varname]
+        for cellInfo in self._version_to_cells.pop(version, ()):
+            del self._cell_to_version[cellInfo]
+            del self._cell_to_pipeline[cellInfo]
+
     def _infer_pipelineinfo(self, version, cellInfo):
         """Try to make up a pipelineInfo for a version and store it.
 
@@ -783,7 +1036,7 @@ class VistrailManager(object):
                 warnings.warn("Current controller is not a DAT vistrail:\n"
                               "  %r" % controller)
             else:
-                vistraildata = VistrailData(controller)
+                vistraildata = VistrailData(controller, lazy=True)
                 name = self._make_ctrl_name(controller.name)
                 vistraildata.name = name
                 self._names[name] = vistraildata
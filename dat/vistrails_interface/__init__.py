@@ -3,18 +3,25 @@
 This package contains most of the code that deals with VisTrails pipelines.
 """
 
-from itertools import chain
+import copy
+from itertools import chain, izip
+import time
+import urllib
 import warnings
+import weakref
 
 from PyQt4 import QtCore, QtGui
 
 from dat import BaseVariableLoader, DATRecipe, PipelineInformation, \
     RecipeParameterValue, DEFAULT_VARIABLE_NAME
 from dat.gui import translate
+from dat.utils import file_signature
 from dat.vistrails_interface.pipelines import PipelineGenerator, \
     add_constant_module
 from dat.vistrails_interface.utils import get_upgraded_pipeline, \
-    get_function, walk_modules, find_modules_by_type
+    get_function, walk_modules, find_modules_by_type, get_pipeline_graph, \
+    get_variable_values_disk_cache, variable_value_disk_key, \
+    _materialized_values, _variable_values, _variable_pipelines
 from dat.vistrails_interface.wrappers import Variable, ArgumentWrapper, \
     ConstantPort, add_variable_subworkflow
 
@@ -34,19 +41,46 @@ class CancelExecution(RuntimeError):
     pass
 
 
+_not_cached = object()
+
+
+def _find_output_module(pipeline):
+    """Finds the OutputPort module of a variable's pipeline, or None.
+    """
+    outputport_desc = get_module_registry().get_descriptor_by_name(
+        'org.vistrails.vistrails.basic', 'OutputPort')
+    for module in pipeline.module_list:
+        if (module.module_descriptor is outputport_desc and
+                get_function(module, 'name') == 'value'):
+            return module
+    return None
+
+
 def get_variable_value(variable):
     """Get the value of a variable, i.e. the result of its pipeline.
 
     The 'variable' can either be a Variable, from which a temporary pipeline
     will be built, or a VariableInformation, representing an existing pipeline.
-    """
-    def pipeline_from_info(variableinfo):
-        controller = variableinfo._controller
-        version = controller.vistrail.get_version_number(
-            'dat-var-%s' % variable.name)
-        return controller.vistrail.getPipeline(version), version
 
+    Values are cached, keyed on the version of the variable if it exists in a
+    vistrail, or on the signature of the temporary pipeline otherwise; see
+    invalidate_variable_values(). The returned value is shared and must not be
+    modified.
+
+    If a disk cache directory was set (see set_disk_cache_directory()), values
+    are also kept there, keyed on the signature of the variable's subworkflow,
+    so they are not computed again in a later session.
+    """
     def pipeline_from_generator(variable_gen):
+        # Reuse the pipeline built on a previous call if the variable didn't
+        # change since
+        state = (len(variable_gen._generator.operations),
+                 variable_gen._output_module,
+                 variable_gen._outputport_name)
+        cached = _variable_pipelines.get(variable_gen)
+        if cached is not None and cached[0] == state:
+            return cached[1], 1, cached[2]
+
         # Get the original OutputPort module
         orig_controller = variable_gen._generator.controller
         base_pipeline = orig_controller.vistrail.getPipeline('dat-vars')
@@ -72,23 +106,53 @@ def get_variable_value(variable):
         version = controller.perform_action(action)
         controller.change_selected_version(version)
         assert version == controller.current_version == 1
-        return controller.current_pipeline, 1
+        pipeline = controller.current_pipeline
+        signature = pipeline.subpipeline_signature(output_port.id)
+        _variable_pipelines[variable_gen] = state, pipeline, signature
+        return pipeline, 1, signature
 
     # Obtain 'pipeline' and 'version' from 'variable'
     if isinstance(variable, Variable.VariableInformation):
-        # Pipeline already exists
-        pipeline, version = pipeline_from_info(variable)
+        variableinfo = variable
     elif isinstance(variable, Variable):
-        if variable._materialized is not None:
-            # Pipeline already exists
-            pipeline, version = pipeline_from_info(variable._materialized)
-        else:
-            # Pipeline doesn't exist
-            # We need to make one from the operations
-            pipeline, version = pipeline_from_generator(variable)
+        variableinfo = variable._materialized
     else:
         raise TypeError
 
+    if variableinfo is not None:
+        # Pipeline already exists
+        vistrail = variableinfo._controller.vistrail
+        version = vistrail.get_version_number(
+            'dat-var-%s' % variableinfo.name)
+        cache, key = _materialized_values.get(vistrail, create=True), version
+        try:
+            return cache[key][0]
+        except KeyError:
+            # The interpreter doesn't get the shared pipeline
+            pipeline = copy.copy(get_upgraded_pipeline(vistrail, version))
+    else:
+        # Pipeline doesn't exist
+        # We need to make one from the operations
+        pipeline, version, key = pipeline_from_generator(variable)
+        cache = _variable_values
+        try:
+            return cache[key][0]
+        except KeyError:
+            pass
+
+    output_module = _find_output_module(pipeline)
+
+    # Look in the disk cache
+    disk_cache = get_variable_values_disk_cache()
+    disk_key = None
+    if disk_cache is not None and output_module is not None:
+        disk_key = variable_value_disk_key(pipeline, output_module.id)
+        if disk_key is not None:
+            result = disk_cache.get(disk_key, _not_cached)
+            if result is not _not_cached:
+                cache[key] = result, disk_key
+                return result
+
     # Setup the interpreter for execution
     interpreter = get_default_interpreter()
     interpreter.clean_non_cacheable_modules()
@@ -118,22 +182,178 @@ def get_variable_value(variable):
                          '\n'.join(msg for msg in res[4].itervalues()))
 
     # Get the result
-    outputport_desc = get_module_registry().get_descriptor_by_name(
-        'org.vistrails.vistrails.basic', 'OutputPort')
-    for module in pipeline.module_list:
-        if module.module_descriptor is outputport_desc:
-            if get_function(module, 'name') == 'value':
-                module_obj = tmp_id_to_module_map[module.id]
-                result = module_obj.get_output('ExternalPipe')
-                break
+    if output_module is not None:
+        module_obj = tmp_id_to_module_map[output_module.id]
+        result = module_obj.get_output('ExternalPipe')
     else:
         result = None
 
     interpreter.finalize_pipeline(pipeline, *res[:-1])
     interpreter.parent_execs = [None]
+    if disk_key is not None and not disk_cache.set(disk_key, result):
+        disk_key = None
+    cache[key] = result, disk_key
     return result
 
 
+def _upstream_modules(graph, module_id):
+    """Returns the ids of a module and of every module upstream of it.
+    """
+    upstream = set()
+    open_list = [module_id]
+    while open_list:
+        mod_id = open_list.pop()
+        if mod_id not in upstream:
+            upstream.add(mod_id)
+            open_list.extend(connection.source.moduleId
+                             for connection in graph.incoming(mod_id))
+    return upstream
+
+
+def _variable_value_disk_key(variable):
+    """Computes the disk key of a materialized variable's value, or None.
+
+    This is the key get_variable_value() stores the value under.
+    """
+    vistrail = variable._controller.vistrail
+    version = vistrail.get_version_number('dat-var-%s' % variable.name)
+    pipeline = get_upgraded_pipeline(vistrail, version)
+    output_module = _find_output_module(pipeline)
+    if output_module is None:
+        return None
+    return variable_value_disk_key(pipeline, output_module.id)
+
+
+def _find_cached_value_candidates(pipelineInfo, pipeline):
+    """Finds the variable subworkflows that could read their value from disk.
+
+    Returns a dict mapping the id of the output module of each subworkflow to
+    (disk key, source port, [connection id], [upstream module id]); see
+    use_cached_values(). The disk cache itself is not accessed.
+    """
+    graph = get_pipeline_graph(pipeline)
+
+    # The connections of each parameter to the subworkflow it uses
+    # source module id -> set([connection id])
+    source_conn_ids = dict()
+    for conn_lists in pipelineInfo.conn_map.itervalues():
+        for conn_ids in conn_lists:
+            for conn_id in conn_ids:
+                if conn_id in pipeline.connections:
+                    source_conn_ids.setdefault(
+                        pipeline.connections[conn_id].source.moduleId,
+                        set()).add(conn_id)
+
+    candidates = dict()
+    for param, values in pipelineInfo.recipe.parameters.iteritems():
+        conn_lists = pipelineInfo.conn_map.get(param, ())
+        for value, conn_ids in izip(values, conn_lists):
+            if (value.type != RecipeParameterValue.VARIABLE or
+                    value.typecast is not None or
+                    not all(conn_id in pipeline.connections
+                            for conn_id in conn_ids)):
+                continue
+            sources = set((pipeline.connections[conn_id].source.moduleId,
+                           pipeline.connections[conn_id].source.name)
+                          for conn_id in conn_ids)
+            if len(sources) != 1:
+                continue
+            (source_id, source_port), = sources
+            if source_id in candidates:
+                continue  # Variable used by several parameters
+
+            # The subworkflow must only be connected to the plot through the
+            # connections of the parameters using it
+            allowed = source_conn_ids[source_id]
+            upstream = _upstream_modules(graph, source_id)
+            if any(conn.destination.moduleId not in upstream and
+                   conn.id not in allowed
+                   for mod_id in upstream
+                   for conn in graph.outgoing(mod_id)):
+                continue
+
+            disk_key = _variable_value_disk_key(value.variable)
+            if disk_key is None:
+                continue
+            candidates[source_id] = (disk_key, source_port,
+                                     sorted(allowed), sorted(upstream))
+    return candidates
+
+
+def _replace_with_cached_values(controller, pipeline, replacements):
+    """Replaces variable subworkflows with modules reading the disk cache.
+
+    The pipeline is modified; it must be a copy. replacements is a dict
+    returned by _find_cached_value_candidates().
+    """
+    source_desc = get_module_registry().get_descriptor_by_name(
+        'org.vistrails.vistrails.basic', 'PythonSource')
+    for source_id, (disk_key, source_port, conn_ids, upstream) in (
+            replacements.iteritems()):
+        source = pipeline.modules[source_id]
+        connections = [pipeline.connections[conn_id] for conn_id in conn_ids]
+        module = controller.create_module_from_descriptor(source_desc)
+        module.id = source_id
+        module.add_port_spec(controller.create_port_spec(
+            module, 'output', 'value',
+            source.get_port_spec(source_port, 'output').sigstring))
+        code = ('from dat.vistrails_interface.utils import '
+                'read_cached_variable_value\n'
+                'value = read_cached_variable_value(%r)\n'
+                'cache_this()\n' % disk_key)
+        module.add_function(controller.create_function(
+            module, 'source', [urllib.quote(code)]))
+
+        # Also deletes their connections, including those to the plot
+        for mod_id in upstream:
+            pipeline.delete_module(mod_id)
+        pipeline.add_module(module)
+        for conn in connections:
+            new_conn = controller.create_connection(
+                module, 'value',
+                pipeline.modules[conn.destination.moduleId],
+                conn.destination.name)
+            new_conn.id = conn.id
+            pipeline.add_connection(new_conn)
+    # Drops the signatures computed for the original pipeline
+    pipeline.set_defaults()
+
+
+def use_cached_values(controller, pipelineInfo, pipeline):
+    """Makes a plot pipeline read its variables from the disk cache.
+
+    Each plot pipeline has its own copy of the subworkflows of its variables,
+    which the interpreter runs again in every session. If a disk cache
+    directory was set (see set_disk_cache_directory()), this returns a copy
+    of the pipeline where the subworkflow of each variable whose value is
+    already in the disk cache is replaced by a single module reading it, so
+    that a variable is only loaded once for every cell, and not again in
+    later sessions. Nothing gets computed here.
+
+    The module reading the value and its connections get the ids of the
+    subworkflow's output module and connections, so the execution is logged
+    against modules of the recorded version.
+
+    Variables used through a typecast, whose value is not on disk, or whose
+    subworkflow is also connected to other modules are left as they are. The
+    given pipeline is returned if no variable was replaced.
+    """
+    disk_cache = get_variable_values_disk_cache()
+    if disk_cache is None:
+        return pipeline
+    replacements = dict(
+        (source_id, candidate)
+        for source_id, candidate in _find_cached_value_candidates(
+            pipelineInfo, pipeline).iteritems()
+        if candidate[0] in disk_cache)
+    if not replacements:
+        return pipeline
+
+    pipeline = copy.copy(pipeline)
+    _replace_with_cached_values(controller, pipeline, replacements)
+    return pipeline
+
+
 def call_operation_callback(op, callback, args):
     """Call a VariableOperation callback to build a new Variable.
 
@@ -154,6 +374,102 @@ def call_operation_callback(op, callback, args):
     return result
 
 
+class OperationTemplate(object):
+    """An operation subworkflow, read once and ready to be copied.
+
+    This holds everything apply_operation_subworkflow() needs from the XML
+    file: the modules to copy (everything but the InputPorts and the
+    OutputPort), the connections between them, the (module id, port name)
+    pairs each parameter is connected to, and the output port.
+    """
+    def __init__(self, subworkflow):
+        reg = get_module_registry()
+        inputport_desc = reg.get_descriptor_by_name(
+            'org.vistrails.vistrails.basic', 'InputPort')
+        outputport_desc = reg.get_descriptor_by_name(
+            'org.vistrails.vistrails.basic', 'OutputPort')
+
+        locator = XMLFileLocator(subworkflow)
+        vistrail = locator.load()
+        pipeline = get_upgraded_pipeline(vistrail)
+
+        self.modules = [module
+                        for module in pipeline.modules.itervalues()
+                        if module.module_descriptor not in (inputport_desc,
+                                                            outputport_desc)]
+
+        # [(src_id, src_port, dest_id, dest_port)]
+        self.connections = []
+        # param name -> [(module id, input port name)]
+        self.parameters = dict()
+        # (module id, port name)
+        self.output = None
+        for connection in pipeline.connection_list:
+            src = pipeline.modules[connection.source.moduleId]
+            dest = pipeline.modules[connection.destination.moduleId]
+            if src.module_descriptor is inputport_desc:
+                param = get_function(src, 'name')
+                ports = self.parameters.setdefault(param, [])
+                ports.append((connection.destination.moduleId,
+                              connection.destination.name))
+            elif dest.module_descriptor is outputport_desc:
+                self.output = (connection.source.moduleId,
+                               connection.source.name)
+            else:
+                self.connections.append((connection.source.moduleId,
+                                         connection.source.name,
+                                         connection.destination.moduleId,
+                                         connection.destination.name))
+
+    def instantiate(self, generator):
+        """Copies the subworkflow into the generator, with fresh ids.
+
+        Returns (params, output) where params maps each parameter name to a
+        list of (module, input port name) and output is the (module, port
+        name) of the result, with the newly created modules.
+        """
+        modules_map = dict()  # old module id -> new module
+        for module in self.modules:
+            modules_map[module.id] = generator.copy_module(module)
+
+        for src_id, src_port, dest_id, dest_port in self.connections:
+            generator.connect_modules(
+                modules_map[src_id], src_port,
+                modules_map[dest_id], dest_port)
+
+        params = dict()
+        for param, ports in self.parameters.iteritems():
+            params[param] = [(modules_map[mod_id], port)
+                             for mod_id, port in ports]
+        if self.output is not None:
+            output = (modules_map[self.output[0]], self.output[1])
+        else:
+            output = None
+        return params, output
+
+
+# VariableOperation -> (subworkflow, file signature, OperationTemplate)
+_operation_templates = weakref.WeakKeyDictionary()
+
+
+def get_operation_template(op, subworkflow):
+    """Gets the OperationTemplate for an operation's subworkflow.
+
+    It is only built again if the file changed.
+    """
+    signature = file_signature(subworkflow)
+    try:
+        filename, old_signature, template = _operation_templates[op]
+    except KeyError:
+        pass
+    else:
+        if filename == subworkflow and old_signature == signature:
+            return template
+    template = OperationTemplate(subworkflow)
+    _operation_templates[op] = subworkflow, signature, template
+    return template
+
+
 def apply_operation_subworkflow(controller, op, subworkflow, args):
     """Load an operation subworkflow from a file to build a new Variable.
 
@@ -163,46 +479,11 @@ def apply_operation_subworkflow(controller, op, subworkflow, args):
     will be connected in place of the operation subworkflow's InputPort
     modules.
     """
-    reg = get_module_registry()
-    inputport_desc = reg.get_descriptor_by_name(
-        'org.vistrails.vistrails.basic', 'InputPort')
-    outputport_desc = reg.get_descriptor_by_name(
-        'org.vistrails.vistrails.basic', 'OutputPort')
-
     generator = PipelineGenerator(controller)
 
     # Add the operation subworkflow
-    locator = XMLFileLocator(subworkflow)
-    vistrail = locator.load()
-    operation_pipeline = get_upgraded_pipeline(vistrail)
-
-    # Copy every module but the InputPorts and the OutputPort
-    operation_modules_map = dict()  # old module id -> new module
-    for module in operation_pipeline.modules.itervalues():
-        if module.module_descriptor not in (inputport_desc, outputport_desc):
-            operation_modules_map[module.id] = generator.copy_module(module)
-
-    # Copy the connections and locate the input ports and the output port
-    operation_params = dict()  # param name -> [(module, input port name)]
-    output = None  # (module, port name)
-    for connection in operation_pipeline.connection_list:
-        src = operation_pipeline.modules[connection.source.moduleId]
-        dest = operation_pipeline.modules[connection.destination.moduleId]
-        if src.module_descriptor is inputport_desc:
-            param = get_function(src, 'name')
-            ports = operation_params.setdefault(param, [])
-            ports.append((
-                operation_modules_map[connection.destination.moduleId],
-                connection.destination.name))
-        elif dest.module_descriptor is outputport_desc:
-            output = (operation_modules_map[connection.source.moduleId],
-                      connection.source.name)
-        else:
-            generator.connect_modules(
-                operation_modules_map[connection.source.moduleId],
-                connection.source.name,
-                operation_modules_map[connection.destination.moduleId],
-                connection.destination.name)
+    operation_params, output = get_operation_template(
+        op, subworkflow).instantiate(generator)
 
     # Add the parameter subworkflows
     for i in xrange(len(args)):
@@ -469,9 +750,9 @@ def get_pipeline_location(controller, pipelineInfo):
     if len(sheetref_modules) != 1:
         raise ValueError
     ref = sheetref_modules[0]
-    for connection in pipeline.connection_list:
+    for connection in get_pipeline_graph(pipeline).incoming(ref.id):
         src = pipeline.modules[connection.source.moduleId]
-        if connection.destination.moduleId == ref.id and src.is_vistrail_var():
+        if src.is_vistrail_var():
             var_uuid = src.get_vistrail_var()
             sheetname_var = controller.get_vistrail_variable_by_uuid(var_uuid)
             return row, col, sheetname_var
@@ -500,13 +781,36 @@ def get_plot_modules(pipelineInfo, pipeline):
     return modules
 
 
+def _variable_subworkflow_key(variable, expected_type, cast):
+    if not cast:
+        return variable.name, None
+    return variable.name, (expected_type.identifier,
+                           expected_type.name,
+                           expected_type.namespace)
+
+
 def add_variable_subworkflow_typecast(generator, variable, plot_ports,
-                                      expected_type, typecast):
-    if issubclass(variable.type.module, expected_type.module):
-        return (add_variable_subworkflow(generator,
-                                         variable.name,
-                                         plot_ports),
-                RecipeParameterValue(variable=variable))
+                                      expected_type, typecast,
+                                      subworkflows=None):
+    """Adds a variable subworkflow, typecasting it if needed.
+
+    Returns the ids of the connections tying it to plot_ports, and the
+    RecipeParameterValue that was actually used.
+
+    subworkflows is an optional dictionary used to share the variable
+    subworkflows of a pipeline: it maps a (variable name, cast type) key to
+    the (module, port_name, typecast name) output of a subworkflow that is
+    already in the generated pipeline. Such a subworkflow is connected again
+    instead of being copied; new subworkflows are recorded.
+    """
+    cast = not issubclass(variable.type.module, expected_type.module)
+    key = _variable_subworkflow_key(variable, expected_type, cast)
+    if subworkflows is not None and key in subworkflows:
+        output_module, output_port, typecast_name = subworkflows[key]
+    elif not cast:
+        output_module, output_port = add_variable_subworkflow(generator,
+                                                              variable.name)
+        typecast_name = None
     else:
         # Load the variable from the workflow
         var_pipeline = Variable.from_workflow(variable)
@@ -517,19 +821,21 @@ def add_variable_subworkflow_typecast(generator, variable, plot_ports,
             variable.type, expected_type)
 
         generator.append_operations(var_pipeline._generator.operations)
-        if plot_ports:
-            connection_ids = []
-            for var_output_mod, var_output_port in plot_ports:
-                connection_ids.append(generator.connect_modules(
-                    var_pipeline._output_module,
-                    var_pipeline._outputport_name,
-                    var_output_mod,
-                    var_output_port))
-            return connection_ids, RecipeParameterValue(
-                variable=variable,
-                typecast=typecast_operation.name)
-        else:
-            return (var_pipeline._output_module, var_pipeline._outputport_name)
+        output_module = var_pipeline._output_module
+        output_port = var_pipeline._outputport_name
+        typecast_name = typecast_operation.name
+    if subworkflows is not None:
+        subworkflows[key] = output_module, output_port, typecast_name
+
+    connection_ids = []
+    for var_output_mod, var_output_port in plot_ports:
+        connection_ids.append(generator.connect_modules(
+            output_module,
+            output_port,
+            var_output_mod,
+            var_output_port))
+    return connection_ids, RecipeParameterValue(variable=variable,
+                                                typecast=typecast_name)
 
 
 def create_pipeline(controller, recipe, row, column, var_sheetname,
@@ -686,6 +992,8 @@ def create_pipeline(controller, recipe, row, column, var_sheetname,
 
     name_to_port = {port.name: port for port in recipe.plot.ports}
     actual_parameters = {}
+    # A variable used several times is only added once
+    subworkflows = dict()  # (varname, cast type) -> (module, port, typecast)
     for port_name, parameters in parameters_incl_defaults.iteritems():
         plot_ports = plot_params.get(port_name, [])
         p_conns = conn_map[port_name] = []
@@ -697,7 +1005,8 @@ def create_pipeline(controller, recipe, row, column, var_sheetname,
                     parameter.variable,
                     plot_ports,
                     name_to_port[port_name].type,
-                    typecast=typecast)
+                    typecast=typecast,
+                    subworkflows=subworkflows)
                 p_conns.append(conns)
                 actual_values.append(actual_param)
             else:  # parameter.type == RecipeParameterValue.CONSTANT
@@ -765,6 +1074,24 @@ def update_pipeline(controller, pipelineInfo, new_recipe, typecast=None):
     removed_params = []
 
     name_to_port = {port.name: port for port in new_recipe.plot.ports}
+
+    # The variable subworkflows already in the pipeline can be shared by the
+    # new parameters
+    subworkflows = dict()  # (varname, cast type) -> (module, port, typecast)
+    for port_name, parameters in old_recipe.parameters.iteritems():
+        for param, conns in izip(parameters,
+                                 pipelineInfo.conn_map[port_name]):
+            if param.type == RecipeParameterValue.VARIABLE and conns:
+                source = pipeline.connections[conns[0]].source
+                key = _variable_subworkflow_key(
+                    param.variable,
+                    name_to_port[port_name].type,
+                    param.typecast is not None)
+                subworkflows[key] = (pipeline.modules[source.moduleId],
+                                     source.name,
+                                     param.typecast)
+
+    removed_conns = []  # [[conn_id: int]]
     actual_parameters = {}
     for port_name in (set(old_recipe.parameters.iterkeys()) |
                       set(new_recipe.parameters.iterkeys())):
@@ -802,7 +1129,8 @@ def update_pipeline(controller, pipelineInfo, new_recipe, typecast=None):
                     param.variable,
                     plot_ports,
                     name_to_port[port_name].type,
-                    typecast=typecast)
+                    typecast=typecast,
+                    subworkflows=subworkflows)
                 conn_lists.append(conns)
                 actual_values.append(actual_param)
             else:  # param.type == RecipeParameterValue.CONSTANT:
@@ -820,19 +1148,40 @@ def update_pipeline(controller, pipelineInfo, new_recipe, typecast=None):
         # If they haven't been removed by the previous loop, that means that
         # there were more of them in the old recipe
         for conn_lists in old_params.itervalues():
-            for connections in conn_lists:
-                # Remove the variable subworkflow
-                modules = set(
-                    pipeline.modules[pipeline.connections[c].source.moduleId]
-                    for c in connections)
-                generator.delete_linked(
-                    modules,
-                    connection_filter=lambda c: c.id not in connections)
-
-                removed_params.append(port_name)
+            removed_conns.extend(conn_lists)
+            removed_params.extend(port_name for c in conn_lists)
 
         actual_parameters[port_name] = actual_values
 
+    if removed_conns:
+        # Subworkflows still connected to the plot are kept, only the
+        # connections are removed
+        used = set(generator.get_connection(conn_id).source.moduleId
+                   for conn_lists in conn_map.itervalues()
+                   for conns in conn_lists
+                   for conn_id in conns)
+        unused = set()
+        for conns in removed_conns:
+            sources = set(pipeline.connections[c].source.moduleId
+                          for c in conns)
+            if sources & used:
+                generator.delete_connections(
+                    pipeline.connections[c] for c in conns)
+            else:
+                unused.update(pipeline.modules[mod_id] for mod_id in sources)
+
+        # Remove the other variable subworkflows, without following the
+        # connections into the plot
+        if unused:
+            plot_conns = set(
+                conn_id
+                for conn_lists in pipelineInfo.conn_map.itervalues()
+                for conns in conn_lists
+                for conn_id in conns)
+            generator.delete_linked(
+                unused,
+                connection_filter=lambda c: c.id not in plot_conns)
+
     # We didn't find anything to change
     if not (added_params or removed_params):
         return pipelineInfo
@@ -944,25 +1293,39 @@ def execute_pipeline(controller, pipeline,
     progress.hide()
     progress.deleteLater()
 
-    if not results[0].errors:
+    return execution_error(results[0])
+
+
+def execution_error(result):
+    """Gets the error message from the result of an execution.
+
+    Returns None if no module failed.
+    """
+    if not result.errors:
         return None
     else:
-        module_id, error = next(results[0].errors.iteritems())
-        return str(error)
+        return str(next(result.errors.itervalues()))
 
 
 MISSING_PARAMS = object()
 
 
+def recipe_is_complete(recipe):
+    """Indicates whether all the mandatory ports of the plot are set.
+    """
+    return all(
+        port.optional or port.name in recipe.parameters
+        for port in recipe.plot.ports)
+
+
 def try_execute(controller, pipelineInfo):
     recipe = pipelineInfo.recipe
 
-    if all(
-            port.optional or port.name in recipe.parameters
-            for port in recipe.plot.ports):
+    if recipe_is_complete(recipe):
         # Get the pipeline
         controller.change_selected_version(pipelineInfo.version)
-        pipeline = controller.current_pipeline
+        pipeline = use_cached_values(controller, pipelineInfo,
+                                     controller.current_pipeline)
 
         # Execute the new pipeline
         error = execute_pipeline(
@@ -974,3 +1337,170 @@ def try_execute(controller, pipelineInfo):
         return error
     else:
         return MISSING_PARAMS
+
+
+class _TimingView(DummyView):
+    """A view recording when it was last told about a module's status.
+    """
+    last_event = None
+
+    def _event(self):
+        self.last_event = time.time()
+
+    def set_module_active(self, *args, **kwargs):
+        self._event()
+        return DummyView.set_module_active(self, *args, **kwargs)
+
+    def set_module_success(self, *args, **kwargs):
+        self._event()
+        return DummyView.set_module_success(self, *args, **kwargs)
+
+    def set_module_error(self, *args, **kwargs):
+        self._event()
+        return DummyView.set_module_error(self, *args, **kwargs)
+
+
+class PipelineToExecute(object):
+    """Gets the Pipeline object to execute for a DAT pipeline.
+
+    Variables are read from the disk cache where possible, see
+    use_cached_values(). The pipeline is never the shared one returned by
+    get_upgraded_pipeline(), so the interpreter can't corrupt the cache.
+
+    This is done in three steps, so that the slow ones can run off the GUI
+    thread. The constructor and finish() use the controller and the shared
+    caches, and have to be called from the GUI thread. copy() copies the
+    pipeline and looks for the values in the disk cache; it only uses what the
+    constructor got, and can be called from any thread.
+
+    The variables whose value is not on disk yet are computed by their
+    subworkflow; once the pipeline has been executed, store_values() writes
+    these values to the disk cache, so the next executions read them.
+    """
+    def __init__(self, controller, pipelineInfo):
+        self.pipelineInfo = pipelineInfo
+        self._shared = get_upgraded_pipeline(controller.vistrail,
+                                             pipelineInfo.version)
+        if get_variable_values_disk_cache() is None:
+            self._candidates = {}
+        else:
+            self._candidates = _find_cached_value_candidates(pipelineInfo,
+                                                             self._shared)
+        self._pipeline = None
+        self._replacements = None
+        # [(module id, output port, disk key)], see store_variable_values()
+        self.stores = []
+
+    def copy(self):
+        disk_cache = get_variable_values_disk_cache()
+        self._replacements = dict()
+        self.stores = []
+        for source_id, candidate in self._candidates.iteritems():
+            disk_key, source_port = candidate[:2]
+            if disk_cache is not None and disk_key in disk_cache:
+                self._replacements[source_id] = candidate
+            else:
+                self.stores.append((source_id, source_port, disk_key))
+        self._pipeline = copy.copy(self._shared)
+
+    def finish(self, controller):
+        """Returns the pipeline to execute.
+        """
+        if self._pipeline is None:
+            self.copy()
+        if self._replacements:
+            _replace_with_cached_values(controller, self._pipeline,
+                                        self._replacements)
+            self._replacements = None
+        return self._pipeline
+
+    def store_values(self, result):
+        """Writes the variable values computed by the execution to disk.
+
+        result is what the interpreter returned for the pipeline from
+        finish().
+        """
+        store_variable_values(self.stores, result)
+
+
+def store_variable_values(stores, result):
+    """Writes the values of variables computed by an execution to disk.
+
+    stores is a list of (module id, output port, disk key), as in
+    PipelineToExecute.stores, and result what the interpreter returned. The
+    value of each output port is stored under the key get_variable_value()
+    would use, if the module was executed successfully.
+    """
+    disk_cache = get_variable_values_disk_cache()
+    if disk_cache is None:
+        return
+    for module_id, port_name, disk_key in stores:
+        if module_id in result.errors or disk_key in disk_cache:
+            continue
+        module_obj = result.objects.get(module_id)
+        if module_obj is None or port_name not in module_obj.outputPorts:
+            continue
+        disk_cache.set(disk_key, module_obj.get_output(port_name))
+
+
+def get_pipeline_to_execute(controller, pipelineInfo):
+    """Gets the Pipeline object to execute for a DAT pipeline.
+
+    This does all the steps of PipelineToExecute at once.
+    """
+    return PipelineToExecute(controller, pipelineInfo).finish(controller)
+
+
+def execute_pipelines(controller, pipelineInfos, reason, **kwargs):
+    """Executes DAT pipelines in a single batch, without any GUI.
+
+    All the pipelines go through one execute_workflow_list() call, so that
+    upstream modules they share are only run once. Pipelines whose recipe
+    misses mandatory parameters are not executed.
+
+    The pipelines are obtained from PipelineToExecute, and the variable
+    values they compute are written to the disk cache.
+
+    Returns a list of (pipelineInfo, error, seconds) in the same order, where
+    error is None, MISSING_PARAMS or an error message. The time of each
+    pipeline is measured from the last module event of the previous one.
+    """
+    outcomes = [(pipelineInfo, MISSING_PARAMS, 0.0)
+                for pipelineInfo in pipelineInfos]
+    jobs = []
+    workflows = []
+    for i, pipelineInfo in enumerate(pipelineInfos):
+        if not recipe_is_complete(pipelineInfo.recipe):
+            continue
+        workflow = PipelineToExecute(controller, pipelineInfo)
+        pipeline = workflow.finish(controller)
+        view = _TimingView()
+        jobs.append((i, view, workflow))
+        workflows.append((
+            controller.locator,     # locator
+            pipelineInfo.version,   # version
+            pipeline,               # pipeline
+            view,                   # view
+            None,                   # custom_aliases
+            None,                   # custom_params
+            reason,                 # reason
+            None,                   # sinks
+            kwargs))                # extra_info
+
+    start = time.time()
+    if workflows:
+        results, changed = controller.execute_workflow_list(workflows)
+    else:
+        results = []
+
+    previous = start
+    for (i, view, workflow), result in izip(jobs, results):
+        workflow.store_values(result)
+        if view.last_event is not None:
+            seconds = view.last_event - previous
+            previous = view.last_event
+        else:
+            seconds = 0.0
+        outcomes[i] = pipelineInfos[i], execution_error(result), seconds
+
+    return outcomes
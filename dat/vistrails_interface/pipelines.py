@@ -1,6 +1,9 @@
 """Pipeline-generation code.
 """
 
+from collections import OrderedDict
+
+from dat import PipelineInformation
 from dat.vistrails_interface.utils import delete_linked
 
 from vistrails.core.db.action import create_action
@@ -9,31 +12,115 @@ from vistrails.core.vistrail.connection import Connection
 from vistrails.core.vistrail.module import Module as PipelineModule
 
 
+# Default minimum distance between the centers of new and existing modules
+LAYOUT_MARGIN = 200.0
+
+
 class PipelineGenerator(object):
     """A wrapper for simple operations that keeps a list of all modules.
 
     This wraps simple operations on the pipeline and keeps the list of
-    VisTrails ops internally. It also keeps a list of all modules needed by
-    VisTrails's layout function.
+    VisTrails ops internally. It also keeps track of the modules and
+    connections that are added and deleted, by id, as needed by VisTrails's
+    layout function; the existing pipeline is not scanned until the action is
+    performed.
     """
     def __init__(self, controller):
         self.controller = controller
         self._version = controller.current_version
         self.operations = []
-        self.all_modules = set(controller.current_pipeline.module_list)
-        self.all_connections = set(controller.current_pipeline.connection_list)
+        # id -> module or connection, in the order they were added
+        self._added_modules = OrderedDict()
+        self._added_connections = OrderedDict()
+        # ids of modules and connections from the pipeline that are deleted
+        self._deleted_modules = set()
+        self._deleted_connections = set()
+        # id -> module or connection of the pipeline being built, existing
+        # and added; filled in the first time all_modules or all_connections
+        # is used, then kept up to date by _record()
+        self._all_modules = None
+        self._all_connections = None
 
     def _ensure_version(self):
         if self.controller.current_version != self._version:
             self.controller.change_selected_version(self._version)
 
-    def append_operations(self, operations):
+    def _record(self, operations):
+        """Updates the added and deleted modules and connections.
+        """
         for op in operations:
             if op[0] == 'add':
                 if isinstance(op[1], PipelineModule):
-                    self.all_modules.add(op[1])
+                    self._added_modules[op[1].id] = op[1]
+                    if self._all_modules is not None:
+                        self._all_modules[op[1].id] = op[1]
                 elif isinstance(op[1], Connection):
-                    self.all_connections.add(op[1])
+                    self._added_connections[op[1].id] = op[1]
+                    if self._all_connections is not None:
+                        self._all_connections[op[1].id] = op[1]
+            elif op[0] == 'delete':
+                if isinstance(op[1], PipelineModule):
+                    if self._added_modules.pop(op[1].id, None) is None:
+                        self._deleted_modules.add(op[1].id)
+                    if self._all_modules is not None:
+                        self._all_modules.pop(op[1].id, None)
+                elif isinstance(op[1], Connection):
+                    if self._added_connections.pop(op[1].id, None) is None:
+                        self._deleted_connections.add(op[1].id)
+                    if self._all_connections is not None:
+                        self._all_connections.pop(op[1].id, None)
+
+    @property
+    def all_modules(self):
+        """The modules of the pipeline being built, existing and added.
+
+        This is a view that is kept up to date as the pipeline is changed.
+        """
+        if self._all_modules is None:
+            self._ensure_version()
+            self._all_modules = dict(
+                (m.id, m)
+                for m in self.controller.current_pipeline.module_list
+                if m.id not in self._deleted_modules)
+            self._all_modules.update(self._added_modules)
+        return self._all_modules.viewvalues()
+
+    @property
+    def all_connections(self):
+        """The connections of the pipeline being built, existing and added.
+
+        This is a view that is kept up to date as the pipeline is changed.
+        """
+        if self._all_connections is None:
+            self._ensure_version()
+            self._all_connections = dict(
+                (c.id, c)
+                for c in self.controller.current_pipeline.connection_list
+                if c.id not in self._deleted_connections)
+            self._all_connections.update(self._added_connections)
+        return self._all_connections.viewvalues()
+
+    def get_connection(self, conn_id):
+        """Gets a connection, either added or from the existing pipeline.
+        """
+        try:
+            return self._added_connections[conn_id]
+        except KeyError:
+            self._ensure_version()
+            return self.controller.current_pipeline.connections[conn_id]
+
+    def append_operations(self, operations):
+        """Appends the operations of another generator.
+
+        Operations that this generator already has (the very same objects,
+        copied from a Variable used several times) are skipped, so that a
+        shared subworkflow is only added once.
+        """
+        existing = set(id(op) for op in self.operations)
+        self._append([op for op in operations if id(op) not in existing])
+
+    def _append(self, operations):
+        self._record(operations)
         self.operations.extend(operations)
 
     def copy_module(self, module):
@@ -42,21 +129,18 @@ class PipelineGenerator(object):
         Returns the new module (that is not yet created in the vistrail!)
         """
         module = module.do_copy(True, self.controller.vistrail.idScope, {})
-        self.operations.append(('add', module))
-        self.all_modules.add(module)
+        self.add_module(module)
         return module
 
     def add_module(self, module):
-        self.operations.append(('add', module))
-        self.all_modules.add(module)
+        self._append([('add', module)])
 
     def connect_modules(self, src_mod, src_port, dest_mod, dest_port):
         self._ensure_version()
         new_conn = self.controller.create_connection(
             src_mod, src_port,
             dest_mod, dest_port)
-        self.operations.append(('add', new_conn))
-        self.all_connections.add(new_conn)
+        self._append([('add', new_conn)])
         return new_conn.id
 
     def connect_var(self, vt_var, dest_module, dest_portname):
@@ -73,14 +157,14 @@ class PipelineGenerator(object):
                 var_type_desc,
                 x, y,
                 vt_var.uuid)
-            self.operations.append(('add', var_module))
+            self._append([('add', var_module)])
         elif self.controller.check_vistrail_var_connected(var_module,
                                                           dest_module,
                                                           dest_portname):
             return
         connection = self.controller.create_connection(
             var_module, 'value', dest_module, dest_portname)
-        self.operations.append(('add', connection))
+        self._append([('add', connection)])
 
     def update_function(self, module, portname, values):
         self._ensure_version()
@@ -91,48 +175,136 @@ class PipelineGenerator(object):
         """Wrapper for delete_linked().
 
         This calls delete_linked with the controller and list of operations,
-        and updates the internal list of all modules to be layout.
+        and records the deleted modules and connections.
         """
         self._ensure_version()
-        deleted_ids = delete_linked(
+        first = len(self.operations)
+        delete_linked(
             self.controller, modules, self.operations, **kwargs)
-        self.all_modules = set(
-            m
-            for m in self.all_modules
-            if m.id not in deleted_ids)
-        self.all_connections = set(
-            c
-            for c in self.all_connections
-            if (c.source.moduleId not in deleted_ids and
-                c.destination.moduleId not in deleted_ids))
+        self._record(self.operations[first:])
+        # Added connections to deleted modules are not laid out
+        for conn_id, conn in self._added_connections.items():
+            if (conn.source.moduleId in self._deleted_modules or
+                    conn.destination.moduleId in self._deleted_modules):
+                del self._added_connections[conn_id]
+                if self._all_connections is not None:
+                    self._all_connections.pop(conn_id, None)
+
+    def delete_connections(self, connections):
+        """Deletes connections, leaving the modules in place.
+        """
+        self._ensure_version()
+        self._append([('delete', conn) for conn in set(connections)])
 
     def delete_modules(self, modules):
         self.delete_linked(modules, depth=0)
 
-    def perform_action(self):
-        """Layout all the modules and create the action.
+    def perform_action(self, margin=LAYOUT_MARGIN):
+        """Layout the new modules and create the action.
+
+        Only the added modules are laid out, among themselves, then placed at
+        the height of the existing modules they are connected to, and moved
+        to the right of the existing modules if they would come closer than
+        margin to them. The existing modules keep their positions; use
+        relayout_pipeline() to lay out a whole pipeline again.
         """
         self._ensure_version()
 
-        pipeline = self.controller.current_pipeline
+        if self._added_modules:
+            pipeline = self.controller.current_pipeline
+
+            # Existing modules connected to the new ones
+            neighbors = set()
+            new_connections = []
+            for conn in self._added_connections.itervalues():
+                outside = [mod_id
+                           for mod_id in (conn.source.moduleId,
+                                          conn.destination.moduleId)
+                           if mod_id not in self._added_modules]
+                if outside:
+                    neighbors.update(mod_id
+                                     for mod_id in outside
+                                     if mod_id in pipeline.modules)
+                else:
+                    new_connections.append(conn)
 
-        self.operations.extend(self.controller.layout_modules_ops(
-            old_modules=[m
-                         for m in self.all_modules
-                         if m.id in pipeline.modules],
-            new_modules=[m
-                         for m in self.all_modules
-                         if m.id not in pipeline.modules],
-            new_connections=[c
-                             for c in self.all_connections
-                             if c.id not in pipeline.connections],
-            preserve_order=True))
+            # No existing module is given, so none of them gets moved
+            self.operations.extend(self.controller.layout_modules_ops(
+                new_modules=self._added_modules.values(),
+                new_connections=new_connections,
+                preserve_order=True))
+            _place_beside(
+                self._added_modules.values(),
+                [module
+                 for mod_id, module in pipeline.modules.iteritems()
+                 if mod_id not in self._deleted_modules],
+                [pipeline.modules[mod_id] for mod_id in neighbors],
+                margin)
 
         action = create_action(self.operations)
         self.controller.add_new_action(action)
         return self.controller.perform_action(action)
 
 
+def relayout_pipeline(controller, pipelineInfo, description=None):
+    """Lays out every module of a pipeline again, creating a new version.
+
+    PipelineGenerator only positions the modules it adds, so pipelines that
+    were updated many times can be tidied up with this. Returns the
+    PipelineInformation of the new version, which should be recorded with
+    VistrailData#created_pipeline().
+    """
+    controller.change_selected_version(pipelineInfo.version)
+    operations = controller.layout_modules_ops(
+        old_modules=controller.current_pipeline.module_list,
+        full=True,
+        preserve_order=True)
+    action = create_action(operations)
+    controller.add_new_action(action)
+    new_version = controller.perform_action(action)
+    if description is not None:
+        controller.vistrail.change_description(description, new_version)
+    # Modules are only moved, so the ids are the same
+    return PipelineInformation(new_version,
+                               pipelineInfo.recipe,
+                               pipelineInfo.conn_map,
+                               pipelineInfo.port_map)
+
+
+def _bounding_box(modules):
+    xs = [module.location.x for module in modules]
+    ys = [module.location.y for module in modules]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _place_beside(new_modules, existing_modules, neighbors, margin):
+    """Moves new modules next to their neighbors, clear of existing modules.
+
+    Their layout is kept; they are only translated. They are centered
+    vertically on the existing modules they are connected to, then moved to
+    the right of the existing modules if they overlap them.
+    """
+    if not new_modules or not existing_modules:
+        return
+    new_min_x, new_min_y, new_max_x, new_max_y = _bounding_box(new_modules)
+    if neighbors:
+        nb_min_x, nb_min_y, nb_max_x, nb_max_y = _bounding_box(neighbors)
+        offset = (nb_min_y + nb_max_y - new_min_y - new_max_y) / 2.0
+        for module in new_modules:
+            module.location.y += offset
+        new_min_y += offset
+        new_max_y += offset
+    ex_min_x, ex_min_y, ex_max_x, ex_max_y = _bounding_box(existing_modules)
+    if (new_min_x > ex_max_x + margin or
+            new_max_x < ex_min_x - margin or
+            new_min_y > ex_max_y + margin or
+            new_max_y < ex_min_y - margin):
+        return
+    offset = ex_max_x + margin - new_min_x
+    for module in new_modules:
+        module.location.x += offset
+
+
 def add_constant_module(generator, descriptor, constant, plot_ports):
     module = generator.controller.create_module_from_descriptor(descriptor)
     generator.add_module(module)
@@ -1,14 +1,25 @@
 """General low-level utilities for VisTrails interaction.
 """
 
+import hashlib
+import logging
+import os
+import re
 import sys
+import weakref
 
-from vistrails.core.modules.basic_modules import Constant
+from dat.utils import DiskCache, LRUCache, file_signature
+
+import vistrails.core.db.io
+from vistrails.core.modules.basic_modules import Constant, Path
 from vistrails.core.modules.module_descriptor import ModuleDescriptor
-from vistrails.core.modules.module_registry import get_module_registry
+from vistrails.core.modules.module_registry import get_module_registry, \
+    ModuleRegistryException
 from vistrails.core.modules.utils import parse_descriptor_string
 from vistrails.core.modules.vistrails_module import Module
+from vistrails.core.packagemanager import get_package_manager
 from vistrails.core.vistrail.controller import VistrailController
+from vistrails.core.vistrail.pipeline import Pipeline
 
 
 def resolve_descriptor(param, package_identifier=None):
@@ -38,12 +49,288 @@ def resolve_descriptor(param, package_identifier=None):
                         "subclass or str object, not '%s'" % type(param))
 
 
-def get_upgraded_pipeline(vistrail, version=None):
+class VistrailCache(object):
+    """Keeps a bounded LRUCache for each vistrail.
+
+    Vistrails are looked up by identity; the cache associated with a vistrail
+    goes away with the vistrail object.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # id(vistrail) -> (weakref to vistrail, LRUCache)
+        self._caches = dict()
+
+    def get(self, vistrail, create=False):
+        """Gets the cache associated with a vistrail.
+
+        Returns None if there is none, unless create is True.
+        """
+        key = id(vistrail)
+        entry = self._caches.get(key)
+        if entry is not None and entry[0]() is vistrail:
+            return entry[1]
+        elif not create:
+            return None
+
+        caches = self._caches
+
+        def forget(ref):
+            if caches.get(key, (None,))[0] is ref:
+                del caches[key]
+
+        cache = LRUCache(self.max_size)
+        caches[key] = weakref.ref(vistrail, forget), cache
+        return cache
+
+    def invalidate(self, vistrail=None, versions=None):
+        """Drops entries from the caches.
+
+        If vistrail is None, everything is dropped. Else, only the entries for
+        this vistrail are, or only the given versions if 'versions' is not
+        None.
+        """
+        if vistrail is None:
+            self._caches.clear()
+            return
+        cache = self.get(vistrail)
+        if cache is None:
+            return
+        if versions is None:
+            cache.clear()
+        else:
+            for version in versions:
+                cache.pop(version)
+
+
+# Maximum number of upgraded pipelines kept for each vistrail
+UPGRADED_PIPELINES_CACHE_SIZE = 256
+
+# Maximum number of bytes used by the upgraded pipelines stored on disk
+UPGRADED_PIPELINES_DISK_CACHE_SIZE = 256 * 1024 ** 2
+
+# vistrail -> version -> Pipeline
+_upgraded_pipelines = VistrailCache(UPGRADED_PIPELINES_CACHE_SIZE)
+# disk key -> serialized Pipeline; see set_disk_cache_directory()
+_upgraded_pipelines_on_disk = None
+
+# Pipelines that are shared and never modified, i.e. the ones returned by
+# get_upgraded_pipeline(); the indexes built for them are kept
+_shared_pipelines = weakref.WeakSet()
+# filename -> (file signature, hash of the content)
+_file_hashes = dict()
+# [(identifier, version)] of the enabled packages, or None
+_package_versions = None
+
+
+def invalidate_upgraded_pipelines(vistrail=None, versions=None):
+    """Drops pipelines from the cache used by get_upgraded_pipeline().
+
+    If vistrail is None, the whole cache is emptied; this should happen when
+    packages are loaded or unloaded, as it changes the result of upgrades.
+    Else, only the pipelines for this vistrail are dropped, or only the given
+    versions if 'versions' is not None (for instance because they were pruned).
+
+    Pipelines stored on disk are keyed on the versions of the packages, so they
+    don't need to be dropped.
+    """
+    global _package_versions
+    if vistrail is None:
+        _package_versions = None
+    _upgraded_pipelines.invalidate(vistrail, versions)
+
+
+def _file_hash(filename):
+    """Returns the SHA1 hash of a file's content, or None.
+
+    Hashes are kept until the file changes.
+    """
+    signature = file_signature(filename)
+    if signature is None:
+        return None
+    entry = _file_hashes.get(filename)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+    hasher = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(65536), ''):
+                hasher.update(chunk)
+    except IOError:
+        return None
+    _file_hashes[filename] = signature, hasher.hexdigest()
+    return hasher.hexdigest()
+
+
+def _upgraded_pipeline_disk_key(vistrail, version, filename=None):
+    """Computes the key of an upgraded pipeline in the disk cache.
+
+    This is the hash of the file the vistrail was loaded from, the version
+    with the date of its action (which tells apart versions created since the
+    file was saved), and the versions of the enabled packages.
+
+    Returns None if the vistrail wasn't loaded from a file.
+    """
+    global _package_versions
+    if filename is None:
+        filename = getattr(getattr(vistrail, 'locator', None), 'name', None)
+    if not filename or not os.path.isfile(filename):
+        return None
+    try:
+        action = vistrail.actionMap[version]
+    except KeyError:
+        return None
+    file_hash = _file_hash(filename)
+    if file_hash is None:
+        return None
+    if _package_versions is None:
+        _package_versions = sorted(
+            (package.identifier, package.version)
+            for package in get_package_manager().enabled_package_list())
+    return repr((file_hash, version, action.date, _package_versions))
+
+
+# Maximum number of values kept by get_variable_value(), for materialized
+# variables of each vistrail and for variables that are being built
+VARIABLE_VALUES_CACHE_SIZE = 32
+
+# Maximum number of bytes used by the values stored on disk
+VARIABLE_VALUES_DISK_CACHE_SIZE = 2 * 1024 ** 3
+
+# vistrail -> version -> (value, disk key)
+_materialized_values = VistrailCache(VARIABLE_VALUES_CACHE_SIZE)
+# signature of the temporary pipeline -> (value, disk key)
+_variable_values = LRUCache(VARIABLE_VALUES_CACHE_SIZE)
+# Variable -> ((operations count, output), Pipeline, signature)
+_variable_pipelines = weakref.WeakKeyDictionary()
+# disk key -> value; see set_disk_cache_directory()
+_variable_values_on_disk = None
+
+# Parameters naming remote data, that can change without DAT noticing
+_URL_PARAMETER = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]+://')
+
+
+def set_disk_cache_directory(directory):
+    """Sets the directory where DAT keeps its caches between sessions.
+
+    The pipelines of vistrail files upgraded by get_upgraded_pipeline() are
+    stored there, as well as the values of variables computed by
+    get_variable_value() if they can be pickled. Nothing is stored on disk
+    until this is called; passing None disables it again.
+    """
+    global _upgraded_pipelines_on_disk, _variable_values_on_disk
+    if directory is None:
+        _upgraded_pipelines_on_disk = None
+        _variable_values_on_disk = None
+    else:
+        _upgraded_pipelines_on_disk = DiskCache(
+            os.path.join(directory, 'pipelines'),
+            UPGRADED_PIPELINES_DISK_CACHE_SIZE)
+        _variable_values_on_disk = DiskCache(
+            os.path.join(directory, 'values'),
+            VARIABLE_VALUES_DISK_CACHE_SIZE)
+
+
+def get_variable_values_disk_cache():
+    """Returns the DiskCache of variable values, or None if it's disabled.
+    """
+    return _variable_values_on_disk
+
+
+def variable_value_disk_key(pipeline, output_id):
+    """Computes the key of a variable's value in the disk cache.
+
+    This is the signature of the subpipeline upstream of the output module,
+    along with the version of the packages it uses and the signature of the
+    files named by its parameters (Path modules, but also filenames given as
+    strings), so that upgrading a package or modifying an input file
+    invalidates the value.
+
+    Returns None if the value must not be kept on disk: a module of the
+    pipeline is not available, reads data the key can't account for (a URL
+    parameter), or opted out. Modules opt out by setting a
+    'dat_disk_cacheable' class attribute to False; the modules of loaders
+    whose results depend on some other state (a database, a web service)
+    should do this.
+    """
+    reg = get_module_registry()
+    packages = set()
+    files = set()
+    try:
+        for module in pipeline.module_list:
+            packages.add((module.package,
+                          reg.get_package_by_name(module.package).version))
+            module_class = module.module_descriptor.module
+            if not getattr(module_class, 'dat_disk_cacheable', True):
+                return None
+            for function in module.functions:
+                for param in function.params:
+                    value = param.strValue
+                    if _URL_PARAMETER.match(value):
+                        return None
+                    elif (issubclass(module_class, Path) or
+                            os.path.isfile(value)):
+                        files.add((value, file_signature(value)))
+    except ModuleRegistryException:
+        return None
+    return repr((pipeline.subpipeline_signature(output_id),
+                 sorted(packages),
+                 sorted(files)))
+
+
+_missing = object()
+
+
+def read_cached_variable_value(disk_key):
+    """Gets a variable value that use_cached_values() put in a plot pipeline.
+
+    The value is read from the disk cache. Raises KeyError if it is not
+    available anymore.
+    """
+    if _variable_values_on_disk is not None:
+        value = _variable_values_on_disk.get(disk_key, _missing)
+        if value is not _missing:
+            return value
+    raise KeyError("variable value is not in the cache anymore")
+
+
+def invalidate_variable_values(vistrail=None, versions=None):
+    """Drops values from the cache used by get_variable_value().
+
+    If vistrail is None, every value is dropped from memory; DAT does this when
+    packages are loaded or unloaded. Else, only the values of the variables
+    stored in that vistrail are dropped, or only those of the given versions if
+    'versions' is not None; these are also removed from the disk cache.
+
+    Loaders reading data that might have changed since the value was computed
+    should call this before asking for the value again.
+    """
+    if vistrail is None:
+        _variable_values.clear()
+        _variable_pipelines.clear()
+    elif _variable_values_on_disk is not None:
+        cache = _materialized_values.get(vistrail)
+        if cache is not None:
+            for version in (cache.keys() if versions is None else versions):
+                value, disk_key = cache.get(version, (None, None))
+                if disk_key is not None:
+                    _variable_values_on_disk.pop(disk_key)
+    _materialized_values.invalidate(vistrail, versions)
+
+
+def get_upgraded_pipeline(vistrail, version=None, filename=None):
     """This is similar to Vistrail#getPipeline() but performs upgrades.
 
     getPipeline() can fail if the original pipeline has a different version.
     In contrast, this function will update the pipeline first using a
     controller.
+
+    Results are cached for each vistrail (see invalidate_upgraded_pipelines()),
+    so the returned pipeline is shared and must not be modified.
+
+    If a disk cache directory was set (see set_disk_cache_directory()), the
+    pipelines of vistrails loaded from a file are also kept there, so opening
+    the file again doesn't need to upgrade them. The file is found from the
+    vistrail's locator, unless 'filename' is given.
     """
     if version is None:
         version = vistrail.get_latest_version()
@@ -54,10 +341,86 @@ def get_upgraded_pipeline(vistrail, version=None):
     else:
         raise TypeError
 
+    cache = _upgraded_pipelines.get(vistrail, create=True)
+    try:
+        return cache[version]
+    except KeyError:
+        pass
+
+    disk_key = None
+    if _upgraded_pipelines_on_disk is not None:
+        disk_key = _upgraded_pipeline_disk_key(vistrail, version, filename)
+    if disk_key is not None:
+        serialized = _upgraded_pipelines_on_disk.get(disk_key)
+        if serialized is not None:
+            try:
+                pipeline = vistrails.core.db.io.unserialize(serialized,
+                                                            Pipeline)
+            except Exception:
+                logging.warning("Discarding invalid cached pipeline",
+                                exc_info=True)
+                _upgraded_pipelines_on_disk.pop(disk_key)
+            else:
+                cache[version] = pipeline
+                _shared_pipelines.add(pipeline)
+                return pipeline
+
     controller = VistrailController(vistrail)
     controller.recompute_terse_graph()  # FIXME : this shouldn't be needed...
     controller.do_version_switch(version)
-    return controller.current_pipeline
+    pipeline = controller.current_pipeline
+    cache[version] = pipeline
+    _shared_pipelines.add(pipeline)
+    if disk_key is not None:
+        _upgraded_pipelines_on_disk.set(
+            disk_key,
+            vistrails.core.db.io.serialize(pipeline))
+    return pipeline
+
+
+class AnnotationIndex(object):
+    """Index of the action annotations of a vistrail, by key and version.
+
+    The index is built in a single pass over the vistrail's annotations, only
+    keeping the given keys. Annotations should then be changed through set(),
+    which updates both the vistrail and the index.
+    """
+    def __init__(self, vistrail, keys):
+        self._vistrail = vistrail
+        self._index = dict((key, dict()) for key in keys)  # key -> {version}
+        self.scanned = 0
+        for an in vistrail.action_annotations:
+            self.scanned += 1
+            try:
+                self._index[an.key][an.action_id] = an.value
+            except KeyError:
+                pass
+
+    def get(self, key, version, default=None):
+        """Gets the value of an annotation, or default if it doesn't exist.
+        """
+        return self._index[key].get(version, default)
+
+    def iteritems(self, key):
+        """Iterates on the (version, value) pairs of an indexed key.
+        """
+        return self._index[key].iteritems()
+
+    def __len__(self):
+        return sum(len(versions) for versions in self._index.itervalues())
+
+    def set(self, version, key, value):
+        """Sets or removes (if value is None) an annotation on a version.
+        """
+        self._vistrail.set_action_annotation(version, key, value)
+        try:
+            versions = self._index[key]
+        except KeyError:
+            return  # Not an indexed key
+        if value is None:
+            versions.pop(version, None)
+        else:
+            versions[version] = value
 
 
 def get_function(module, function_name):
@@ -70,16 +433,106 @@ def get_function(module, function_name):
     return None
 
 
-def read_port_specs(pipeline, port):
+class PipelineGraph(object):
+    """Adjacency view of the connections of a pipeline.
+
+    Connections are indexed by module id and by (module id, port name), in
+    both directions. Use get_pipeline_graph() to get the shared graph of a
+    pipeline.
+
+    The graph is not updated if the pipeline is modified.
+    """
+    def __init__(self, pipeline):
+        # module id -> [Connection]
+        self._outgoing = dict()
+        self._incoming = dict()
+        # (module id, port name) -> [Connection]
+        self._outgoing_ports = dict()
+        self._incoming_ports = dict()
+        for connection in pipeline.connection_list:
+            src, dest = connection.source, connection.destination
+            self._outgoing.setdefault(src.moduleId, []).append(connection)
+            self._outgoing_ports.setdefault(
+                (src.moduleId, src.name), []).append(connection)
+            self._incoming.setdefault(dest.moduleId, []).append(connection)
+            self._incoming_ports.setdefault(
+                (dest.moduleId, dest.name), []).append(connection)
+
+    def outgoing(self, module_id, port_name=None):
+        """Returns the connections from a module, or from one of its ports.
+        """
+        if port_name is None:
+            return self._outgoing.get(module_id, [])
+        return self._outgoing_ports.get((module_id, port_name), [])
+
+    def incoming(self, module_id, port_name=None):
+        """Returns the connections to a module, or to one of its ports.
+        """
+        if port_name is None:
+            return self._incoming.get(module_id, [])
+        return self._incoming_ports.get((module_id, port_name), [])
+
+    def connections(self, module_id):
+        """Returns all the connections a module takes part in.
+        """
+        return self.outgoing(module_id) + self.incoming(module_id)
+
+
+class _ScannedPipelineGraph(object):
+    """Same interface as PipelineGraph, for a pipeline that can change.
+
+    Nothing is indexed: each lookup scans the pipeline's connections.
+    """
+    def __init__(self, pipeline):
+        self._pipeline = pipeline
+
+    def outgoing(self, module_id, port_name=None):
+        return [c
+                for c in self._pipeline.connection_list
+                if (c.source.moduleId == module_id and
+                    (port_name is None or c.source.name == port_name))]
+
+    def incoming(self, module_id, port_name=None):
+        return [c
+                for c in self._pipeline.connection_list
+                if (c.destination.moduleId == module_id and
+                    (port_name is None or c.destination.name == port_name))]
+
+    def connections(self, module_id):
+        return self.outgoing(module_id) + self.incoming(module_id)
+
+
+# Pipeline -> PipelineGraph
+_pipeline_graphs = weakref.WeakKeyDictionary()
+
+
+def get_pipeline_graph(pipeline):
+    """Gets a graph view of the connections of a pipeline.
+
+    For the pipelines returned by get_upgraded_pipeline(), which are never
+    modified, this is a PipelineGraph, built once and shared. Other pipelines
+    can change at any time, so they are not indexed: the returned view scans
+    their connections on each lookup.
+    """
+    graph = _pipeline_graphs.get(pipeline)
+    if graph is None:
+        if pipeline in _shared_pipelines:
+            graph = _pipeline_graphs[pipeline] = PipelineGraph(pipeline)
+        else:
+            graph = _ScannedPipelineGraph(pipeline)
+    return graph
+
+
+def read_port_specs(pipeline, port, graph=None):
     default_type = None
     default_value = None
 
+    if graph is None:
+        graph = get_pipeline_graph(pipeline)
+
     # First: try from the InputPort's 'Default' port
     # Connections to the 'Default' port
-    connections = [c
-                   for c in pipeline.connection_list
-                   if (c.destination.moduleId == port.id and
-                       c.destination.name == 'Default')]
+    connections = graph.incoming(port.id, 'Default')
     if len(connections) > 1:
         raise ValueError("multiple default values set")
     elif len(connections) == 1:
@@ -91,10 +544,7 @@ def read_port_specs(pipeline, port):
             module_type, get_function(module, 'value'))
 
     # Connections from the 'InternalPipe' port
-    connections = [c
-                   for c in pipeline.connection_list
-                   if (c.source.moduleId == port.id and
-                       c.source.name == 'InternalPipe')]
+    connections = graph.outgoing(port.id, 'InternalPipe')
     if len(connections) != 1:
         # Can't guess anything here
         return default_type, default_value, None, None
@@ -129,13 +579,11 @@ def walk_modules(pipeline, modules,
     if connection_filter is None:
         connection_filter = lambda m: True
 
-    # Build a map of the connections in which each module takes part
-    module_connections = dict()
-    for connection in pipeline.connection_list:
-        for mod in (connection.source.moduleId,
-                    connection.destination.moduleId):
-            conns = module_connections.setdefault(mod, set())
-            conns.add(connection)
+    # A pipeline that can change gets a graph for this walk only
+    if pipeline in _shared_pipelines:
+        graph = get_pipeline_graph(pipeline)
+    else:
+        graph = PipelineGraph(pipeline)
 
     visited_connections = set()
 
@@ -152,7 +600,7 @@ def walk_modules(pipeline, modules,
         # For each module considered
         for module in open_list:
             # For each connection it takes part in
-            for connection in module_connections.get(module.id, []):
+            for connection in graph.connections(module.id):
                 # If that connection passes the filter
                 if (connection not in visited_connections and
                         connection_filter(connection)):
@@ -177,7 +625,7 @@ def walk_modules(pipeline, modules,
 
     conn_selected = set()
     for module in selected:
-        conn_selected.update(module_connections.get(module.id, []))
+        conn_selected.update(graph.connections(module.id))
 
     return selected, conn_selected
 
@@ -207,10 +655,64 @@ def delete_linked(controller, modules, operations,
     return set(mod.id for mod in to_delete)
 
 
-def find_modules_by_type(pipeline, moduletypes):
+class ModuleTypeIndex(object):
+    """Index of the modules of a pipeline by type.
+
+    Each module is listed under its class and every one of its base classes,
+    in the order of pipeline.module_list. Use get_module_type_index() to get
+    the shared index of a pipeline.
+
+    The index is not updated if the pipeline is modified.
+    """
+    def __init__(self, pipeline):
+        self._positions = dict()  # module id -> position in module_list
+        self._types = dict()  # class -> [module id]
+        for position, module in enumerate(pipeline.module_list):
+            self._positions[module.id] = position
+            for cls in module.module_descriptor.module.__mro__:
+                self._types.setdefault(cls, []).append(module.id)
+
+    def find(self, moduletypes):
+        """Returns the ids of the modules subclassing one of the given types.
+        """
+        if len(moduletypes) == 1:
+            return list(self._types.get(moduletypes[0], ()))
+        ids = set()
+        for moduletype in moduletypes:
+            ids.update(self._types.get(moduletype, ()))
+        return sorted(ids, key=self._positions.__getitem__)
+
+
+# Pipeline -> ModuleTypeIndex
+_module_type_indexes = weakref.WeakKeyDictionary()
+
+
+def get_module_type_index(pipeline):
+    """Gets the shared ModuleTypeIndex of a pipeline, or None.
+
+    Only the pipelines returned by get_upgraded_pipeline(), which are never
+    modified, get an index; it is built once. Other pipelines can change at
+    any time, so None is returned for them.
+    """
+    index = _module_type_indexes.get(pipeline)
+    if index is None and pipeline in _shared_pipelines:
+        index = _module_type_indexes[pipeline] = ModuleTypeIndex(pipeline)
+    return index
+
+
+def find_modules_by_type(pipeline, moduletypes, index=None):
     """Finds all modules that subclass one of the given types in the pipeline.
+
+    Shared pipelines are looked up in their ModuleTypeIndex, so repeated
+    lookups don't check every module; the index to use can also be given.
+    The modules of other pipelines are checked one by one.
     """
     moduletypes = tuple(moduletypes)
+    if index is None:
+        index = get_module_type_index(pipeline)
+    if index is not None:
+        modules = pipeline.modules
+        return [modules[mod_id] for mod_id in index.find(moduletypes)]
     result = []
     for module in pipeline.module_list:
         desc = module.module_descriptor
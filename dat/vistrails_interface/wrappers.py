@@ -9,10 +9,12 @@ from itertools import izip
 import os
 import warnings
 
-from dat.utils import abbrev
+from dat.utils import abbrev, file_signature
 from dat.vistrails_interface.pipelines import PipelineGenerator
 from dat.vistrails_interface.utils import resolve_descriptor, \
-    get_upgraded_pipeline, get_function, read_port_specs, find_modules_by_type
+    get_upgraded_pipeline, invalidate_upgraded_pipelines, \
+    invalidate_variable_values, get_function, read_port_specs, \
+    find_modules_by_type, get_pipeline_graph
 
 from vistrails.core import get_vistrails_application
 from vistrails.core.db.action import create_action
@@ -77,6 +79,23 @@ class ModuleWrapper(object):
             inputport_name,
             value)
 
+    def add_port(self, port_type, port_name, vt_type):
+        """Add a port to a module that accepts user-defined ports.
+
+        This is for modules such as PythonSource, whose ports are declared on
+        each module in the pipeline. port_type is either 'input' or 'output';
+        vt_type is resolvable to a VisTrails module type.
+        """
+        if port_type not in ('input', 'output'):
+            raise ValueError("add_port() port_type must be 'input' or "
+                             "'output'")
+        descriptor = resolve_descriptor(vt_type)
+        controller = self._variable._generator.controller
+        # The module hasn't been created in the vistrail yet, so its port
+        # specs get added with it
+        self._module.add_port_spec(controller.create_port_spec(
+            self._module, port_type, port_name, descriptor.sigstring))
+
     def connect_outputport_to(self, outputport_name,
                               other_module, inputport_name):
         """Create a connection between ports of two modules.
@@ -128,6 +147,8 @@ class Variable(object):
             version = controller.vistrail.get_version_number(
                 'dat-var-%s' % self.name)
             controller.prune_versions([version])
+            invalidate_upgraded_pipelines(controller.vistrail, [version])
+            invalidate_variable_values(controller.vistrail, [version])
 
         def rename(self, new_varname):
             """Change the tag on this version in the Vistrail.
@@ -295,6 +316,15 @@ class Variable(object):
         self._materialized = variable_info
         return variable_info
 
+    @property
+    def materialized(self):
+        """The VariableInformation of this Variable, if it was materialized.
+
+        None for intermediate results, that only exist to build another
+        Variable.
+        """
+        return self._materialized
+
     @staticmethod
     def read_type(pipeline):
         """Read the type of a Variable from its pipeline.
@@ -342,6 +372,20 @@ class ArgumentWrapper(object):
         self._variable = variable
         self._copied = False
 
+    @property
+    def provenance(self):
+        """The data provenance of the argument, e.g. a Constant.
+        """
+        return self._variable.provenance
+
+    def mark_used(self):
+        """Indicates that the argument was used without being connected.
+
+        This is for operations that read the value from the provenance (for
+        instance, a constant), so no warning is issued about the argument.
+        """
+        self._copied = True
+
     def connect_to(self, module, inputport_name):
         generator = module._variable._generator
         if not self._copied:
@@ -418,6 +462,7 @@ class Plot(object):
         package = os.path.dirname(inspect.getabsfile(caller))
 
         self.callback = self.subworkflow = None
+        self._pipeline = self._pipeline_signature = None
 
         # Build plot from a subworkflow
         if 'pipeline' in kwargs and 'subworkflow' in kwargs:
@@ -448,11 +493,23 @@ class Plot(object):
 
         This might mean materializing it from a callback or translating it from
         a user-friendly format.
+
+        A subworkflow is only loaded and upgraded once; the result is kept
+        until the file changes on disk or the package is reloaded. The
+        returned pipeline is shared: callers copy its modules and connections
+        into the pipelines they build and must not modify it.
         """
         if self.subworkflow is not None:
-            locator = XMLFileLocator(self.subworkflow)
-            vistrail = locator.load()
-            return get_upgraded_pipeline(vistrail)
+            signature = file_signature(self.subworkflow)
+            if (self._pipeline is None or
+                    signature != self._pipeline_signature):
+                locator = XMLFileLocator(self.subworkflow)
+                vistrail = locator.load()
+                self._pipeline = get_upgraded_pipeline(
+                    vistrail,
+                    filename=self.subworkflow)
+                self._pipeline_signature = signature
+            return self._pipeline
         else:
             callback_ret = self.pipeline_arg
             if callable(callback_ret):
@@ -468,6 +525,11 @@ class Plot(object):
                 raise ValueError("Plot pipeline is invalid value %s" %
                                  abbrev(repr(callback_ret)))
 
+    def _invalidate_pipeline(self):
+        """Forgets the pipeline loaded from the subworkflow file, if any.
+        """
+        self._pipeline = self._pipeline_signature = None
+
     def _read_metadata(self, package_identifier):
         """Reads a plot's ports from the subworkflow file
 
@@ -489,6 +551,7 @@ class Plot(object):
         inputports = find_modules_by_type(pipeline, [InputPort])
         if not inputports:
             raise ValueError("No InputPort module")
+        graph = get_pipeline_graph(pipeline)
 
         currentports = {port.name: port for port in self.ports}
         seenports = set()
@@ -568,7 +631,8 @@ class Plot(object):
                 (default_type, default_value,
                  entry_type, enum_values) = read_port_specs(
                      pipeline,
-                     port)
+                     port,
+                     graph)
                 if default_value is not None:
                     if not issubclass(default_type, type.module):
                         raise ValueError("incompatible type %r" % ((
@@ -782,23 +846,22 @@ def add_variable_subworkflow(generator, variable, plot_ports=None):
                 var_modules_map[connection.destination.moduleId],
                 connection.destination.name)
 
+    output_connections = get_pipeline_graph(var_pipeline).incoming(output_id)
     if plot_ports:
         connection_ids = []
         # Connects the port previously connected to the OutputPort to the ports
         # in plot_ports
-        for connection in var_pipeline.connection_list:
-            if connection.destination.moduleId == output_id:
-                for var_output_mod, var_output_port in plot_ports:
-                    connection_ids.append(generator.connect_modules(
-                        var_modules_map[connection.source.moduleId],
-                        connection.source.name,
-                        var_output_mod,
-                        var_output_port))
+        for connection in output_connections:
+            for var_output_mod, var_output_port in plot_ports:
+                connection_ids.append(generator.connect_modules(
+                    var_modules_map[connection.source.moduleId],
+                    connection.source.name,
+                    var_output_mod,
+                    var_output_port))
         return connection_ids
     else:
         # Just find the output port and return it
-        for connection in var_pipeline.connection_list:
-            if connection.destination.moduleId == output_id:
-                return (var_modules_map[connection.source.moduleId],
-                        connection.source.name)
-        assert False
+        assert output_connections
+        connection = output_connections[0]
+        return (var_modules_map[connection.source.moduleId],
+                connection.source.name)